@@ -0,0 +1,126 @@
+import os
+import json
+import time
+import argparse
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from mock_server import MockServer
+
+# Offline benchmark of the workflow against mock_server.py.
+# Runs transkribus_workflow and update_or_create_file for synthetic batches of documents
+# and reports wall time, throughput, server requests and the per-stage metrics of instrumentation.py.
+#
+#   python benchmark.py --sizes 10 100 1000 --latency 0.01 --job-duration 2 --error-rate 0.01
+
+# accepts every XML document, so validation costs time but never fails
+PERMISSIVE_SCHEMA = """<grammar xmlns="http://relaxng.org/ns/structure/1.0">
+  <start><ref name="any"/></start>
+  <define name="any">
+    <element><anyName/><zeroOrMore><choice><attribute><anyName/></attribute><text/><ref name="any"/></choice></zeroOrMore></element>
+  </define>
+</grammar>
+"""
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the workflow against a local mock server")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000], help="documents per batch (10 to 10000)")
+    parser.add_argument("--scenarios", nargs="+", default=["transkribus", "exist"], choices=["transkribus", "exist"])
+    parser.add_argument("--pages", type=int, default=2, help="pages per Transkribus document")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every request")
+    parser.add_argument("--job-duration", type=float, default=1.0, help="run time of every Transkribus job")
+    parser.add_argument("--queue-time", type=float, default=0.5, help="mean queue time of every Transkribus job")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with 503")
+    parser.add_argument("--pipelined", action="store_true", help="run transkribus_workflow with the staged pipeline")
+    parser.add_argument("--workers", type=int, default=8, help="parallel update_or_create_file calls")
+    parser.add_argument("--output", default="benchmark_results.json")
+    return parser.parse_args()
+
+
+def api_delta(before, after):
+    return {key: after[key] - before[key] for key in after}
+
+
+def main():
+    args = parse_args()
+    server = MockServer(latency=args.latency, job_duration=args.job_duration,
+                        queue_time=args.queue_time, error_rate=args.error_rate).start()
+    workdir = tempfile.mkdtemp(prefix="benchmark_")
+    schema_path = os.path.join(workdir, "any.rng")
+    with open(schema_path, "w", encoding="utf-8") as f:
+        f.write(PERMISSIVE_SCHEMA)
+
+    os.environ.update(server.environment())
+    os.environ.update({
+        "TRANSKRIBUS_SESSION_CACHE": os.path.join(workdir, "session.json"),
+        "TRANSKRIBUS_DOWNLOAD_DIR": os.path.join(workdir, "downloads"),
+        "TRANSKRIBUS_RATE_LIMIT": "0",
+        "METRICS_DIR": os.path.join(workdir, "metrics"),
+        "RELAXNG_SCHEMA_PATH": schema_path,
+    })
+    # the workflow modules read their configuration when they are imported
+    from transkribus_main import transkribus_workflow
+    from exist_tasks import update_or_create_file, fetch_server, EXIST_SERVER
+    from instrumentation import get_recorder
+    from transkribus_client import get_metrics
+    from error_codes import UPLOAD_SUCCESS
+
+    def measured(scenario, documents, run):
+        get_recorder().reset()
+        api_before = get_metrics()["total"]
+        requests_before = server.state.requests
+        start = time.perf_counter()
+        details = run()
+        seconds = time.perf_counter() - start
+        result = {
+            "scenario": scenario,
+            "documents": documents,
+            "seconds": seconds,
+            "documents_per_second": documents / seconds if seconds else 0,
+            "server_requests": server.state.requests - requests_before,
+            "api": api_delta(api_before, get_metrics()["total"]),
+            "stages": get_recorder().snapshot()["stages"],
+            **details,
+        }
+        print(f"{scenario:<20} {documents:>6} docs  {seconds:8.1f} s  {result['documents_per_second']:8.1f} docs/s  "
+              f"{result['server_requests']:>7} requests  {result['api']['retries']:>4} retries")
+        return result
+
+    def run_transkribus(documents):
+        server.state.reset()
+        server.state.seed_documents(documents, args.pages)
+        state_db = os.path.join(workdir, f"state_transkribus_{documents}.db")
+        transkribus_workflow(pipelined=args.pipelined, upload=False, state_db=state_db)
+        exported = sum(1 for job in server.state.jobs.values() if job["jobType"] == "Export")
+        return {"exported": exported}
+
+    def run_exist(documents, state_db):
+        ids = [f"doc_{i:05d}" for i in range(documents)]
+        with ThreadPoolExecutor(max_workers=args.workers) as pool:
+            statuses = list(pool.map(
+                lambda id_to_get: update_or_create_file.fn(fetch_server, EXIST_SERVER, "benchmark", id_to_get, state_db),
+                ids,
+            ))
+        return {"uploaded": sum(1 for status in statuses if status == UPLOAD_SUCCESS)}
+
+    results = []
+    try:
+        for documents in args.sizes:
+            if "transkribus" in args.scenarios:
+                results.append(measured("transkribus_workflow", documents, lambda: run_transkribus(documents)))
+            if "exist" in args.scenarios:
+                server.state.reset()
+                server.state.seed_sources([f"doc_{i:05d}" for i in range(documents)])
+                state_db = os.path.join(workdir, f"state_exist_{documents}.db")
+                results.append(measured("update_or_create", documents, lambda: run_exist(documents, state_db)))
+                # second pass: sources answer 304 and nothing has to be pushed again
+                results.append(measured("update_or_create (2)", documents, lambda: run_exist(documents, state_db)))
+    finally:
+        server.stop()
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"settings": vars(args), "results": results}, f, indent=2)
+        print(f"Results written to {args.output}, work files in {workdir}")
+
+
+if __name__ == "__main__":
+    main()
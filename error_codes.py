@@ -0,0 +1,13 @@
+# Status codes returned by the fetch, validation and upload tasks (exist_tasks, helper_tasks).
+# They are also used as prefix of the messages in the summary issues, so they are readable strings.
+
+FILE_FETCH_SUCCESS = "FILE_FETCH_SUCCESS"
+FILE_FETCH_FAILED = "FILE_FETCH_FAILED"
+
+VALIDATION_SUCCESS = "VALIDATION_SUCCESS"
+VALIDATION_FAILED = "VALIDATION_FAILED"
+VALIDATION_EXCEPTION = "VALIDATION_EXCEPTION"
+
+UPLOAD_SUCCESS = "UPLOAD_SUCCESS"
+UPLOAD_FAILED = "UPLOAD_FAILED"
+UPLOAD_VALIDATION_FAILED = "UPLOAD_VALIDATION_FAILED"
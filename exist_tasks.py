@@ -2,11 +2,18 @@ import os
 import requests as r
 from requests.auth import HTTPBasicAuth
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 from prefect import task
-from git_tasks import create_issue_on_gitlab, update_gitlab_issue, close_gitlab_issue
+from git_tasks import IssueReporter, flushes_process_reporter, get_run_reporter
 import tempfile
+import hashlib
+from lxml import etree
 from dotenv import load_dotenv
-from helper_tasks import validate_xml_with_rng
+from state_store import StateStore, STATE_DB
+from instrumentation import measure
+from helper_tasks import validate_xml_bytes
 from error_codes import FILE_FETCH_SUCCESS, FILE_FETCH_FAILED, UPLOAD_SUCCESS, UPLOAD_FAILED, UPLOAD_VALIDATION_FAILED
 
 
@@ -17,7 +24,8 @@ EXIST_SERVER = os.getenv("exist_server") # target-server for the upload
 EXIST_USER = os.getenv("exist_user")
 EXIST_PASSWORD = os.getenv("exist_password")
 RELAXNG_SCHEMA_PATH = os.getenv("RELAXNG_SCHEMA_PATH") # should be a path to the file on the server, where the RelaxNG schema is stored.
-fetch_server = "https://exist.ulb.tu-darmstadt.de/2/g/"
+fetch_server = os.getenv("exist_fetch_server", "https://exist.ulb.tu-darmstadt.de/2/g/") # source server of the files
+SPOOL_THRESHOLD = int(os.getenv("EXIST_SPOOL_THRESHOLD", str(16 * 1024 * 1024))) # bigger files are spooled to disk
 
 # exist_server:  exist_server="https://exist.ulb.tu-darmstadt.de/3/r/edoc/collection/"
 
@@ -29,16 +37,76 @@ def create_version_of_file():
     pass
 
 
-def get_file_from_server(fetch_server, id_to_get):
+def fetch_source(session, fetch_server, id_to_get, store, known_hash=None, spool_threshold=SPOOL_THRESHOLD):
+    '''fetches a file into a SpooledTemporaryFile and records its validators and sha256 in {store}
+    The body is streamed into the buffer, so only files up to spool_threshold are held in memory.
+    If the validators in {store} belong to the content known_hash (e.g. the hash last pushed),
+    If-None-Match / If-Modified-Since are sent and a 304 answer means the file is still known_hash.
+    returns (buffer, status_code, sha256), buffer is None if the file is unchanged (304) or couldn't be fetched.
+    The caller has to close the buffer.
+    '''
+    cached = store.get_cached_source(fetch_server, id_to_get)
+    headers = {}
+    if cached and known_hash and cached["sha256"] == known_hash:
+        if cached["etag"]:
+            headers["If-None-Match"] = cached["etag"]
+        if cached["last_modified"]:
+            headers["If-Modified-Since"] = cached["last_modified"]
+
+    with measure("exist_fetch") as measurement:
+        with session.get(fetch_server + id_to_get, headers=headers, stream=True) as response:
+            if response.status_code == 304 and headers:
+                return None, 304, known_hash
+            if response.status_code != 200:
+                return None, response.status_code, None
+
+            buffer = tempfile.SpooledTemporaryFile(max_size=spool_threshold)
+            sha256 = hashlib.sha256()
+            try:
+                for chunk in response.iter_content(chunk_size=64 * 1024):
+                    buffer.write(chunk)
+                    sha256.update(chunk)
+            except Exception:
+                buffer.close()
+                raise
+            measurement.bytes = buffer.tell()
+            buffer.seek(0)
+
+    content_hash = sha256.hexdigest()
+    store.save_cached_source(
+        fetch_server, id_to_get, content_hash,
+        etag=response.headers.get("ETag"), last_modified=response.headers.get("Last-Modified"),
+    )
+    return buffer, 200, content_hash
+
+
+def get_file_from_server(fetch_server, id_to_get, in_memory=False, spool_threshold=SPOOL_THRESHOLD, store=None):
     '''fetches a file from an exist-server and saves it temporarily
     args:
     id_to_get: str: the id of the file to get, on the server from which the file is taken.
     still needs fetch_server to construct the url dynamically
+    in_memory: bool: return a buffer instead of a path. The buffer keeps the file in memory
+    and is only spooled to disk if it gets bigger than spool_threshold. The caller has to close it.
+    store: StateStore: if given, the validators and the hash of the file are recorded (see fetch_source).
     '''
+    if store is not None and in_memory:
+        buffer, status_code, _ = fetch_source(get_exist_session(user=None), fetch_server, id_to_get, store,
+                                              spool_threshold=spool_threshold)
+        if buffer is None:
+            print(f"ERROR: Failed to fetch file {id_to_get}, status: {status_code}")
+            return None, FILE_FETCH_FAILED
+        return buffer, FILE_FETCH_SUCCESS
+
     server_url = fetch_server
     id_to_get = id_to_get
-    response = r.get(server_url+id_to_get)
-    temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=".xml")
+    response = r.get(server_url+id_to_get, stream=in_memory)
+    if response.status_code == 200 and in_memory:
+        buffer = tempfile.SpooledTemporaryFile(max_size=spool_threshold)
+        for chunk in response.iter_content(chunk_size=64 * 1024):
+            buffer.write(chunk)
+        buffer.seek(0)
+        return buffer, FILE_FETCH_SUCCESS
+
     if response.status_code == 200:
         temp_dir = tempfile.gettempdir()
         temp_path = os.path.join(temp_dir, f"{id_to_get}.xml")
@@ -54,97 +122,124 @@ def get_file_from_server(fetch_server, id_to_get):
 
 
 @task
-def update_or_create_file(fetch_server, target_server, collection, id_to_get):
+@flushes_process_reporter
+def update_or_create_file(fetch_server, target_server, collection, id_to_get, state_db=STATE_DB):
     '''
     Tries fetching a file from an exist-db server, validates it against a RelaxNG schema, and uploads it to the server.
-    Documents each step in the process by creating a GitLab issue and updating it accordingly.
+    Failures are collected in the summary issue of the run (see git_tasks.IssueReporter).
+    The file is kept in one buffer from fetch to upload, no temp file is written (see get_file_from_server).
+    A file whose hash matches the version last pushed to the target is neither validated nor uploaded again,
+    the fetch of such a file is conditional (ETag/Last-Modified, see fetch_source). state_db=None disables the cache.
     fetch_server should be the same as in get_file_from_server
     Args:
         fetch_server (str): The server from which the file is fetched - not used, yet.
         target_server (str): The server to which the file is uploaded - not used, yet.
         collection (str): The collection in which the file is stored.
         id_to_get (str): The ID of the file to get from the source server.
+        state_db (str): Path of the SQLite file with the source validators and the pushed hashes.
 
     Returns:
         str: Status message indicating success or failure.
     '''
+    store = StateStore(state_db) if state_db else None
+    pushed_hash = store.get_pushed_hash(PUSHED_TARGET, collection, f"{id_to_get}.xml") if store is not None else None
     try:
-        file_path, fetch_status = get_file_from_server(fetch_server=fetch_server, id_to_get=id_to_get)
+        if store is not None:
+            buffer, status_code, content_hash = fetch_source(
+                get_exist_session(user=None), fetch_server, id_to_get, store, known_hash=pushed_hash
+            )
+            fetch_status = FILE_FETCH_SUCCESS if buffer is not None or status_code == 304 else FILE_FETCH_FAILED
+        else:
+            buffer, fetch_status = get_file_from_server(fetch_server=fetch_server, id_to_get=id_to_get, in_memory=True)
+            content_hash = None
     except Exception as e:
-        issue_id = create_issue_on_gitlab(
-            title=f"Error fetching {id_to_get} from {fetch_server}",
-            description=f"Exception occurred while fetching file {id_to_get}: {str(e)} - from {fetch_server}"
-        )
+        get_run_reporter().failure(id_to_get, f"{FILE_FETCH_FAILED}: Exception while fetching from {fetch_server}: {e}")
         print(f"Error fetching file {id_to_get}: {e}")
         return FILE_FETCH_FAILED
 
     if fetch_status != FILE_FETCH_SUCCESS:
-        issue_id = create_issue_on_gitlab(
-            title=f"{id_to_get} not found on {fetch_server}",
-            description=f"Could not fetch file with ID {id_to_get} from the server {fetch_server}"
-        )
+        get_run_reporter().failure(id_to_get, f"{fetch_status}: not found on {fetch_server}")
         print(fetch_status)
         return fetch_status
 
+    if pushed_hash is not None and content_hash == pushed_hash:
+        if buffer is not None:
+            buffer.close()
+        print(f"{id_to_get} is unchanged since the last upload, skipped.")
+        get_run_reporter().success(id_to_get)
+        return UPLOAD_SUCCESS
+
+    with buffer:
+        status = validate_and_upload(buffer, collection, id_to_get)
+        if status == UPLOAD_SUCCESS and store is not None:
+            store.save_pushed_hash(PUSHED_TARGET, collection, f"{id_to_get}.xml", content_hash)
+        return status
+
+
+def hash_buffer(buffer):
+    '''returns the sha256 of a binary file object and rewinds it'''
+    sha256 = hashlib.sha256()
+    for chunk in iter(lambda: buffer.read(64 * 1024), b""):
+        sha256.update(chunk)
+    buffer.seek(0)
+    return sha256.hexdigest()
+
+
+def validate_and_upload(buffer, collection, id_to_get):
+    '''validates the fetched file from {buffer} and uploads the same buffer, used by update_or_create_file'''
+    reporter = get_run_reporter()
     # Validate the XML file
     try:
-        is_valid, validation_status = validate_xml_with_rng(file_path,RELAXNG_SCHEMA_PATH, id_to_get)
-        if not is_valid:
-            issue_id = create_issue_on_gitlab(
-                title=f"Validation failed for {id_to_get}",
-                description=f"Validation errors:\n{validation_status}"
-            )
+        result = validate_xml_bytes(buffer, RELAXNG_SCHEMA_PATH, id_to_get)
+        buffer.seek(0)
+        if not result["valid"]:
+            errors = "; ".join(f"Line {error['line']}: {error['message']}" for error in result["errors"])
+            reporter.failure(id_to_get, f"{UPLOAD_VALIDATION_FAILED}: {errors}")
             print("Validation failed")
             return UPLOAD_VALIDATION_FAILED
     except Exception as e:
-        issue_id = create_issue_on_gitlab(
-            title=f"Validation error for {id_to_get}",
-            description=f"Exception occurred while validating {id_to_get}: {str(e)}"
-        )
+        reporter.failure(id_to_get, f"{UPLOAD_VALIDATION_FAILED}: Exception while validating: {e}")
         print(f"Validation error: {e}")
         return UPLOAD_VALIDATION_FAILED
 
     # Construct upload URL
     url = EXIST_SERVER + collection
-    file_name = os.path.basename(file_path)
+    file_name = f"{id_to_get}.xml"
     target_path = f"texts/{file_name}"
 
-    issue_title = f"Processing file: {file_name}"
-    issue_description = f"Starting upload/update for {file_name} in collection {collection}."
-    issue_id = create_issue_on_gitlab(issue_title, issue_description)
-
     try:
         check_response = r.head(f"{url}/resources/{file_name}")
         if check_response.status_code == 200:
             print(f"File {file_name} already exists. Updating file...")
-            # Implement file update logic here
-            update_message = f"File {file_name} exists. Update in progress."
-            update_gitlab_issue(issue_id, update_message)
+            # the REST API replaces the resource, without it the upload endpoint is used as for new files
+            response = upload_to_exist(get_exist_session(), collection, file_name, buffer,
+                                       mode="put" if EXIST_REST_URL else "post")
         else:
             print(f"Uploading {file_name} to {target_path}...")
-            with open(file_path, 'rb') as file:
-                files = {'file': (file_name, file, 'application/xml')}
-                data = {'filename': target_path}
+            files = {'file': (file_name, buffer, 'application/xml')}
+            data = {'filename': target_path}
 
+            with measure("exist_push") as measurement:
+                measurement.bytes = content_size(buffer)
                 response = r.post(url, files=files, data=data,
                                   auth=HTTPBasicAuth(username=EXIST_USER, password=EXIST_PASSWORD))
 
-                if response.status_code in [200, 201]:
-                    success_message = f"{UPLOAD_SUCCESS}: Uploaded file {file_name} successfully."
-                    close_gitlab_issue(issue_id, success_message)
-                    print(success_message)
-                    return UPLOAD_SUCCESS
-                else:
-                    error_message = f"{UPLOAD_FAILED}: Failed to upload file {file_name}. Status: {response.status_code}"
-                    update_gitlab_issue(issue_id, error_message)
-                    print(f"Failed: {file_path}")
-                    print(f"Status code: {response.status_code}")
-                    print(f"Response: {response.text}")
-                    return UPLOAD_FAILED
+        if response.status_code in [200, 201]:
+            success_message = f"{UPLOAD_SUCCESS}: Uploaded file {file_name} successfully."
+            reporter.success(file_name)
+            print(success_message)
+            return UPLOAD_SUCCESS
+        else:
+            error_message = f"{UPLOAD_FAILED}: Failed to upload file {file_name}. Status: {response.status_code}"
+            reporter.failure(file_name, error_message)
+            print(f"Failed: {file_name}")
+            print(f"Status code: {response.status_code}")
+            print(f"Response: {response.text}")
+            return UPLOAD_FAILED
 
     except Exception as e:
         error_message = f"{UPLOAD_FAILED}: Exception occurred while uploading {file_name}: {str(e)}"
-        update_gitlab_issue(issue_id, error_message)
+        reporter.failure(file_name, error_message)
         print(f"Exception during upload: {e}")
         return UPLOAD_FAILED
 
@@ -153,3 +248,331 @@ def update_or_create_file(fetch_server, target_server, collection, id_to_get):
 def push_to_exist(fetch_server,target_server, collection, id_to_get):
     '''pushes {file_path} to exist-db db'''
     update_or_create_file(fetch_server=fetch_server, target_server=EXIST_SERVER, collection=collection, id_to_get=id_to_get)
+
+
+# Bulk transfer to eXist
+# One pooled, authenticated session per user is shared by all uploads,
+# files are fetched, validated in memory and uploaded by a thread pool.
+
+EXIST_REST_URL = os.getenv("exist_rest_url") # eXist REST root for PUT uploads, e.g. https://host/exist/rest/db/
+# pushed hashes are recorded per target, collection and file name, the same for
+# update_or_create_file and sync_collection, so both paths share the skip state
+PUSHED_TARGET = EXIST_REST_URL or EXIST_SERVER
+EXIST_POOL_SIZE = int(os.getenv("EXIST_POOL_SIZE", "10"))
+EXIST_UPLOAD_WORKERS = int(os.getenv("EXIST_UPLOAD_WORKERS", "8"))
+
+_exist_sessions = {}
+_exist_sessions_lock = threading.Lock()
+
+
+def get_exist_session(user=EXIST_USER, password=EXIST_PASSWORD, pool_size=EXIST_POOL_SIZE):
+    '''returns the shared requests.Session for {user}, with basic auth and keep-alive connection pool'''
+    with _exist_sessions_lock:
+        session = _exist_sessions.get(user)
+        if session is None:
+            session = r.Session()
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            if user:
+                session.auth = HTTPBasicAuth(username=user, password=password)
+            _exist_sessions[user] = session
+        return session
+
+
+def content_size(content):
+    '''returns the size of bytes, or the bytes left to read in a seekable binary file object, without moving its position'''
+    if isinstance(content, (bytes, bytearray)):
+        return len(content)
+    position = content.tell()
+    size = content.seek(0, os.SEEK_END) - position
+    content.seek(position)
+    return size
+
+
+def upload_to_exist(session, collection, file_name, content, mode="post"):
+    '''uploads {content} as texts/{file_name} into {collection}
+    mode "post": multipart POST to EXIST_SERVER + collection, like update_or_create_file
+    mode "put": REST PUT to EXIST_REST_URL + collection/texts/file_name, creates or replaces the resource
+    returns the response
+    '''
+    with measure("exist_push") as measurement:
+        measurement.bytes = content_size(content)
+        if mode == "put":
+            if not EXIST_REST_URL:
+                raise Exception("exist_rest_url has to be set for PUT uploads.")
+            url = f"{EXIST_REST_URL.rstrip('/')}/{collection}/texts/{file_name}"
+            return session.put(url, data=content, headers={"Content-Type": "application/xml"})
+
+        files = {'file': (file_name, content, 'application/xml')}
+        data = {'filename': f"texts/{file_name}"}
+        return session.post(EXIST_SERVER + collection, files=files, data=data)
+
+
+def item_name(item):
+    '''returns the file name an item is uploaded as'''
+    kind, value = item
+    return os.path.basename(value) if kind == "file" else f"{value}.xml"
+
+
+def load_item(fetch_session, item, fetch_server, store=None, known_hash=None):
+    '''reads or fetches a single item, returns (name, content, sha256, error)
+    item is ("file", local path) or ("id", id on fetch_server), content is None if it couldn't be loaded.
+    With a store, the validators and the hash of fetched ids are recorded and an id whose source is
+    unchanged since it had known_hash isn't downloaded again: content is None and sha256 is known_hash (see fetch_source).
+    Exceptions (connection or file errors) are returned as error, so one item doesn't stop a batch.'''
+    kind, value = item
+    file_name = item_name(item)
+    try:
+        if kind == "file":
+            with open(value, "rb") as f:
+                content = f.read()
+            return file_name, content, hashlib.sha256(content).hexdigest(), ""
+
+        if store is not None:
+            buffer, status_code, sha256 = fetch_source(fetch_session, fetch_server, value, store, known_hash)
+            if status_code == 304:
+                return file_name, None, sha256, ""
+            content = None
+            if buffer is not None:
+                with buffer:
+                    content = buffer.read()
+        else:
+            response = fetch_session.get(fetch_server + value)
+            content, status_code = (response.content if response.status_code == 200 else None), response.status_code
+    except Exception as e:
+        return file_name, None, None, f"exception: {e}"
+    if content is None:
+        return file_name, None, None, f"status {status_code}"
+    return file_name, content, hashlib.sha256(content).hexdigest(), ""
+
+
+def sync_item(session, fetch_session, collection, item, fetch_server, mode, validate, store=None):
+    '''fetches (or reads), validates and uploads a single item, returns (name, status, message)
+    item is ("file", local path) or ("id", id on fetch_server)'''
+    file_name, content, _, error = load_item(fetch_session, item, fetch_server, store)
+    if content is None:
+        return file_name, FILE_FETCH_FAILED, error
+    return write_item(session, collection, file_name, content, mode, validate)
+
+
+def write_item(session, collection, file_name, content, mode, validate):
+    '''validates and uploads {content} as {file_name}, returns (name, status, message)
+    Exceptions are returned as failure, so one item doesn't stop a batch.'''
+    if validate:
+        try:
+            result = validate_xml_bytes(content, RELAXNG_SCHEMA_PATH, file_name)
+        except Exception as e:
+            return file_name, UPLOAD_VALIDATION_FAILED, f"exception while validating: {e}"
+        if not result["valid"]:
+            errors = "; ".join(f"Line {e['line']}: {e['message']}" for e in result["errors"])
+            return file_name, UPLOAD_VALIDATION_FAILED, errors
+
+    try:
+        response = upload_to_exist(session, collection, file_name, content, mode)
+    except Exception as e:
+        return file_name, UPLOAD_FAILED, f"exception: {e}"
+    if response.status_code in [200, 201]:
+        return file_name, UPLOAD_SUCCESS, ""
+    return file_name, UPLOAD_FAILED, f"status {response.status_code}: {response.text[:200]}"
+
+
+@task
+def bulk_sync_to_exist(collection, ids=None, directory=None, fetch_server=fetch_server, mode="post",
+                       workers=EXIST_UPLOAD_WORKERS, validate=True):
+    '''
+    Uploads many files to eXist at once, instead of one update_or_create_file run per file.
+    Args:
+        collection (str): The target collection.
+        ids (list): IDs to fetch from fetch_server, or
+        directory (str): a local directory whose *.xml files are uploaded.
+        mode (str): "post" (multipart upload endpoint) or "put" (eXist REST API, see upload_to_exist).
+        workers (int): Max. number of parallel uploads.
+        validate (bool): Validate every file against RELAXNG_SCHEMA_PATH before the upload.
+
+    Returns:
+        dict: file name -> status code, failures are collected in one GitLab issue.
+    '''
+    items = [("id", id_to_get) for id_to_get in ids or []]
+    if directory:
+        items += [
+            ("file", os.path.join(directory, name))
+            for name in sorted(os.listdir(directory)) if name.lower().endswith(".xml")
+        ]
+
+    session = get_exist_session()
+    fetch_session = get_exist_session(user=None)  # the source server is read without login
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(
+            lambda item: sync_item(session, fetch_session, collection, item, fetch_server, mode, validate),
+            items,
+        ))
+
+    failures = [(name, status, message) for name, status, message in results if status != UPLOAD_SUCCESS]
+    print(f"Bulk sync to {collection}: {len(results) - len(failures)} uploaded, {len(failures)} failed.")
+    with IssueReporter(f"Bulk sync to {collection}") as reporter:
+        for name, status, message in results:
+            if status == UPLOAD_SUCCESS:
+                reporter.success(name)
+            else:
+                reporter.failure(name, f"{status} {message}")
+    return {name: status for name, status, _ in results}
+
+
+# Incremental sync
+# The target collection is listed once through the REST API and diffed against the source set,
+# only the necessary creates, updates and deletes are sent, in parallel.
+
+EXIST_NS = "{http://exist.sourceforge.net/NS/exist}"
+
+
+def list_exist_collection(session, collection):
+    '''lists the resources in {collection}/texts with one REST request
+    returns dict file name -> {"last_modified", "created"}, empty if the collection doesn't exist yet.
+    The REST API doesn't report sizes or checksums, those come from the hashes recorded at upload time.
+    '''
+    if not EXIST_REST_URL:
+        raise Exception("exist_rest_url has to be set to list a collection.")
+    response = session.get(f"{EXIST_REST_URL.rstrip('/')}/{collection}/texts")
+    if response.status_code == 404:
+        return {}
+    response.raise_for_status()
+
+    root = etree.fromstring(response.content)
+    return {
+        resource.get("name"): {
+            "last_modified": resource.get("last-modified"),
+            "created": resource.get("created"),
+        }
+        for resource in root.iter(f"{EXIST_NS}resource")
+    }
+
+
+def delete_from_exist(session, collection, file_name):
+    '''deletes texts/{file_name} from {collection} via the REST API, returns the response'''
+    with measure("exist_delete"):
+        return session.delete(f"{EXIST_REST_URL.rstrip('/')}/{collection}/texts/{file_name}")
+
+
+def diff_collection(sources, target, pushed_hashes, delete=False, requested=None):
+    '''
+    compares the source set with the listing of the target collection
+    sources: dict file name -> sha256 of the source content
+    target: listing from list_exist_collection
+    pushed_hashes: dict file name -> sha256 last pushed, None if unknown
+    requested: all file names of the source set, also those that couldn't be loaded (default: sources).
+    Only target files outside of it are deleted, a failed fetch never deletes its file.
+    returns (creates, updates, deletes, unchanged) as lists of file names
+    '''
+    creates, updates, unchanged = [], [], []
+    for file_name, sha256 in sorted(sources.items()):
+        if file_name not in target:
+            creates.append(file_name)
+        elif pushed_hashes.get(file_name) == sha256:
+            unchanged.append(file_name)
+        else:
+            updates.append(file_name)
+    keep = set(sources) if requested is None else set(requested) | set(sources)
+    deletes = sorted(set(target) - keep) if delete else []
+    return creates, updates, deletes, unchanged
+
+
+@task
+def sync_collection(collection, ids=None, directory=None, fetch_server=fetch_server, delete=False,
+                    workers=EXIST_UPLOAD_WORKERS, validate=True, state_db=STATE_DB):
+    '''
+    Brings an eXist collection in line with a source set, sending only the writes that are needed.
+    The target is listed once (no HEAD per file), new files are created, changed files are
+    replaced with a REST PUT and, with delete=True, files missing in the source are removed.
+    A file counts as changed if its hash differs from the one recorded at the last upload.
+    A file that can't be fetched, written or deleted is reported as failure without stopping the others,
+    the hashes of the files written are recorded as soon as they are uploaded.
+    Args:
+        collection (str): The target collection.
+        ids (list): IDs to fetch from fetch_server, and/or
+        directory (str): a local directory whose *.xml files are synced.
+        delete (bool): Delete resources of the target that aren't in the source set.
+        workers (int): Max. number of parallel fetches and writes.
+        validate (bool): Validate every created or updated file against RELAXNG_SCHEMA_PATH.
+        state_db (str): Path of the SQLite file with the fetch cache and the pushed hashes.
+
+    Returns:
+        dict: change summary with the lists "created", "updated", "deleted", "failed" and the number "unchanged".
+    '''
+    store = StateStore(state_db)
+    items = [("id", id_to_get) for id_to_get in ids or []]
+    if directory:
+        items += [
+            ("file", os.path.join(directory, name))
+            for name in sorted(os.listdir(directory)) if name.lower().endswith(".xml")
+        ]
+
+    session = get_exist_session()
+    fetch_session = get_exist_session(user=None)
+    target = list_exist_collection(session, collection)
+
+    names = [item_name(item) for item in items]
+    pushed = {name: store.get_pushed_hash(PUSHED_TARGET, collection, name) for name in names}
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        # sources of files that are in the target as last pushed are only downloaded if they changed
+        loaded = list(pool.map(
+            lambda item: load_item(fetch_session, item, fetch_server, store,
+                                   pushed[item_name(item)] if item_name(item) in target else None),
+            items,
+        ))
+
+        failed = [(name, FILE_FETCH_FAILED, error) for name, _, sha256, error in loaded if sha256 is None]
+        contents = {name: content for name, content, _, _ in loaded if content is not None}
+        hashes = {name: sha256 for name, _, sha256, _ in loaded if sha256 is not None}
+        creates, updates, deletes, unchanged = diff_collection(hashes, target, pushed, delete, requested=names)
+        print(f"Sync of {collection}: {len(creates)} to create, {len(updates)} to update, "
+              f"{len(deletes)} to delete, {len(unchanged)} unchanged.")
+
+        def write(name):
+            result = write_item(session, collection, name, contents[name], "put", validate)
+            # recorded right away, so finished writes are skipped next time even if the sync breaks off
+            if result[1] == UPLOAD_SUCCESS:
+                store.save_pushed_hash(PUSHED_TARGET, collection, name, hashes[name])
+            return result
+
+        def remove(name):
+            try:
+                response = delete_from_exist(session, collection, name)
+            except Exception as e:
+                return name, UPLOAD_FAILED, f"delete failed, exception: {e}"
+            if response.status_code not in [200, 204]:
+                return name, UPLOAD_FAILED, f"delete failed, status {response.status_code}"
+            store.delete_pushed_hash(PUSHED_TARGET, collection, name)
+            return name, UPLOAD_SUCCESS, ""
+
+        writes = pool.map(write, creates + updates)
+        removals = pool.map(remove, deletes)
+
+        written = set()
+        for name, status, message in writes:
+            if status == UPLOAD_SUCCESS:
+                written.add(name)
+            else:
+                failed.append((name, status, message))
+        deleted = []
+        for name, status, message in removals:
+            if status == UPLOAD_SUCCESS:
+                deleted.append(name)
+            else:
+                failed.append((name, status, message))
+
+    summary = {
+        "created": [name for name in creates if name in written],
+        "updated": [name for name in updates if name in written],
+        "deleted": deleted,
+        "unchanged": len(unchanged),
+        "failed": failed,
+    }
+    print(f"Sync of {collection} done: {len(summary['created'])} created, {len(summary['updated'])} updated, "
+          f"{len(deleted)} deleted, {len(unchanged)} unchanged, {len(failed)} failed.")
+    with IssueReporter(f"Sync of {collection}") as reporter:
+        for name, status, message in failed:
+            reporter.failure(name, f"{status} {message}")
+    return summary
@@ -1,11 +1,19 @@
 import os
+import glob
+import hashlib
 import gitlab
-from github import Github
+from github import Github, InputGitTreeElement
 from prefect import task
 import base64
+import atexit
+import functools
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 
 from dotenv import load_dotenv
 import os
+from instrumentation import measure
 
 load_dotenv()  # Load environment variables
 GITHUB_REPO = "WunschK/TEEEEST"
@@ -13,12 +21,183 @@ GITHUB_TOKEN = os.getenv("GITHUB_TOKEN")
 GITHUB_API_URL = f"https://api.github.com/repos/{GITHUB_REPO}/issues"
 
 GITLAB_TOKEN = os.getenv("GITLAB_TOKEN")
-GITLAB_URL = "https://gitlab.ulb.tu-darmstadt.de"
+GITLAB_URL = os.getenv("GITLAB_URL", "https://gitlab.ulb.tu-darmstadt.de")
 GITLAB_REPO_ID = "KWunsch/workflow-tests"
 
 GITLAB_ISSUE_REPO_ID = "zeid/prefect-automation-issues"
 ISSUE_GITLAB_TOKEN = os.getenv("ISSUE_GITLAB_TOKEN")
 GITLAB_ISSUE_PROJECT_ID = 692
+REPORT_FLUSH_EVERY = int(os.getenv("REPORT_FLUSH_EVERY", "50")) # failures per summary issue
+PUSH_WORKERS = int(os.getenv("PUSH_WORKERS", "8")) # parallel file reads and blob uploads of a directory push
+
+_gitlab_projects = {}
+_gitlab_projects_lock = threading.Lock()
+
+
+def get_gitlab_project(project_id=GITLAB_ISSUE_PROJECT_ID, token=None):
+    '''returns the cached project object for {project_id}, the client and the project are only fetched once per token'''
+    token = token or ISSUE_GITLAB_TOKEN
+    with _gitlab_projects_lock:
+        project = _gitlab_projects.get((project_id, token))
+        if project is None:
+            gl = gitlab.Gitlab(GITLAB_URL, private_token=token)
+            project = gl.projects.get(project_id)
+            _gitlab_projects[(project_id, token)] = project
+        return project
+
+
+class IssueReporter:
+    '''
+    Collects the events of a run and reports them as one summary issue with a checklist,
+    instead of one issue per file. Failures are buffered and flushed every {flush_every}
+    failures and on close(). Flushes run in a background thread, so they never block the
+    caller, the last one in close() is sent in the calling thread. An error while reporting is only printed.
+    Use it as context manager or close() it at the end of the run.
+    '''
+
+    def __init__(self, title, flush_every=REPORT_FLUSH_EVERY, project_id=GITLAB_ISSUE_PROJECT_ID):
+        self.title = title
+        self.flush_every = flush_every
+        self.project_id = project_id
+        self.failures = []
+        self.successes = 0
+        self.issues = []
+        self._part = 0
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="issue-reporter")
+        self._futures = []
+
+    def success(self, name):
+        '''counts a successful item, it is only mentioned as number in the summary'''
+        with self._lock:
+            self.successes += 1
+
+    def failure(self, name, message):
+        '''buffers a failed item, a summary issue is sent once flush_every failures are buffered'''
+        with self._lock:
+            self.failures.append((name, message))
+            full = len(self.failures) >= self.flush_every
+        if full:
+            self.flush()
+
+    def flush(self, wait=False):
+        '''sends the buffered failures as one issue in the background, returns the future or None
+        With wait the issue is sent in the calling thread and its ID is returned.'''
+        with self._lock:
+            if not self.failures:
+                return None
+            failures, self.failures = self.failures, []
+            successes, self.successes = self.successes, 0
+            self._part += 1
+            part = self._part
+        title = f"{self.title}: {len(failures)} failed" + (f" (part {part})" if part > 1 else "")
+        checklist = "\n".join(f"- [ ] {name}: {message}" for name, message in failures)
+        description = f"{len(failures)} failed, {successes} succeeded.\n\n{checklist}"
+        if wait:
+            return self._send(title, description)
+        future = self._executor.submit(self._send, title, description)
+        self._futures.append(future)
+        return future
+
+    def _send(self, title, description):
+        try:
+            with measure("gitlab_issue"):
+                issue = get_gitlab_project(self.project_id).issues.create(
+                    {'title': title[:255], 'description': description}
+                )
+            self.issues.append(issue.iid)
+            print(f"Summary issue {issue.iid} created: {title}")
+            return issue.iid
+        except Exception as e:
+            print(f"Failed to create summary issue '{title}': {e}")
+            return None
+
+    def close(self):
+        '''waits until all issues are sent and sends the remaining failures, returns the issue IDs
+        The last flush doesn't use the executor, so close() also works at interpreter exit,
+        when concurrent.futures doesn't accept new work any more.'''
+        for future in self._futures:
+            future.result()
+        self.flush(wait=True)
+        self._executor.shutdown(wait=True)
+        return self.issues
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+_github_repo = None
+_github_repo_lock = threading.Lock()
+
+
+def get_github_repo():
+    '''returns the cached GitHub repository object of GITHUB_REPO'''
+    global _github_repo
+    with _github_repo_lock:
+        if _github_repo is None:
+            _github_repo = Github(GITHUB_TOKEN).get_repo(GITHUB_REPO)
+        return _github_repo
+
+
+_run_reporter = None
+_process_reporter = None
+_run_reporter_lock = threading.Lock()
+
+
+def get_run_reporter():
+    '''returns the reporter shared by all tasks of this run (see run_reporter)
+    Outside of run_reporter a reporter for the process is used, the tasks that report failures
+    send its buffered failures when they end (see flush_process_reporter).'''
+    global _process_reporter
+    with _run_reporter_lock:
+        if _run_reporter is not None:
+            return _run_reporter
+        if _process_reporter is None:
+            _process_reporter = IssueReporter("Workflow run")
+            atexit.register(_process_reporter.close)
+        return _process_reporter
+
+
+def flush_process_reporter():
+    '''sends the failures buffered by the process reporter, does nothing inside run_reporter,
+    where the failures are sent at the end of the run'''
+    with _run_reporter_lock:
+        reporter = _process_reporter if _run_reporter is None else None
+    if reporter is not None:
+        reporter.flush(wait=True)
+
+
+def flushes_process_reporter(fn):
+    '''decorator for tasks that report failures, the failures they buffered outside of run_reporter
+    are sent when the task ends instead of when the process exits'''
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            flush_process_reporter()
+    return wrapper
+
+
+@contextmanager
+def run_reporter(title="Workflow run"):
+    '''creates the reporter of one flow run, get_run_reporter returns it inside the block
+    At the end of the block its remaining failures are sent and the previous reporter is restored,
+    so several runs in one worker process get their own summary issues.'''
+    global _run_reporter
+    reporter = IssueReporter(title)
+    with _run_reporter_lock:
+        previous, _run_reporter = _run_reporter, reporter
+    try:
+        yield reporter
+    finally:
+        with _run_reporter_lock:
+            _run_reporter = previous
+        reporter.close()
+
 
 # Define tasks to be executed in "distribute_stuff"
 
@@ -29,8 +208,7 @@ def create_issue_on_gitlab(title, description):
     max_title_length = 255
     if len(title) > max_title_length:
         title = title[:max_title_length]
-    gl = gitlab.Gitlab(GITLAB_URL, private_token=ISSUE_GITLAB_TOKEN)
-    project = gl.projects.get(GITLAB_ISSUE_PROJECT_ID)
+    project = get_gitlab_project()
     issue = project.issues.create({'title': title, 'description': description})
 
     print(f"Issue {issue.iid} created successfully!")
@@ -42,8 +220,7 @@ def create_issue_on_gitlab(title, description):
 @task
 def update_gitlab_issue(issue_id, message):
     '''Updates an issue in GitLab with a new comment'''
-    gl = gitlab.Gitlab(GITLAB_URL, private_token=ISSUE_GITLAB_TOKEN)
-    project = gl.projects.get(GITLAB_ISSUE_PROJECT_ID)
+    project = get_gitlab_project()
     issue = project.issues.get(issue_id)
 
     # Append a new message to the issue description
@@ -54,8 +231,7 @@ def update_gitlab_issue(issue_id, message):
 @task
 def close_gitlab_issue(issue_id, success_message):
     '''Updates the issue description and closes the given GitLab issue'''
-    gl = gitlab.Gitlab(GITLAB_URL, private_token=ISSUE_GITLAB_TOKEN)
-    project = gl.projects.get(GITLAB_ISSUE_PROJECT_ID)
+    project = get_gitlab_project()
     issue = project.issues.get(issue_id)
 
     # Append success message and close the issue
@@ -68,22 +244,16 @@ def close_gitlab_issue(issue_id, success_message):
 
 
 @task
-def copy_to_gitlab(file_path, subdir):
-    '''Copies {file_path} to GitLab repository and manages an issue in project 692'''
+@flushes_process_reporter
+def copy_to_gitlab(file_path, subdir, reporter=None):
+    '''Copies {file_path} to GitLab repository, failures go to the summary issue of {reporter} (default: the run reporter)'''
+    reporter = reporter or get_run_reporter()
 
     # Use GITLAB_TOKEN for file upload project in the project repo (workflow-tests)
-    gl_file_project = gitlab.Gitlab(GITLAB_URL, private_token=GITLAB_TOKEN)
-    project = gl_file_project.projects.get(GITLAB_REPO_ID)
+    project = get_gitlab_project(GITLAB_REPO_ID, GITLAB_TOKEN)
 
     file_path_in_repo = f"{subdir}/{file_path}"
 
-    # Create issue in project for issue management repo (prefect-automation-issues)
-    issue_id = create_issue_on_gitlab.fn(
-        title=f"Upload {file_path_in_repo} to Gitlab",
-        description=f"Started upload of {file_path_in_repo} to GitLab-Repo {project.name}"
-    )
-    print(f"Issue created: {issue_id}")
-
     try:
         with open(file_path, 'r') as file:
             content = file.read()
@@ -107,33 +277,24 @@ def copy_to_gitlab(file_path, subdir):
             success_message = f"Created new file {file_path_in_repo} on GitLab"
             print(success_message)
 
-        # Update and close the GitLab issue with the success message
-        update_gitlab_issue.fn(issue_id, success_message)
-        close_gitlab_issue.fn(issue_id, success_message)
+        reporter.success(file_path_in_repo)
 
     except Exception as e:
         error_message = f"Failed to create/update file {file_path_in_repo}: {str(e)}"
         print(error_message)
-
-        # Use update_gitlab_issue to append the error message
-        update_gitlab_issue.fn(issue_id, error_message)
+        reporter.failure(file_path_in_repo, f"GitLab upload failed: {e}")
 
 
 @task
-def copy_to_github(file_path, subdir):
-    '''Copies {file_path} to GitHub repository and logs to GitLab issue tracker'''
-    g = Github(GITHUB_TOKEN)
-    repo = g.get_repo(GITHUB_REPO)
+@flushes_process_reporter
+def copy_to_github(file_path, subdir, reporter=None):
+    '''Copies {file_path} to GitHub repository, failures go to the summary issue of {reporter} (default: the run reporter)'''
+    reporter = reporter or get_run_reporter()
+    repo = get_github_repo()
 
     file_name = os.path.basename(file_path)
     github_path = f"{subdir}/{file_name}"
 
-    # Create an issue in the GitLab tracking repo
-    issue_id = create_issue_on_gitlab(
-        title=f"Upload {github_path} to GitHub",
-        description=f"Started upload of `{github_path}` to GitHub"
-    )
-
     with open(file_path, 'r') as file:
         content = file.read()
 
@@ -155,8 +316,146 @@ def copy_to_github(file_path, subdir):
             # Handle errors and log them in GitLab
             error_message = f"Failed to create/update file {github_path}: {e}"
             print(error_message)
-            update_gitlab_issue(issue_id, error_message)
+            reporter.failure(github_path, f"GitHub upload failed: {e}")
             return
 
-    # If everything succeeds, update and close the GitLab issue
-    close_gitlab_issue(issue_id, success_message)
+    reporter.success(github_path)
+
+
+# Directory pushes
+# A whole directory is published as one commit, files whose git blob SHA didn't change are skipped,
+# so the number of API calls depends on the number of changed files.
+
+def git_blob_sha(content):
+    '''returns the SHA-1 git uses for a blob with {content} (bytes)'''
+    return hashlib.sha1(b"blob %d\0" % len(content) + content).hexdigest()
+
+
+def read_directory(directory, subdir, pattern="**/*.xml", workers=PUSH_WORKERS):
+    '''reads all files matching {pattern} in {directory} in parallel
+    returns dict path in the repo ({subdir}/relative path) -> (content, blob sha)'''
+    paths = sorted(p for p in glob.glob(os.path.join(directory, pattern), recursive=True) if os.path.isfile(p))
+
+    def read(path):
+        with open(path, "rb") as f:
+            content = f.read()
+        repo_path = "/".join(filter(None, [subdir.strip("/"), os.path.relpath(path, directory).replace(os.sep, "/")]))
+        return repo_path, (content, git_blob_sha(content))
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return dict(pool.map(read, paths))
+
+
+@task
+@flushes_process_reporter
+def push_directory_to_gitlab(directory, subdir, pattern="**/*.xml", branch="main",
+                             commit_message=None, workers=PUSH_WORKERS, reporter=None):
+    '''
+    Pushes all files matching {pattern} in {directory} to {subdir} of the GitLab repository in one commit.
+    The tree of {subdir} is listed once, only new and changed files (by blob SHA) become commit actions.
+
+    Returns:
+        dict: "created" and "updated" (paths in the repo), "unchanged" (number) and "commit" (ID or None).
+    '''
+    reporter = reporter or get_run_reporter()
+    project = get_gitlab_project(GITLAB_REPO_ID, GITLAB_TOKEN)
+    files = read_directory(directory, subdir, pattern, workers)
+
+    try:
+        tree = project.repository_tree(path=subdir, ref=branch, recursive=True, get_all=True)
+        remote = {entry["path"]: entry["id"] for entry in tree if entry["type"] == "blob"}
+    except gitlab.exceptions.GitlabGetError:
+        remote = {}  # subdir doesn't exist yet
+
+    created = [path for path in files if path not in remote]
+    updated = [path for path in files if path in remote and remote[path] != files[path][1]]
+    summary = {"created": created, "updated": updated,
+               "unchanged": len(files) - len(created) - len(updated), "commit": None}
+    if not created and not updated:
+        print(f"Nothing to push from {directory}, {len(files)} files unchanged.")
+        return summary
+
+    actions = [
+        {
+            "action": "update" if path in remote else "create",
+            "file_path": path,
+            "content": base64.b64encode(files[path][0]).decode("ascii"),
+            "encoding": "base64",
+        }
+        for path in created + updated
+    ]
+    try:
+        with measure("git_push") as measurement:
+            measurement.bytes = sum(len(files[path][0]) for path in created + updated)
+            commit = project.commits.create({
+                "branch": branch,
+                "commit_message": commit_message or f"Update {subdir}: {len(created)} added, {len(updated)} changed",
+                "actions": actions,
+            })
+        summary["commit"] = commit.id
+        for path in created + updated:
+            reporter.success(path)
+        print(f"Pushed {len(actions)} files to GitLab in commit {commit.id}, {summary['unchanged']} unchanged.")
+    except Exception as e:
+        print(f"Failed to push {directory} to GitLab: {e}")
+        for path in created + updated:
+            reporter.failure(path, f"GitLab commit failed: {e}")
+    return summary
+
+
+@task
+@flushes_process_reporter
+def push_directory_to_github(directory, subdir, pattern="**/*.xml", branch="main",
+                             commit_message=None, workers=PUSH_WORKERS, reporter=None):
+    '''
+    Pushes all files matching {pattern} in {directory} to {subdir} of the GitHub repository in one commit.
+    The tree of the branch is read once, blobs of new and changed files are uploaded in parallel
+    and committed as one new tree on top of the branch.
+
+    Returns:
+        dict: "created" and "updated" (paths in the repo), "unchanged" (number) and "commit" (SHA or None).
+    '''
+    reporter = reporter or get_run_reporter()
+    repo = get_github_repo()
+    files = read_directory(directory, subdir, pattern, workers)
+
+    ref = repo.get_git_ref(f"heads/{branch}")
+    base_commit = repo.get_git_commit(ref.object.sha)
+    remote = {
+        element.path: element.sha
+        for element in repo.get_git_tree(base_commit.tree.sha, recursive=True).tree
+        if element.type == "blob"
+    }
+
+    created = [path for path in files if path not in remote]
+    updated = [path for path in files if path in remote and remote[path] != files[path][1]]
+    summary = {"created": created, "updated": updated,
+               "unchanged": len(files) - len(created) - len(updated), "commit": None}
+    if not created and not updated:
+        print(f"Nothing to push from {directory}, {len(files)} files unchanged.")
+        return summary
+
+    def upload_blob(path):
+        blob = repo.create_git_blob(base64.b64encode(files[path][0]).decode("ascii"), "base64")
+        return InputGitTreeElement(path, "100644", "blob", sha=blob.sha)
+
+    try:
+        with measure("git_push") as measurement:
+            measurement.bytes = sum(len(files[path][0]) for path in created + updated)
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                elements = list(pool.map(upload_blob, created + updated))
+            tree = repo.create_git_tree(elements, base_tree=base_commit.tree)
+            commit = repo.create_git_commit(
+                commit_message or f"Update {subdir}: {len(created)} added, {len(updated)} changed",
+                tree, [base_commit],
+            )
+            ref.edit(commit.sha)
+        summary["commit"] = commit.sha
+        for path in created + updated:
+            reporter.success(path)
+        print(f"Pushed {len(elements)} files to GitHub in commit {commit.sha}, {summary['unchanged']} unchanged.")
+    except Exception as e:
+        print(f"Failed to push {directory} to GitHub: {e}")
+        for path in created + updated:
+            reporter.failure(path, f"GitHub commit failed: {e}")
+    return summary
@@ -3,10 +3,28 @@
 # - validating xml-files
 # - post-processing function
 
+import os
+import glob
+import time
+import hashlib
+import threading
+from concurrent.futures import ProcessPoolExecutor
 from lxml import etree
 from prefect import task
 from error_codes import VALIDATION_SUCCESS,VALIDATION_FAILED, VALIDATION_EXCEPTION
-from git_tasks import create_issue_on_gitlab
+from git_tasks import flushes_process_reporter, get_run_reporter
+from state_store import StateStore, STATE_DB
+from instrumentation import measure, get_recorder
+
+# compiled RelaxNG schemas of this process, keyed by (path, mtime)
+# compiled schemas can't be pickled, so every worker process keeps its own cache
+_schema_cache = {}
+_schema_cache_lock = threading.Lock()
+# validate() is not thread-safe on a shared schema, error_log belongs to the last call
+_validation_lock = threading.Lock()
+# compiled XSLT stylesheets of this process, keyed by (path, mtime), like the schemas
+_xslt_cache = {}
+_xslt_cache_lock = threading.Lock()
 
 @task
 def does_not_exist(file_path):
@@ -16,31 +34,114 @@ def does_not_exist(file_path):
 
 
 
+def get_relaxng(rng):
+    '''Returns the compiled RelaxNG schema for {rng}, it is only compiled again if the file changed.'''
+    path = os.path.abspath(rng)
+    key = (path, os.stat(path).st_mtime_ns)
+    with _schema_cache_lock:
+        relaxng = _schema_cache.get(key)
+        if relaxng is None:
+            relaxng = etree.RelaxNG(etree.parse(path))
+            # drop older versions of the same schema
+            for old_key in [k for k in _schema_cache if k[0] == path]:
+                del _schema_cache[old_key]
+            _schema_cache[key] = relaxng
+        return relaxng
+
+
+def validate_file(file_path, rng):
+    '''Validates one XML file against {rng} and returns a dict with the file, "valid" and a list of "errors" (line, message).'''
+    try:
+        relaxng = get_relaxng(rng)
+        xml_doc = etree.parse(file_path)
+        with _validation_lock:
+            valid = relaxng.validate(xml_doc)
+            errors = [{"line": error.line, "message": error.message} for error in relaxng.error_log]
+        return {"file": file_path, "valid": valid, "errors": [] if valid else errors}
+    except Exception as e:
+        return {"file": file_path, "valid": False, "errors": [{"line": None, "message": str(e)}]}
+
+
+def validate_xml_bytes(content, rng, name=None):
+    '''Validates XML held in memory against {rng}, same result dict as validate_file.
+    content can be bytes or a binary file object (e.g. a SpooledTemporaryFile), which is read from its current position.'''
+    try:
+        with measure("validation"):
+            relaxng = get_relaxng(rng)
+            if hasattr(content, "read"):
+                xml_doc = etree.parse(content)
+            else:
+                xml_doc = etree.ElementTree(etree.fromstring(content))
+            with _validation_lock:
+                valid = relaxng.validate(xml_doc)
+                errors = [{"line": error.line, "message": error.message} for error in relaxng.error_log]
+        return {"file": name, "valid": valid, "errors": [] if valid else errors}
+    except Exception as e:
+        return {"file": name, "valid": False, "errors": [{"line": None, "message": str(e)}]}
+
+
+def timed_validate_file(file_path, rng):
+    '''Runs validate_file and returns (result, seconds), the time is recorded by the parent process.'''
+    start = time.perf_counter()
+    result = validate_file(file_path, rng)
+    return result, time.perf_counter() - start
+
+
+def validate_files(file_paths, rng, workers=None):
+    '''Validates many XML files against {rng} in a process pool (workers defaults to the number of CPU cores).
+    Returns one result dict per file, in the order of file_paths. Every file is recorded as one validation.'''
+    file_paths = list(file_paths)
+    if workers == 1 or len(file_paths) < 2:
+        outcomes = [timed_validate_file(file_path, rng) for file_path in file_paths]
+    else:
+        workers = workers or os.cpu_count() or 1
+        chunksize = max(1, len(file_paths) // (workers * 4))
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            outcomes = list(pool.map(timed_validate_file, file_paths, [rng] * len(file_paths), chunksize=chunksize))
+
+    recorder = get_recorder()
+    for file_path, (result, seconds) in zip(file_paths, outcomes):
+        size = os.path.getsize(file_path) if os.path.exists(file_path) else 0
+        recorder.record("validation", seconds, bytes=size, error=not result["valid"])
+    return [result for result, _ in outcomes]
+
+
 @task
+def validate_directory(directory, rng, pattern="**/*.xml", workers=None):
+    '''Validates all files matching {pattern} in {directory} against {rng}.
+    Returns the per-file results and prints a short summary.'''
+    file_paths = sorted(glob.glob(os.path.join(directory, pattern), recursive=True))
+    results = validate_files(file_paths, rng, workers)
+    invalid = [result for result in results if not result["valid"]]
+    print(f"Validated {len(results)} files in {directory}: {len(results) - len(invalid)} valid, {len(invalid)} invalid.")
+    return results
+
+
+@task
+@flushes_process_reporter
 def validate_xml_with_rng(file_path, rng, file_id):
     '''Validates an XML file against a RelaxNG schema.'''
     try:
-        # Parse the XML file
-        xml_doc = etree.parse(file_path)
+        with measure("validation"):
+            # Parse the XML file
+            xml_doc = etree.parse(file_path)
 
-        # Parse the RelaxNG schema
-        with open(rng, 'r') as rng_file:
-            relaxng_doc = etree.parse(rng_file)
-            relaxng = etree.RelaxNG(relaxng_doc)
+            # Get the compiled RelaxNG schema
+            relaxng = get_relaxng(rng)
 
-        # Validate the XML file
-        # Invalid File - aborts the flow and creates an issue on GitLab
-        if not relaxng.validate(xml_doc):
-            error_log = relaxng.error_log
+            # Validate the XML file
+            # Invalid File - aborts the flow and is reported in the summary issue of the run
+            with _validation_lock:
+                valid = relaxng.validate(xml_doc)
+                error_log = relaxng.error_log.copy()
+        if not valid:
             error_messages = "\n".join([f"Line {error.line}: {error.message}" for error in error_log])
             short_error = error_log[0].message if error_log else "Unknown error"
             todo_list = "\n".join([f"- [ ] Line {error.line}: {error.message}" for error in error_log])
             print(f"XML file {file_path} is not valid. Errors:\n{error_messages}")
 
-            # Create GitLab issue
-            issue_title = f"{VALIDATION_FAILED}: Validation failed - {file_id}"
-            issue_description = f"Validation errors:\n{todo_list}"
-            create_issue_on_gitlab(issue_title, issue_description)
+            # collected in the summary issue of the run
+            get_run_reporter().failure(file_id, f"{VALIDATION_FAILED}: {short_error} ({len(error_log)} errors)")
 
             return False, f"{VALIDATION_FAILED}\n{todo_list}"
 
@@ -53,14 +154,117 @@ def validate_xml_with_rng(file_path, rng, file_id):
         print(f"An error occurred during validation: {e}")
         return False, VALIDATION_EXCEPTION
 
+def get_xslt(xsl):
+    '''Returns the compiled XSLT stylesheet {xsl}, it is only compiled again if the file changed.'''
+    path = os.path.abspath(xsl)
+    key = (path, os.stat(path).st_mtime_ns)
+    with _xslt_cache_lock:
+        xslt = _xslt_cache.get(key)
+        if xslt is None:
+            xslt = etree.XSLT(etree.parse(path))
+            for old_key in [k for k in _xslt_cache if k[0] == path]:
+                del _xslt_cache[old_key]
+            _xslt_cache[key] = xslt
+        return xslt
+
+
+def read_post_proc_steps(config):
+    '''Returns the stylesheet paths listed in {config} (post_proc.xml, see below) in document order.
+    Relative paths are resolved against the directory of the config file.'''
+    base = os.path.dirname(os.path.abspath(config))
+    root = etree.parse(config).getroot()
+    return [
+        os.path.join(base, step.text.strip())
+        for step in root if isinstance(step.tag, str) and step.text and step.text.strip()
+    ]
+
+
+def chain_digest(steps):
+    '''Returns a hash over the contents of all stylesheets of a chain, it changes as soon as one of them changes.'''
+    sha256 = hashlib.sha256()
+    for step in steps:
+        with open(step, "rb") as f:
+            sha256.update(hashlib.sha256(f.read()).digest())
+    return sha256.hexdigest()
+
+
+def transform_file(file_path, steps, output_path):
+    '''Runs {file_path} through the stylesheets in {steps} and writes the result to {output_path}.
+    The intermediate results stay in memory. Returns (file_path, error message or None).'''
+    try:
+        doc = etree.parse(file_path)
+        for step in steps:
+            doc = get_xslt(step)(doc)
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        with open(output_path, "wb") as f:
+            f.write(bytes(doc))  # serialised according to xsl:output of the last step
+        return file_path, None
+    except Exception as e:
+        return file_path, str(e)
+
+
 @task
-def post_proc():
+@flushes_process_reporter
+def post_proc(export_dir, config="post_proc.xml", output_dir=None, pattern="**/*.xml", workers=None, state_db=STATE_DB):
     '''handles processing of files with xslt-scripts
-    sends them to saxon.jar and takes the result.
-    Takes all the files that are specified in the post_proc.xml.
-    Should probably take the file from zeid-nas/Projekt-Name/{export-name}/export and put it into  zeid-nas/Projekt-Name/{export-name}/post_proc
+    Takes all the files in {export_dir} matching {pattern} and runs them through the stylesheets
+    specified in the post_proc.xml, in the order of the steps.
+    The stylesheets are compiled once per worker process (lxml/libxslt, so XSLT 1.0) and the files are
+    processed in a process pool. Results go to {output_dir}, by default the post_proc folder next to the export,
+    e.g. zeid-nas/Projekt-Name/{export-name}/export -> zeid-nas/Projekt-Name/{export-name}/post_proc.
+    A file that already went through the same chain with the same content is skipped (state_db=None disables that).
+    Returns dict file path -> output path of the processed and skipped files, failures go to the run reporter.
     '''
-    pass
+    steps = read_post_proc_steps(config)
+    if not steps:
+        print(f"No steps in {config}, nothing to do.")
+        return {}
+    for step in steps:
+        get_xslt(step)  # fail early on a broken stylesheet
+    output_dir = output_dir or os.path.join(os.path.dirname(os.path.abspath(export_dir)), "post_proc")
+    chain = chain_digest(steps)
+    store = StateStore(state_db) if state_db else None
+
+    results, todo = {}, []
+    for file_path in sorted(glob.glob(os.path.join(export_dir, pattern), recursive=True)):
+        output_path = os.path.join(output_dir, os.path.relpath(file_path, export_dir))
+        with open(file_path, "rb") as f:
+            content_hash = hashlib.sha256(f.read()).hexdigest()
+        if store is not None and os.path.exists(output_path) and \
+                store.get_post_processed(file_path) == (chain, content_hash):
+            results[file_path] = output_path
+        else:
+            todo.append((file_path, output_path, content_hash))
+    skipped = len(results)
+
+    with measure("post_proc") as measurement:
+        measurement.count = len(todo)
+        if workers == 1 or len(todo) < 2:
+            outcomes = [transform_file(file_path, steps, output_path) for file_path, output_path, _ in todo]
+        else:
+            workers = workers or os.cpu_count() or 1
+            chunksize = max(1, len(todo) // (workers * 4))
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                outcomes = list(pool.map(
+                    transform_file,
+                    [file_path for file_path, _, _ in todo],
+                    [steps] * len(todo),
+                    [output_path for _, output_path, _ in todo],
+                    chunksize=chunksize,
+                ))
+
+    reporter = get_run_reporter()
+    for (file_path, output_path, content_hash), (_, error) in zip(todo, outcomes):
+        if error:
+            reporter.failure(file_path, f"Post-processing failed: {error}")
+            continue
+        results[file_path] = output_path
+        if store is not None:
+            store.save_post_processed(file_path, chain, content_hash)
+
+    print(f"Post-processed {len(results) - skipped} files into {output_dir}, "
+          f"{skipped} unchanged, {len(todo) - len(results) + skipped} failed.")
+    return results
 
 
 # <post_proc>
@@ -0,0 +1,189 @@
+import os
+import json
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from prefect.artifacts import create_markdown_artifact
+from transkribus_client import get_metrics, reset_metrics
+
+# Timing and throughput instrumentation of a workflow run.
+# Every stage (upload, job wait, download, validation, eXist push, ...) records its wall time,
+# bytes, retries and, for Transkribus jobs, the time the job spent in the server queue.
+# At the end of a run the numbers are published as Prefect artifacts and written
+# to METRICS_DIR as JSON and in the Prometheus text format.
+
+METRICS_DIR = os.getenv("METRICS_DIR", "metrics")
+
+logger = logging.getLogger(__name__)
+
+_FIELDS = ("count", "errors", "seconds", "max_seconds", "bytes", "retries",
+           "queued", "queue_seconds", "max_queue_seconds")
+
+
+class Measurement:
+    """Values of one measured operation, set by the caller inside measure()."""
+
+    def __init__(self):
+        self.bytes = 0
+        self.retries = 0
+        self.count = 1
+        self.queue_seconds = None
+
+
+class Recorder:
+    """Sums up the measurements per stage, can be used from several threads."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stages = {}
+        self.started_at = time.time()
+
+    def record(self, stage, seconds, bytes=0, retries=0, count=1, queue_seconds=None, error=False):
+        with self._lock:
+            entry = self._stages.setdefault(stage, dict.fromkeys(_FIELDS, 0))
+            entry["count"] += count
+            entry["errors"] += 1 if error else 0
+            entry["seconds"] += seconds
+            entry["max_seconds"] = max(entry["max_seconds"], seconds)
+            entry["bytes"] += bytes
+            entry["retries"] += retries
+            if queue_seconds is not None:
+                entry["queued"] += 1
+                entry["queue_seconds"] += queue_seconds
+                entry["max_queue_seconds"] = max(entry["max_queue_seconds"], queue_seconds)
+
+    def snapshot(self):
+        """Returns the stage totals and the request counters of the Transkribus client."""
+        with self._lock:
+            stages = {name: dict(entry) for name, entry in self._stages.items()}
+        return {
+            "started_at": self.started_at,
+            "duration": time.time() - self.started_at,
+            "stages": stages,
+            "api": get_metrics(),
+        }
+
+    def reset(self):
+        with self._lock:
+            self._stages = {}
+            self.started_at = time.time()
+        reset_metrics()
+
+
+_recorder = Recorder()
+
+
+def get_recorder():
+    return _recorder
+
+
+@contextmanager
+def measure(stage):
+    """
+    Measures the wall time of the block as one operation of {stage}.
+    The block can set bytes, retries, count and queue_seconds on the yielded Measurement,
+    an exception is counted as error and raised again.
+    """
+    measurement = Measurement()
+    start = time.perf_counter()
+    error = False
+    try:
+        yield measurement
+    except BaseException:
+        error = True
+        raise
+    finally:
+        _recorder.record(
+            stage, time.perf_counter() - start, bytes=measurement.bytes, retries=measurement.retries,
+            count=measurement.count, queue_seconds=measurement.queue_seconds, error=error,
+        )
+
+
+def to_prometheus(snapshot):
+    """Renders a snapshot in the Prometheus text exposition format."""
+    lines = []
+
+    def metric(name, kind, help_text, samples):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for label, value in samples:
+            lines.append(f"{name}{{{label}}} {value}" if label else f"{name} {value}")
+
+    stages = snapshot["stages"]
+    for field, kind, help_text in (
+        ("count", "counter", "Operations per stage."),
+        ("errors", "counter", "Failed operations per stage."),
+        ("seconds", "counter", "Wall time per stage in seconds."),
+        ("max_seconds", "gauge", "Longest single operation per stage in seconds."),
+        ("bytes", "counter", "Bytes transferred per stage."),
+        ("retries", "counter", "Retries per stage."),
+        ("queue_seconds", "counter", "Time Transkribus jobs spent in the server queue in seconds."),
+    ):
+        suffix = "_total" if kind == "counter" else ""
+        metric(f"workflow_stage_{field}{suffix}", kind, help_text,
+               [(f'stage="{name}"', entry[field]) for name, entry in sorted(stages.items())])
+
+    endpoints = snapshot["api"]["endpoints"]
+    for field, help_text in (
+        ("requests", "Requests per Transkribus endpoint."),
+        ("retries", "Retried requests per Transkribus endpoint."),
+        ("errors", "Failed requests per Transkribus endpoint."),
+        ("throttle_seconds", "Time spent waiting for the rate limiter in seconds."),
+        ("seconds", "Wall time of the requests in seconds."),
+        ("bytes", "Bytes received per Transkribus endpoint."),
+    ):
+        metric(f"transkribus_api_{field}_total", "counter", help_text,
+               [(f'endpoint="{name}"', entry[field]) for name, entry in sorted(endpoints.items())])
+
+    metric("workflow_run_seconds", "gauge", "Duration of the run so far.", [("", snapshot["duration"])])
+    return "\n".join(lines) + "\n"
+
+
+def to_markdown(snapshot):
+    """Renders the stage totals as markdown table, slowest stage first."""
+    rows = ["| Stage | Ops | Errors | Seconds | Max s | MB | Retries | Avg queue s |",
+            "|---|---|---|---|---|---|---|---|"]
+    for name, entry in sorted(snapshot["stages"].items(), key=lambda item: -item[1]["seconds"]):
+        queue = entry["queue_seconds"] / entry["queued"] if entry["queued"] else 0
+        rows.append(
+            f"| {name} | {entry['count']} | {entry['errors']} | {entry['seconds']:.1f} | {entry['max_seconds']:.1f} "
+            f"| {entry['bytes'] / (1024 * 1024):.1f} | {entry['retries']} | {queue:.1f} |"
+        )
+    total = snapshot["api"]["total"]
+    rows.append("")
+    rows.append(f"Transkribus API: {total['requests']} requests, {total['retries']} retries, "
+                f"{total['errors']} errors, {total['throttle_seconds']:.1f} s throttled.")
+    return "\n".join(rows)
+
+
+def write_metrics(directory=METRICS_DIR, snapshot=None):
+    """Writes the snapshot to {directory}/metrics.json and metrics.prom, returns both paths."""
+    snapshot = snapshot or _recorder.snapshot()
+    os.makedirs(directory, exist_ok=True)
+    json_path = os.path.join(directory, "metrics.json")
+    prom_path = os.path.join(directory, "metrics.prom")
+    with open(json_path, "w", encoding="utf-8") as f:
+        json.dump(snapshot, f, indent=2)
+    with open(prom_path, "w", encoding="utf-8") as f:
+        f.write(to_prometheus(snapshot))
+    return json_path, prom_path
+
+
+def publish_artifacts(snapshot=None, key="workflow-metrics"):
+    """Publishes the stage totals as Prefect markdown artifact, only works inside a flow or task run."""
+    snapshot = snapshot or _recorder.snapshot()
+    try:
+        create_markdown_artifact(markdown=to_markdown(snapshot), key=key,
+                                 description="Wall time, bytes, retries and queue time per stage")
+    except Exception as e:
+        logger.warning(f"[!] Metrics artifact not created: {e}")
+
+
+def report_metrics(directory=METRICS_DIR):
+    """Publishes the metrics of the run as artifact and writes the JSON/Prometheus dump, returns the snapshot."""
+    snapshot = _recorder.snapshot()
+    publish_artifacts(snapshot)
+    json_path, prom_path = write_metrics(directory, snapshot)
+    logger.info(f"[+] Metrics written to {json_path} and {prom_path}")
+    return snapshot
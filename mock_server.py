@@ -0,0 +1,501 @@
+import io
+import re
+import json
+import time
+import random
+import hashlib
+import zipfile
+import argparse
+import threading
+import xml.etree.ElementTree as ET
+from email.utils import formatdate
+from urllib.parse import urlparse, parse_qs, unquote
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Local stand-in for Transkribus, eXist and the GitLab issue API, used by benchmark.py.
+# Everything is kept in memory. Latency, job durations, queue times and error rates
+# are configurable, so the workflow can be measured without touching the real servers.
+#
+# Routes (base URL http://host:port):
+#   /TrpServer/rest/...        Transkribus: auth/login, collections/list, collections/{id}/list, fulldoc,
+#                              uploads, LA/analyze, recognition/ocr, jobs/list, jobs/{id}, export
+#   /downloads/{name}.zip      export downloads, with Range support
+#   /exist/source/{id}         eXist source documents (ETag/Last-Modified, 304)
+#   /exist/upload/{col}        eXist upload endpoint (POST) and /exist/upload/{col}/resources/{name} (HEAD)
+#   /exist/rest/{col}/texts    eXist REST API: listing (GET collection), GET/PUT/DELETE resources
+#   /api/v4/projects/{id}      GitLab project and issue API
+
+PAGE_NS = "http://schema.primaresearch.org/PAGE/gts/pagecontent/2013-07-15"
+EXIST_NS = "http://exist.sourceforge.net/NS/exist"
+
+
+def page_xml(doc_id, page_nr, lines=10):
+    """Returns a small PAGE XML file with one text region."""
+    text_lines = "".join(
+        f'<TextLine id="l{i}"><Coords points="0,0"/><TextEquiv><Unicode>Document {doc_id} page {page_nr} line {i}'
+        f'</Unicode></TextEquiv></TextLine>'
+        for i in range(1, lines + 1)
+    )
+    return (
+        f'<?xml version="1.0" encoding="UTF-8"?><PcGts xmlns="{PAGE_NS}">'
+        f'<Page imageFilename="{page_nr:04d}.jpg" imageWidth="1000" imageHeight="1000">'
+        f'<TextRegion id="r1"><Coords points="0,0"/>{text_lines}</TextRegion></Page></PcGts>'
+    ).encode("utf-8")
+
+
+def tei_source(id_, paragraphs=20):
+    """Returns a small TEI document as eXist source file."""
+    body = "".join(f"<p>Paragraph {i} of {id_}</p>" for i in range(paragraphs))
+    return (
+        f'<?xml version="1.0" encoding="UTF-8"?><TEI xmlns="http://www.tei-c.org/ns/1.0"><teiHeader><fileDesc>'
+        f'<titleStmt><title>{id_}</title></titleStmt></fileDesc></teiHeader><text><body>{body}</body></text></TEI>'
+    ).encode("utf-8")
+
+
+class MockState:
+    """In-memory data of all mocked servers."""
+
+    def __init__(self, latency=0.0, job_duration=1.0, queue_time=0.5, error_rate=0.0, seed=None):
+        self.latency = latency
+        self.job_duration = job_duration
+        self.queue_time = queue_time
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.base_url = ""  # set by MockServer, used for download URLs
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.collections = {}
+            self.jobs = {}
+            self.uploads = {}
+            self.exports = {}
+            self.sources = {}
+            self.exist = {}
+            self.issues = []
+            self.requests = 0
+            self.errors = 0
+            self._next_id = 1000
+
+    def next_id(self):
+        self._next_id += 1
+        return self._next_id
+
+    def seed_documents(self, documents, pages=2, col_id=1, col_name="Benchmark"):
+        """Creates a collection with {documents} new documents of {pages} pages each."""
+        with self.lock:
+            collection = self.collections.setdefault(col_id, {"colId": col_id, "colName": col_name, "docs": {}})
+            for i in range(documents):
+                doc_id = self.next_id()
+                collection["docs"][doc_id] = self._new_document(doc_id, f"doc_{i:05d}", pages)
+
+    def seed_sources(self, ids):
+        """Adds eXist source documents for the given IDs."""
+        with self.lock:
+            for id_ in ids:
+                self.sources[id_] = (tei_source(id_), formatdate(time.time(), usegmt=True))
+
+    def _new_document(self, doc_id, title, pages):
+        return {
+            "docId": doc_id,
+            "title": title,
+            "nrOfPages": pages,
+            "nrOfNew": pages,
+            "pages": [
+                {
+                    "pageId": self.next_id(),
+                    "pageNr": nr,
+                    "imgFileName": f"{nr:04d}.jpg",
+                    "md5Sum": hashlib.md5(f"{doc_id}-{nr}".encode()).hexdigest(),
+                    "key": f"key-{doc_id}-{nr}",
+                }
+                for nr in range(1, pages + 1)
+            ],
+        }
+
+    def create_job(self, job_type, doc_id=None, col_id=None):
+        now = time.time()
+        job_id = self.next_id()
+        queue = self.random.uniform(0, 2 * self.queue_time) if self.queue_time else 0
+        self.jobs[job_id] = {
+            "jobId": job_id, "jobType": job_type, "docId": doc_id, "colId": col_id,
+            "created": now, "started": now + queue, "ended": now + queue + self.job_duration,
+        }
+        return job_id
+
+    def job_status(self, job_id):
+        """Returns the job as the server would, its state follows from the current time."""
+        job = self.jobs[job_id]
+        now = time.time()
+        state = "CREATED" if now < job["started"] else "RUNNING" if now < job["ended"] else "FINISHED"
+        status = {
+            "jobId": str(job_id), "jobType": job["jobType"], "docId": job["docId"], "state": state,
+            "createTime": int(job["created"] * 1000),
+            "startTime": int(job["started"] * 1000) if state != "CREATED" else None,
+            "endTime": int(job["ended"] * 1000) if state == "FINISHED" else None,
+        }
+        if state == "FINISHED":
+            self._finish(job, status)
+        return status
+
+    def _finish(self, job, status):
+        if job.get("done"):
+            status["result"] = job.get("result")
+            return
+        job["done"] = True
+        doc = self.find_document(job["docId"]) if job["docId"] is not None else None
+        if job["jobType"] == "TextRecognitionJob" and doc is not None:
+            doc["nrOfNew"] = 0
+        if job["jobType"] == "Export":
+            job["result"] = f"{self.base_url}/downloads/export_{job['jobId']}.zip"
+        status["result"] = job.get("result")
+
+    def find_document(self, doc_id):
+        for collection in self.collections.values():
+            if doc_id in collection["docs"]:
+                return collection["docs"][doc_id]
+        return None
+
+    def export_zip(self, job_id):
+        """Builds the export ZIP of a finished export job: {colId}/{title}/page/*.xml plus mets.xml."""
+        job = self.jobs[job_id]
+        doc = self.find_document(job["docId"])
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as zf:
+            folder = f"{job['colId']}/{doc['title']}"
+            zf.writestr(f"{folder}/mets.xml", "<mets/>")
+            for page in doc["pages"]:
+                zf.writestr(f"{folder}/page/{page['pageNr']:04d}.xml", page_xml(doc["docId"], page["pageNr"]))
+        return buffer.getvalue()
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    state = None  # set by MockServer
+
+    def log_message(self, format, *args):
+        pass
+
+    # routing
+
+    def do_GET(self):
+        self.dispatch("GET")
+
+    def do_POST(self):
+        self.dispatch("POST")
+
+    def do_PUT(self):
+        self.dispatch("PUT")
+
+    def do_DELETE(self):
+        self.dispatch("DELETE")
+
+    def do_HEAD(self):
+        self.dispatch("HEAD")
+
+    def dispatch(self, method):
+        url = urlparse(self.path)
+        self.query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        self.body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        state = self.state
+        with state.lock:
+            state.requests += 1
+            fail = state.random.random() < state.error_rate
+            if fail:
+                state.errors += 1
+        if state.latency:
+            time.sleep(state.latency)
+        if fail:
+            return self.send(503, b"injected error")
+
+        for pattern, route_method, handler in ROUTES:
+            match = re.fullmatch(pattern, url.path)
+            if match and route_method == method:
+                try:
+                    return handler(self, *[unquote(group) for group in match.groups()])
+                except KeyError:
+                    return self.send(404, b"not found")
+                except Exception as e:
+                    return self.send(500, str(e).encode("utf-8"))
+        self.send(404, b"no route")
+
+    def send(self, status, body=b"", content_type="text/plain", headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def send_json(self, data, status=200):
+        self.send(status, json.dumps(data).encode("utf-8"), "application/json")
+
+    # Transkribus
+
+    def login(self):
+        self.send(200, b"<trpUserLogin><sessionId>mock-session</sessionId></trpUserLogin>", "application/xml")
+
+    def collections_list(self):
+        with self.state.lock:
+            data = [{"colId": c["colId"], "colName": c["colName"], "nrOfDocuments": len(c["docs"])}
+                    for c in self.state.collections.values()]
+        self.send_json(data)
+
+    def documents_list(self, col_id):
+        with self.state.lock:
+            docs = self.state.collections[int(col_id)]["docs"].values()
+            data = [{"docId": d["docId"], "title": d["title"], "nrOfPages": d["nrOfPages"], "nrOfNew": d["nrOfNew"]}
+                    for d in docs]
+        self.send_json(data)
+
+    def fulldoc(self, col_id, doc_id):
+        with self.state.lock:
+            doc = self.state.collections[int(col_id)]["docs"][int(doc_id)]
+            data = {
+                "md": {"docId": doc["docId"], "title": doc["title"], "nrOfPages": doc["nrOfPages"], "nrOfNew": doc["nrOfNew"]},
+                "pageList": {"pages": [dict(page) for page in doc["pages"]]},
+            }
+        self.send_json(data)
+
+    def create_upload(self):
+        payload = json.loads(self.body or b"{}")
+        with self.state.lock:
+            upload_id = self.state.next_id()
+            self.state.uploads[upload_id] = {
+                "colId": int(self.query.get("collId", 0)),
+                "title": payload.get("md", {}).get("title", f"upload_{upload_id}"),
+                "pages": len(payload.get("pageList", {}).get("pages", [])),
+                "received": 0,
+            }
+        self.send(200, f"<trpUpload><uploadId>{upload_id}</uploadId></trpUpload>".encode(), "application/xml")
+
+    def upload_page(self, upload_id):
+        with self.state.lock:
+            upload = self.state.uploads[int(upload_id)]
+            upload["received"] += 1
+            if upload["received"] == upload["pages"]:
+                collection = self.state.collections.setdefault(
+                    upload["colId"], {"colId": upload["colId"], "colName": "Uploads", "docs": {}}
+                )
+                doc_id = self.state.next_id()
+                collection["docs"][doc_id] = self.state._new_document(doc_id, upload["title"], upload["pages"])
+                self.state.create_job("UploadJob", doc_id, upload["colId"])
+        self.send(200, b"<trpUpload/>", "application/xml")
+
+    def analyze_layout(self):
+        root = ET.fromstring(self.body)
+        if root.find(".//docId") is None:
+            return self.send(400, b"No documents selected")
+        col_id = int(self.query.get("collId", 0))
+        # like the real server, one LA job covers all submitted documents and doesn't carry their docIds
+        with self.state.lock:
+            job_id = self.state.create_job("LAJob", None, col_id)
+        self.send_json([{"jobId": str(job_id)}])
+
+    def recognition(self):
+        with self.state.lock:
+            job_id = self.state.create_job("TextRecognitionJob", int(self.query["id"]), int(self.query.get("collId", 0)))
+        self.send(200, str(job_id).encode())
+
+    def jobs_list(self):
+        with self.state.lock:
+            data = [self.state.job_status(job_id) for job_id in self.state.jobs]
+        self.send_json(data)
+
+    def job(self, job_id):
+        with self.state.lock:
+            data = self.state.job_status(int(job_id))
+        self.send_json(data)
+
+    def export(self, col_id, doc_id):
+        with self.state.lock:
+            job_id = self.state.create_job("Export", int(doc_id), int(col_id))
+        self.send(200, str(job_id).encode())
+
+    def download(self, job_id):
+        with self.state.lock:
+            data = self.state.exports.get(int(job_id))
+            if data is None:
+                data = self.state.exports[int(job_id)] = self.state.export_zip(int(job_id))
+        match = re.fullmatch(r"bytes=(\d+)-", self.headers.get("Range", ""))
+        if match:
+            offset = int(match.group(1))
+            if offset >= len(data):
+                return self.send(416)
+            return self.send(206, data[offset:], "application/zip",
+                             {"Content-Range": f"bytes {offset}-{len(data) - 1}/{len(data)}"})
+        self.send(200, data, "application/zip")
+
+    # eXist
+
+    def exist_source(self, id_):
+        with self.state.lock:
+            content, last_modified = self.state.sources[id_]
+        etag = f'"{hashlib.sha256(content).hexdigest()[:16]}"'
+        if self.headers.get("If-None-Match") == etag:
+            return self.send(304, headers={"ETag": etag, "Last-Modified": last_modified})
+        self.send(200, content, "application/xml", {"ETag": etag, "Last-Modified": last_modified})
+
+    def exist_resource_head(self, collection, name):
+        with self.state.lock:
+            exists = f"{collection}/texts/{name}" in self.state.exist
+        self.send(200 if exists else 404)
+
+    def exist_upload(self, collection):
+        # multipart form: the file name is taken from the "filename" field
+        match = re.search(rb'name="filename"\r\n\r\n([^\r]*)', self.body)
+        path = match.group(1).decode() if match else f"texts/upload_{time.time()}.xml"
+        with self.state.lock:
+            self.state.exist[f"{collection}/{path}"] = (self.body, time.time())
+        self.send(201, b"created")
+
+    def exist_rest_get(self, path):
+        with self.state.lock:
+            if path in self.state.exist:
+                return self.send(200, self.state.exist[path][0], "application/xml")
+            prefix = path.rstrip("/") + "/"
+            resources = [(name[len(prefix):], modified) for name, (_, modified) in self.state.exist.items()
+                         if name.startswith(prefix) and "/" not in name[len(prefix):]]
+        if not resources:
+            return self.send(404, b"not found")
+        entries = "".join(
+            f'<exist:resource name="{name}" created="{formatdate(modified, usegmt=True)}" '
+            f'last-modified="{formatdate(modified, usegmt=True)}"/>'
+            for name, modified in resources
+        )
+        body = f'<exist:result xmlns:exist="{EXIST_NS}"><exist:collection name="/db/{path}">{entries}</exist:collection></exist:result>'
+        self.send(200, body.encode(), "application/xml")
+
+    def exist_rest_put(self, path):
+        with self.state.lock:
+            created = path not in self.state.exist
+            self.state.exist[path] = (self.body, time.time())
+        self.send(201 if created else 200, b"")
+
+    def exist_rest_delete(self, path):
+        with self.state.lock:
+            found = self.state.exist.pop(path, None) is not None
+        self.send(200 if found else 404, b"")
+
+    # GitLab
+
+    def gitlab_project(self, project_id):
+        self.send_json({"id": project_id, "name": "mock-project", "path_with_namespace": project_id})
+
+    def gitlab_create_issue(self, project_id):
+        payload = json.loads(self.body or b"{}") if self.headers.get("Content-Type", "").startswith("application/json") \
+            else {key: values[0] for key, values in parse_qs(self.body.decode()).items()}
+        with self.state.lock:
+            iid = len(self.state.issues) + 1
+            issue = {"id": iid, "iid": iid, "project_id": project_id, "state": "opened",
+                     "title": payload.get("title"), "description": payload.get("description")}
+            self.state.issues.append(issue)
+        self.send_json(issue, 201)
+
+
+ROUTES = [
+    (r"/TrpServer/rest/auth/login", "POST", MockHandler.login),
+    (r"/TrpServer/rest/collections/list", "GET", MockHandler.collections_list),
+    (r"/TrpServer/rest/collections/(\d+)/list", "GET", MockHandler.documents_list),
+    (r"/TrpServer/rest/collections/(\d+)/(\d+)/fulldoc", "GET", MockHandler.fulldoc),
+    (r"/TrpServer/rest/collections/(\d+)/(\d+)/export", "POST", MockHandler.export),
+    (r"/TrpServer/rest/uploads", "POST", MockHandler.create_upload),
+    (r"/TrpServer/rest/uploads/(\d+)", "PUT", MockHandler.upload_page),
+    (r"/TrpServer/rest/LA/analyze", "POST", MockHandler.analyze_layout),
+    (r"/TrpServer/rest/recognition/ocr", "POST", MockHandler.recognition),
+    (r"/TrpServer/rest/jobs/list", "GET", MockHandler.jobs_list),
+    (r"/TrpServer/rest/jobs/(\d+)", "GET", MockHandler.job),
+    (r"/downloads/export_(\d+)\.zip", "GET", MockHandler.download),
+    (r"/exist/source/(.+)", "GET", MockHandler.exist_source),
+    (r"/exist/upload/(.+)/resources/([^/]+)", "HEAD", MockHandler.exist_resource_head),
+    (r"/exist/upload/(.+)", "POST", MockHandler.exist_upload),
+    (r"/exist/rest/(.+)", "GET", MockHandler.exist_rest_get),
+    (r"/exist/rest/(.+)", "PUT", MockHandler.exist_rest_put),
+    (r"/exist/rest/(.+)", "DELETE", MockHandler.exist_rest_delete),
+    (r"/api/v4/projects/([^/]+)", "GET", MockHandler.gitlab_project),
+    (r"/api/v4/projects/([^/]+)/issues", "POST", MockHandler.gitlab_create_issue),
+]
+
+
+class MockServer:
+    """
+    Runs the mock servers in a background thread.
+
+    :param port: Port to listen on, 0 picks a free one
+    :param latency: Seconds added to every request
+    :param job_duration: Run time of every job in seconds
+    :param queue_time: Mean time a job waits before it starts, in seconds
+    :param error_rate: Fraction of requests answered with 503
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, **options):
+        self.state = MockState(**options)
+        handler = type("BoundMockHandler", (MockHandler,), {"state": self.state})
+        self.httpd = ThreadingHTTPServer((host, port), handler)
+        self.httpd.daemon_threads = True
+        self.state.base_url = self.url
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def environment(self, collection="benchmark"):
+        """Returns the environment variables that point the workflow modules at this server."""
+        return {
+            "TRANSKRIBUS_BASE_URL": f"{self.url}/TrpServer/rest",
+            "TRANSKRIBUS_EMAIL": "mock@example.org",
+            "TRANSKRIBUS_PASSWORD": "mock",
+            "exist_server": f"{self.url}/exist/upload/",
+            "exist_fetch_server": f"{self.url}/exist/source/",
+            "exist_rest_url": f"{self.url}/exist/rest/",
+            "exist_user": "mock",
+            "exist_password": "mock",
+            "GITLAB_URL": self.url,
+            "ISSUE_GITLAB_TOKEN": "mock",
+            "GITLAB_TOKEN": "mock",
+        }
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name="mock-server", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Mock Transkribus/eXist/GitLab server")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--documents", type=int, default=10, help="new documents in collection 1")
+    parser.add_argument("--pages", type=int, default=2)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--job-duration", type=float, default=1.0)
+    parser.add_argument("--queue-time", type=float, default=0.5)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    server = MockServer(port=args.port, latency=args.latency, job_duration=args.job_duration,
+                        queue_time=args.queue_time, error_rate=args.error_rate)
+    server.state.seed_documents(args.documents, args.pages)
+    server.state.seed_sources([f"doc_{i:05d}" for i in range(args.documents)])
+    print(f"Mock server running on {server.url}, environment:")
+    for name, value in server.environment().items():
+        print(f"{name}={value}")
+    server.start()
+    try:
+        server.thread.join()
+    except KeyboardInterrupt:
+        server.stop()
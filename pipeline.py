@@ -0,0 +1,92 @@
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Staged pipeline scheduler.
+# Every stage has its own thread pool and concurrency limit. An item moves on to the
+# next stage as soon as it has finished the previous one, so all stages work at the
+# same time and the throughput approaches that of the slowest stage.
+
+logger = logging.getLogger(__name__)
+
+
+class StagedPipeline:
+    """
+    Runs items through a sequence of stages.
+
+    :param stages: List of (name, func, max_workers). func(item, value) gets the item and the
+                   result of the previous stage (None for the first one). Returning None
+                   drops the item, it is recorded as error of that stage like an exception.
+    """
+
+    def __init__(self, stages):
+        if not stages:
+            raise ValueError("A pipeline needs at least one stage.")
+        self.stages = stages
+
+    def run(self, items):
+        """
+        Processes all items and blocks until every item left the pipeline.
+
+        :return: (results, errors) - results maps item -> result of the last stage,
+                 errors maps item -> (stage name, exception)
+        """
+        executors = [
+            ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f"stage-{name}")
+            for name, _, max_workers in self.stages
+        ]
+        results = {}
+        errors = {}
+        finished = {name: 0 for name, _, _ in self.stages}
+        pending = 0
+        condition = threading.Condition()
+        start = time.time()
+
+        def submit(index, item, value):
+            nonlocal pending
+            with condition:
+                pending += 1
+            future = executors[index].submit(self.stages[index][1], item, value)
+            future.add_done_callback(lambda f: done(index, item, f))
+
+        def done(index, item, future):
+            nonlocal pending
+            name = self.stages[index][0]
+            try:
+                value = future.result()
+            except Exception as e:
+                logger.error(f"[!] Stage '{name}' failed for {item}: {e}")
+                with condition:
+                    errors[item] = (name, e)
+                value = None
+            else:
+                if value is None:
+                    logger.error(f"[!] Stage '{name}' returned no result for {item}, dropping it.")
+                    with condition:
+                        errors[item] = (name, RuntimeError(f"Stage '{name}' returned no result"))
+
+            if value is not None:
+                with condition:
+                    finished[name] += 1
+                if index + 1 < len(self.stages):
+                    submit(index + 1, item, value)
+                else:
+                    with condition:
+                        results[item] = value
+
+            with condition:
+                pending -= 1
+                condition.notify_all()
+
+        try:
+            for item in items:
+                submit(0, item, None)
+            with condition:
+                condition.wait_for(lambda: pending == 0)
+        finally:
+            for executor in executors:
+                executor.shutdown(wait=True)
+
+        logger.info(f"[+] Pipeline done in {time.time() - start:.1f} s: {finished}, {len(errors)} errors")
+        return results, errors
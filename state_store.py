@@ -0,0 +1,311 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from contextlib import contextmanager
+
+# Local state of the workflow, kept in a SQLite file between runs.
+# Records how far every document got (stage, job IDs, page checksums, export path),
+# a signature of every collection listing, the checksums of local images,
+# the uploaded folders, the eXist documents fetched and pushed and the post-processed files,
+# so reruns can skip finished work.
+
+STATE_DB = os.getenv("TRANSKRIBUS_STATE_DB", "transkribus_state.db")
+
+# pipeline stages of a document, in order
+STAGE_NEW = "new"
+STAGE_LA_STARTED = "la_started"
+STAGE_LA_DONE = "la_done"
+STAGE_OCR_STARTED = "ocr_started"
+STAGE_OCR_DONE = "ocr_done"
+STAGE_EXPORTED = "exported"
+STAGES = (STAGE_NEW, STAGE_LA_STARTED, STAGE_LA_DONE, STAGE_OCR_STARTED, STAGE_OCR_DONE, STAGE_EXPORTED)
+
+_DOCUMENT_FIELDS = ("stage", "la_job_id", "ocr_job_id", "export_path", "page_checksums")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    col_id INTEGER NOT NULL,
+    doc_id INTEGER NOT NULL,
+    stage TEXT NOT NULL,
+    la_job_id TEXT,
+    ocr_job_id TEXT,
+    export_path TEXT,
+    page_checksums TEXT,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (col_id, doc_id)
+);
+CREATE TABLE IF NOT EXISTS collections (
+    col_id INTEGER PRIMARY KEY,
+    signature TEXT NOT NULL,
+    checked_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS checksums (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    md5 TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS uploads (
+    col_id INTEGER NOT NULL,
+    title TEXT NOT NULL,
+    digest TEXT NOT NULL,
+    uploaded_at REAL NOT NULL,
+    PRIMARY KEY (col_id, title)
+);
+-- exist_sources kept the fetched bodies, only their validators and hashes are stored now
+DROP TABLE IF EXISTS exist_sources;
+CREATE TABLE IF NOT EXISTS exist_source_validators (
+    server TEXT NOT NULL,
+    id TEXT NOT NULL,
+    etag TEXT,
+    last_modified TEXT,
+    sha256 TEXT NOT NULL,
+    fetched_at REAL NOT NULL,
+    PRIMARY KEY (server, id)
+);
+CREATE TABLE IF NOT EXISTS exist_pushed (
+    server TEXT NOT NULL,
+    collection TEXT NOT NULL,
+    id TEXT NOT NULL,
+    sha256 TEXT NOT NULL,
+    pushed_at REAL NOT NULL,
+    PRIMARY KEY (server, collection, id)
+);
+CREATE TABLE IF NOT EXISTS post_processed (
+    path TEXT PRIMARY KEY,
+    chain TEXT NOT NULL,
+    sha256 TEXT NOT NULL,
+    processed_at REAL NOT NULL
+);
+"""
+
+# max. number of parameters per SQLite query
+_QUERY_CHUNK = 500
+
+
+def listing_signature(documents):
+    """Returns a hash of a collection listing, it changes as soon as any document in it changes."""
+    payload = json.dumps(documents, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def checksums_digest(checksums):
+    """Combines an ordered list of page checksums into one digest for the whole document."""
+    return hashlib.sha256("\n".join(checksums).encode("utf-8")).hexdigest()
+
+
+def page_checksums(pages):
+    """Maps pageId -> image checksum (or key if the server doesn't send one) for pages from a fulldoc."""
+    return {
+        str(page.get("pageId")): page.get("md5Sum") or page.get("key")
+        for page in pages
+    }
+
+
+class StateStore:
+    """
+    Small wrapper around the SQLite state file.
+    Every call opens its own connection, so one store can be used from several threads.
+    """
+
+    _init_lock = threading.Lock()
+
+    def __init__(self, path=STATE_DB):
+        self.path = path
+        with self._init_lock:
+            with self._connect() as conn:
+                conn.executescript(_SCHEMA)
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        try:
+            with conn:  # commits on success, rolls back on error
+                yield conn
+        finally:
+            conn.close()
+
+    def get_document(self, col_id, doc_id):
+        """Returns the stored state of a document as dict or None if it's unknown."""
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT * FROM documents WHERE col_id = ? AND doc_id = ?", (col_id, doc_id)
+            ).fetchone()
+        if row is None:
+            return None
+        state = dict(row)
+        state["page_checksums"] = json.loads(state["page_checksums"]) if state["page_checksums"] else {}
+        return state
+
+    def update_document(self, col_id, doc_id, **fields):
+        """
+        Creates or updates the state of a document.
+        Only the given fields are changed, page_checksums may be passed as dict.
+        """
+        unknown = set(fields) - set(_DOCUMENT_FIELDS)
+        if unknown:
+            raise ValueError(f"Unknown document fields: {unknown}")
+        if "stage" in fields and fields["stage"] not in STAGES:
+            raise ValueError(f"Unknown stage: {fields['stage']}")
+        if "page_checksums" in fields:
+            fields["page_checksums"] = json.dumps(fields["page_checksums"], sort_keys=True)
+
+        state = self.get_document(col_id, doc_id)
+        with self._connect() as conn:
+            if state is None:
+                fields.setdefault("stage", STAGE_NEW)
+                columns = ["col_id", "doc_id", "updated_at", *fields]
+                values = [col_id, doc_id, time.time(), *fields.values()]
+                conn.execute(
+                    f"INSERT INTO documents ({', '.join(columns)}) VALUES ({', '.join('?' for _ in columns)})",
+                    values,
+                )
+            else:
+                assignments = ", ".join(f"{name} = ?" for name in ["updated_at", *fields])
+                conn.execute(
+                    f"UPDATE documents SET {assignments} WHERE col_id = ? AND doc_id = ?",
+                    [time.time(), *fields.values(), col_id, doc_id],
+                )
+
+    def reset_document(self, col_id, doc_id):
+        """Puts a document back to the first stage, e.g. after its pages changed."""
+        self.update_document(
+            col_id, doc_id,
+            stage=STAGE_NEW, la_job_id=None, ocr_job_id=None, export_path=None,
+        )
+
+    def unfinished_documents(self, col_id):
+        """Returns the IDs of all documents of a collection that weren't exported yet."""
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT doc_id FROM documents WHERE col_id = ? AND stage != ? ORDER BY doc_id",
+                (col_id, STAGE_EXPORTED),
+            ).fetchall()
+        return [row["doc_id"] for row in rows]
+
+    def collection_unchanged(self, col_id, signature):
+        """True if the collection listing has the same signature as in the last run."""
+        with self._connect() as conn:
+            row = conn.execute("SELECT signature FROM collections WHERE col_id = ?", (col_id,)).fetchone()
+        return row is not None and row["signature"] == signature
+
+    def save_collection(self, col_id, signature):
+        """Stores the signature of a collection listing once it has been checked."""
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO collections (col_id, signature, checked_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(col_id) DO UPDATE SET signature = excluded.signature, checked_at = excluded.checked_at",
+                (col_id, signature, time.time()),
+            )
+
+    def get_checksums(self, stats):
+        """
+        Looks up known checksums of local files.
+
+        :param stats: Dict path -> (size, mtime_ns) of the files as they are now
+        :return: Dict path -> md5 for all files whose size and mtime didn't change
+        """
+        paths = list(stats)
+        known = {}
+        with self._connect() as conn:
+            for i in range(0, len(paths), _QUERY_CHUNK):
+                chunk = paths[i:i + _QUERY_CHUNK]
+                rows = conn.execute(
+                    f"SELECT path, size, mtime_ns, md5 FROM checksums WHERE path IN ({', '.join('?' for _ in chunk)})",
+                    chunk,
+                ).fetchall()
+                for row in rows:
+                    if (row["size"], row["mtime_ns"]) == tuple(stats[row["path"]]):
+                        known[row["path"]] = row["md5"]
+        return known
+
+    def save_checksums(self, entries):
+        """Stores checksums of local files, entries is a dict path -> (size, mtime_ns, md5)."""
+        with self._connect() as conn:
+            conn.executemany(
+                "INSERT INTO checksums (path, size, mtime_ns, md5) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(path) DO UPDATE SET size = excluded.size, mtime_ns = excluded.mtime_ns, md5 = excluded.md5",
+                [(path, *entry) for path, entry in entries.items()],
+            )
+
+    def get_upload_digest(self, col_id, title):
+        """Returns the checksum digest of the last upload of a folder into a collection or None."""
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT digest FROM uploads WHERE col_id = ? AND title = ?", (col_id, title)
+            ).fetchone()
+        return row["digest"] if row else None
+
+    def get_cached_source(self, server, id_):
+        """Returns the validators of the last fetch of an eXist document (etag, last_modified, sha256) or None."""
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT etag, last_modified, sha256 FROM exist_source_validators WHERE server = ? AND id = ?",
+                (server, id_),
+            ).fetchone()
+        return dict(row) if row else None
+
+    def save_cached_source(self, server, id_, sha256, etag=None, last_modified=None):
+        """Stores the validators and the sha256 of a fetched eXist document, the content itself isn't kept."""
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO exist_source_validators (server, id, etag, last_modified, sha256, fetched_at) "
+                "VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT(server, id) DO UPDATE SET etag = excluded.etag, "
+                "last_modified = excluded.last_modified, sha256 = excluded.sha256, fetched_at = excluded.fetched_at",
+                (server, id_, etag, last_modified, sha256, time.time()),
+            )
+
+    def get_pushed_hash(self, server, collection, id_):
+        """Returns the sha256 of the version of a document last pushed to server/collection or None."""
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT sha256 FROM exist_pushed WHERE server = ? AND collection = ? AND id = ?",
+                (server, collection, id_),
+            ).fetchone()
+        return row["sha256"] if row else None
+
+    def save_pushed_hash(self, server, collection, id_, sha256):
+        """Records the sha256 of a document that was pushed to server/collection."""
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO exist_pushed (server, collection, id, sha256, pushed_at) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(server, collection, id) DO UPDATE SET sha256 = excluded.sha256, pushed_at = excluded.pushed_at",
+                (server, collection, id_, sha256, time.time()),
+            )
+
+    def delete_pushed_hash(self, server, collection, id_):
+        """Forgets a document that was deleted from server/collection."""
+        with self._connect() as conn:
+            conn.execute(
+                "DELETE FROM exist_pushed WHERE server = ? AND collection = ? AND id = ?",
+                (server, collection, id_),
+            )
+
+    def get_post_processed(self, path):
+        """Returns (chain digest, content sha256) of the last post-processing of a file or None."""
+        with self._connect() as conn:
+            row = conn.execute("SELECT chain, sha256 FROM post_processed WHERE path = ?", (path,)).fetchone()
+        return (row["chain"], row["sha256"]) if row else None
+
+    def save_post_processed(self, path, chain, sha256):
+        """Records that a file with content {sha256} went through the stylesheet chain {chain}."""
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO post_processed (path, chain, sha256, processed_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(path) DO UPDATE SET chain = excluded.chain, sha256 = excluded.sha256, "
+                "processed_at = excluded.processed_at",
+                (path, chain, sha256, time.time()),
+            )
+
+    def save_upload(self, col_id, title, digest):
+        """Records that a folder with the given checksum digest exists in a collection."""
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO uploads (col_id, title, digest, uploaded_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(col_id, title) DO UPDATE SET digest = excluded.digest, uploaded_at = excluded.uploaded_at",
+                (col_id, title, digest, time.time()),
+            )
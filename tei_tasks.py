@@ -0,0 +1,172 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from lxml import etree
+from prefect import task
+from git_tasks import flushes_process_reporter, get_run_reporter
+from helper_tasks import validate_files
+from exist_tasks import sync_collection
+from instrumentation import measure
+
+# Conversion of Transkribus exports (PAGE XML) to TEI.
+# Every page is read with iterparse and its elements are cleared as soon as they are written,
+# the TEI document is written incrementally, so memory doesn't grow with the number of pages.
+# Documents are converted in parallel in a process pool.
+
+TEI_NS = "http://www.tei-c.org/ns/1.0"
+# PAGE elements handled while streaming, any PAGE namespace version
+PAGE_TAGS = ("{*}Page", "{*}TextRegion", "{*}TextLine")
+
+
+def tei(tag):
+    return f"{{{TEI_NS}}}{tag}"
+
+
+def local_name(element):
+    return etree.QName(element).localname
+
+
+def find_page_documents(export_dir):
+    '''finds the documents of an extracted export, every folder with a "page" subfolder is one document
+    returns a list of (title, sorted PAGE XML paths)'''
+    documents = []
+    for root, dirs, files in os.walk(export_dir):
+        if os.path.basename(root) != "page":
+            continue
+        pages = sorted(os.path.join(root, name) for name in files if name.lower().endswith(".xml"))
+        if pages:
+            documents.append((os.path.basename(os.path.dirname(root)), pages))
+    return sorted(documents)
+
+
+def line_text(line):
+    '''returns the text of a TextLine, from its own TextEquiv (not the ones of its words)'''
+    for child in line:
+        if isinstance(child.tag, str) and local_name(child) == "TextEquiv":
+            unicode = child.find("{*}Unicode")
+            return (unicode.text or "") if unicode is not None else ""
+    return ""
+
+
+def release(element):
+    '''clears a handled element and drops its already handled siblings, so the parsed tree stays small'''
+    element.clear(keep_tail=True)
+    parent = element.getparent()
+    if parent is not None:
+        while element.getprevious() is not None:
+            del parent[0]
+
+
+def stream_page(page_path, page_number, xf):
+    '''writes one PAGE file into the open TEI body of {xf}: a pb and one p with lb per text region'''
+    regions = []  # lines of the open (possibly nested) text regions
+    for event, element in etree.iterparse(page_path, events=("start", "end"), tag=PAGE_TAGS):
+        name = local_name(element)
+        if event == "start":
+            if name == "Page":
+                with xf.element(tei("pb"), n=str(page_number), facs=element.get("imageFilename", "")):
+                    pass
+            elif name == "TextRegion":
+                regions.append([])
+            continue
+
+        if name == "TextLine":
+            if regions:
+                regions[-1].append(line_text(element))
+            release(element)
+        elif name == "TextRegion":
+            lines = regions.pop()
+            if lines:
+                attributes = {"facs": f"#{element.get('id')}"} if element.get("id") else {}
+                with xf.element(tei("p"), **attributes):
+                    for text in lines:
+                        with xf.element(tei("lb")):
+                            pass
+                        xf.write(text)
+            release(element)
+
+
+def convert_document(title, page_paths, output_path):
+    '''converts the PAGE files of one document into the TEI file {output_path}
+    returns (output_path, error message or None)'''
+    try:
+        os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+        with etree.xmlfile(output_path, encoding="utf-8") as xf:
+            xf.write_declaration()
+            with xf.element(tei("TEI"), nsmap={None: TEI_NS}):
+                with xf.element(tei("teiHeader")):
+                    with xf.element(tei("fileDesc")):
+                        with xf.element(tei("titleStmt")):
+                            with xf.element(tei("title")):
+                                xf.write(title)
+                        with xf.element(tei("publicationStmt")):
+                            with xf.element(tei("p")):
+                                xf.write("Converted from Transkribus PAGE XML.")
+                        with xf.element(tei("sourceDesc")):
+                            with xf.element(tei("p")):
+                                xf.write(f"{len(page_paths)} pages")
+                with xf.element(tei("text")):
+                    with xf.element(tei("body")):
+                        with xf.element(tei("div")):
+                            for page_number, page_path in enumerate(page_paths, start=1):
+                                stream_page(page_path, page_number, xf)
+        return output_path, None
+    except Exception as e:
+        return output_path, str(e)
+
+
+def convert_export_to_tei(export_dir, output_dir=None, workers=None):
+    '''converts every document of an extracted export into one TEI file in {output_dir} (default: {export_dir}/tei)
+    returns a dict title -> (output path, error message or None)'''
+    output_dir = output_dir or os.path.join(export_dir, "tei")
+    documents = find_page_documents(export_dir)
+    outputs = [os.path.join(output_dir, f"{title}.xml") for title, _ in documents]
+
+    if workers == 1 or len(documents) < 2:
+        results = [convert_document(title, pages, output) for (title, pages), output in zip(documents, outputs)]
+    else:
+        with ProcessPoolExecutor(max_workers=workers or os.cpu_count() or 1) as pool:
+            results = list(pool.map(
+                convert_document,
+                [title for title, _ in documents],
+                [pages for _, pages in documents],
+                outputs,
+            ))
+    return {title: result for (title, _), result in zip(documents, results)}
+
+
+@task
+@flushes_process_reporter
+def page_to_tei(export_dir, output_dir=None, workers=None, rng=None, collection=None):
+    '''
+    Converts the PAGE XML of an export (see transkribus_tasks.export_and_download) into one TEI file per document.
+    Args:
+        export_dir (str): The extracted export.
+        output_dir (str): Where the TEI files go, default {export_dir}/tei.
+        workers (int): Max. number of documents converted in parallel, defaults to the number of CPU cores.
+        rng (str): If given, the TEI files are validated against this RelaxNG schema.
+        collection (str): If given, the TEI files are published to this eXist collection (see exist_tasks.sync_collection).
+
+    Returns:
+        dict: title -> path of the TEI file, failed conversions are reported in the summary issue of the run.
+    '''
+    reporter = get_run_reporter()
+    converted = {}
+    with measure("tei_conversion") as measurement:
+        results = convert_export_to_tei(export_dir, output_dir, workers)
+        measurement.count = len(results)
+    for title, (output_path, error) in results.items():
+        if error:
+            reporter.failure(title, f"TEI conversion failed: {error}")
+        else:
+            converted[title] = output_path
+    print(f"Converted {len(converted)} documents of {export_dir} to TEI.")
+
+    if rng and converted:
+        for result in validate_files(converted.values(), rng, workers):
+            if not result["valid"]:
+                errors = "; ".join(f"Line {error['line']}: {error['message']}" for error in result["errors"][:10])
+                reporter.failure(result["file"], f"TEI validation failed: {errors}")
+
+    if collection and converted:
+        sync_collection(collection, directory=output_dir or os.path.join(export_dir, "tei"))
+    return converted
@@ -0,0 +1,463 @@
+import os
+import time
+import random
+import asyncio
+import logging
+import xml.etree.ElementTree as ET
+import httpx
+from lxml import etree
+from transkribus_client import POOL_SIZE
+from transkribus_jobs import DEFAULT_JOB_TYPES, FINAL_STATES, open_jobs
+from transkribus_tasks import (
+    BASE_URL,
+    LA_PARAMS,
+    SUPPORTED_IMAGE_EXT,
+    FULLDOC_WORKERS,
+    UPLOAD_PAGE_WORKERS,
+    DOWNLOAD_DIR,
+    DOWNLOAD_CHUNK_SIZE,
+    json_to_xml_description,
+    parse_job_ids,
+    calculate_checksums,
+    extract_export,
+    is_page_xml
+)
+
+# Asyncio counterpart of transkribus_tasks.
+# One AsyncTranskribusClient holds one pooled httpx.AsyncClient and one job poller,
+# so a single event loop can drive hundreds of documents without a thread per document.
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncJobTracker:
+    """
+    Polls /jobs/list once per tick for all coroutines waiting on documents or jobs.
+    Same backoff and jitter rules as transkribus_jobs.JobTracker.
+    """
+
+    def __init__(self, client, min_interval=2, max_interval=30, backoff=1.5, jitter=0.2, max_errors=5):
+        self.client = client
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.jitter = jitter
+        self.max_errors = max_errors
+
+        self._doc_waiters = []  # (doc_id, job_types, registered_at, future)
+        self._job_waiters = {}  # job_id -> [future, ...]
+        self._states = {}
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    async def wait_for_document(self, doc_id=None, job_types=DEFAULT_JOB_TYPES, timeout=None):
+        """Waits until no job of the given types is open for doc_id (or at all if doc_id is None)."""
+        future = asyncio.get_running_loop().create_future()
+        waiter = (doc_id, tuple(job_types), time.monotonic(), future)
+        self._doc_waiters.append(waiter)
+        self._ensure_running()
+        try:
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            # a waiter that timed out or was cancelled isn't polled for any longer
+            if waiter in self._doc_waiters:
+                self._doc_waiters.remove(waiter)
+
+    async def wait_for_job(self, job_id, timeout=None):
+        """Waits until the job reaches a final state and returns its status."""
+        future = asyncio.get_running_loop().create_future()
+        self._job_waiters.setdefault(str(job_id), []).append(future)
+        self._ensure_running()
+        try:
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            waiters = self._job_waiters.get(str(job_id), [])
+            if future in waiters:
+                waiters.remove(future)
+            if not waiters:
+                self._job_waiters.pop(str(job_id), None)
+
+    def _ensure_running(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        else:
+            self._wakeup.set()
+
+    async def _run(self):
+        interval = self.min_interval
+        errors = 0
+        last_poll = 0.0
+
+        while self._doc_waiters or self._job_waiters:
+            # new waiters wake the poller, but never poll faster than min_interval
+            await asyncio.sleep(max(0.0, last_poll + self.min_interval - time.monotonic()))
+            last_poll = time.monotonic()
+
+            try:
+                changed = await self._poll()
+                errors = 0
+            except Exception as e:
+                errors += 1
+                logger.warning(f"[!] Error retrieving job status ({errors}/{self.max_errors}): {e}")
+                if errors >= self.max_errors:
+                    self._fail_all(e)
+                    break
+                changed = False
+
+            interval = self.min_interval if changed else min(interval * self.backoff, self.max_interval)
+            delay = interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+            self._wakeup.clear()
+            if self._doc_waiters or self._job_waiters:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def _poll(self):
+        polled_at = time.monotonic()
+        response = await self.client.http.get(f"{self.client.base_url}/jobs/list")
+        if response.status_code != 200:
+            raise Exception(f"{response.status_code} - {response.text}")
+        jobs = response.json()
+
+        states = {str(job.get("jobId")): job.get("state") for job in jobs}
+        changed = states != self._states
+        self._states = states
+        by_id = {str(job.get("jobId")): job for job in jobs}
+
+        # only the single job status carries the full result
+        for job_id in list(self._job_waiters):
+            if job_id not in by_id or by_id[job_id].get("state") in FINAL_STATES:
+                status_response = await self.client.http.get(f"{self.client.base_url}/jobs/{job_id}")
+                if status_response.status_code == 200:
+                    by_id[job_id] = status_response.json()
+
+        remaining = []
+        for waiter in self._doc_waiters:
+            doc_id, job_types, registered_at, future = waiter
+            if future.done():
+                continue  # timed out
+            if registered_at > polled_at or open_jobs(jobs, doc_id, job_types):
+                remaining.append(waiter)
+            else:
+                future.set_result(True)
+        self._doc_waiters = remaining
+
+        for job_id, job in by_id.items():
+            if job_id in self._job_waiters and job.get("state") in FINAL_STATES:
+                for future in self._job_waiters.pop(job_id):
+                    if not future.done():
+                        future.set_result(job)
+
+        return changed
+
+    def _fail_all(self, error):
+        futures = [future for _, _, _, future in self._doc_waiters]
+        futures += [future for waiters in self._job_waiters.values() for future in waiters]
+        self._doc_waiters = []
+        self._job_waiters = {}
+        for future in futures:
+            if not future.done():
+                future.set_exception(Exception(f"Job polling failed: {error}"))
+
+
+class AsyncTranskribusClient:
+    """
+    Async client for the Transkribus REST API.
+
+    Usage:
+        async with await AsyncTranskribusClient.login() as client:
+            collections = await client.get_collections()
+    """
+
+    def __init__(self, session_id, pool_size=POOL_SIZE, base_url=BASE_URL, timeout=60):
+        self.session_id = session_id
+        self.base_url = base_url
+        self.http = httpx.AsyncClient(
+            headers={"Cookie": f"JSESSIONID={session_id}"},
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+            timeout=timeout,
+        )
+        # export files may come from another host, they are downloaded without the session cookie
+        self.download_http = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+            timeout=timeout,
+        )
+        self.jobs = AsyncJobTracker(self)
+
+    @classmethod
+    async def login(cls, email=None, password=None, **kwargs):
+        """Performs the login to Transkribus and returns a client for the new session."""
+        email = email or os.getenv("TRANSKRIBUS_EMAIL")
+        password = password or os.getenv("TRANSKRIBUS_PASSWORD")
+
+        if not email or not password:
+            raise Exception("Missing login credentials: Please ensure that the .env file is correct.")
+
+        base_url = kwargs.get("base_url", BASE_URL)
+        async with httpx.AsyncClient() as http:
+            response = await http.post(f"{base_url}/auth/login", data={"user": email, "pw": password})
+
+        if response.status_code != 200:
+            raise Exception(f"Login failed: {response.status_code} - {response.text}")
+
+        try:
+            root = etree.fromstring(response.content)
+            session_id = root.find("sessionId").text
+        except etree.ParseError:
+            raise Exception("Error: The XML response could not be parsed.")
+        logger.info("Successfully logged in!")
+        return cls(session_id, **kwargs)
+
+    async def aclose(self):
+        await self.http.aclose()
+        await self.download_http.aclose()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.aclose()
+
+    async def _get_json(self, url, error_message):
+        response = await self.http.get(url)
+        if response.status_code != 200:
+            raise Exception(f"{error_message}: {response.status_code} - {response.text}")
+        try:
+            return response.json()
+        except ValueError as e:
+            raise Exception(f"JSON-parsing-error: {e}")
+
+    async def get_collections(self):
+        """Fetches all collections as a list of tuples (ID, Name)."""
+        data = await self._get_json(f"{self.base_url}/collections/list", "Error retrieving the collections")
+        return [(col["colId"], col["colName"]) for col in data]
+
+    async def get_documents_in_collection(self, collection_id):
+        """Fetches all documents from a specific collection."""
+        return await self._get_json(
+            f"{self.base_url}/collections/{collection_id}/list", "Error while retrieving the documents"
+        )
+
+    async def get_fulldoc(self, collection_id, doc_id):
+        """Fetches the /fulldoc of a document, None if it couldn't be loaded."""
+        try:
+            return await self._get_json(
+                f"{self.base_url}/collections/{collection_id}/{doc_id}/fulldoc", f"Document {doc_id} couldn't be loaded"
+            )
+        except Exception as e:
+            logger.warning(str(e))
+            return None
+
+    async def get_page_ids(self, collection_id, doc_id, fulldoc=None):
+        """Fetch pageIds for a specific document, an already fetched fulldoc can be passed."""
+        data = fulldoc or await self.get_fulldoc(collection_id, doc_id)
+        if data is None:
+            return []
+        return [page["pageId"] for page in data.get("pageList", {}).get("pages", [])]
+
+    async def filter_new_documents(self, collection_id, doc_ids, documents=None, max_concurrency=FULLDOC_WORKERS):
+        """
+        Returns a dict docId -> fulldoc (or None, if the listing was sufficient) for all documents with status "New".
+        Like transkribus_tasks.filter_new_documents, nrOfNew from the listing is used if present.
+        """
+        listed = {doc.get("docId"): doc for doc in documents or []}
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def check(doc_id):
+            md = listed.get(doc_id, {})
+            if "nrOfNew" in md:
+                return md["nrOfNew"] > 0, None
+            async with semaphore:
+                data = await self.get_fulldoc(collection_id, doc_id)
+            if data is None:
+                return False, None
+            return data.get("md", {}).get("nrOfNew", 0) > 0, data
+
+        results = await asyncio.gather(*(check(doc_id) for doc_id in doc_ids))
+        new_docs = {doc_id: data for doc_id, (is_new, data) in zip(doc_ids, results) if is_new}
+        logger.info(f"[+] Found 'New'-documents: {list(new_docs)}")
+        return new_docs
+
+    async def wait_for_documents_to_appear(self, collection_id, expected_titles, timeout=300, poll_interval=5):
+        """Waits until all expected document titles are visible in the collection, returns (title, docId) tuples."""
+        expected = set(expected_titles)
+        found = set()
+        deadline = time.monotonic() + timeout
+
+        while time.monotonic() < deadline:
+            docs = await self.get_documents_in_collection(collection_id)
+            seen = {(d.get("title") or d.get("md", {}).get("title")): d.get("docId") for d in docs}
+            found = {t for t in expected if t in seen}
+            if found == expected:
+                return [(t, seen[t]) for t in expected_titles]
+            await asyncio.sleep(poll_interval)
+
+        raise TimeoutError(f"Documents did not appear in the collection in time: {expected - found}")
+
+    async def upload_document(self, collection_id, folder_path, page_concurrency=UPLOAD_PAGE_WORKERS, store=None):
+        """
+        Uploads the images of one folder as a new document.
+        Checksums are calculated in a worker thread, pages are uploaded concurrently.
+
+        :return: The title of the uploaded document or None
+        """
+        folder_name = os.path.basename(folder_path)
+        images = sorted(
+            os.path.join(folder_path, f)
+            for f in os.listdir(folder_path)
+            if os.path.splitext(f.lower())[1] in SUPPORTED_IMAGE_EXT
+        )
+        if not images:
+            logger.warning(f"No valid image files found in the directory: {folder_path}")
+            return None
+
+        checksums = await asyncio.to_thread(calculate_checksums, images, 0, store)
+        payload = {
+            "md": {"title": folder_name},
+            "pageList": {
+                "pages": [
+                    {"fileName": os.path.basename(img), "pageNr": i + 1, "imgChecksum": checksum}
+                    for i, (img, checksum) in enumerate(zip(images, checksums))
+                ]
+            },
+        }
+        response = await self.http.post(f"{self.base_url}/uploads", params={"collId": collection_id}, json=payload)
+        if response.status_code != 200:
+            raise Exception(f"Error creating the upload: {response.status_code} - {response.text}")
+        upload_id = ET.fromstring(response.text).find("uploadId").text
+
+        semaphore = asyncio.Semaphore(page_concurrency)
+
+        async def upload_page(img):
+            async with semaphore:
+                with open(img, "rb") as img_file:
+                    files = {"img": (os.path.basename(img), img_file, "application/octet-stream")}
+                    response = await self.http.put(f"{self.base_url}/uploads/{upload_id}", files=files)
+            if response.status_code != 200:
+                raise Exception(f"Error uploading the page {img}: {response.status_code} - {response.text}")
+
+        await asyncio.gather(*(upload_page(img) for img in images))
+        logger.info(f"Upload of '{folder_name}' with {len(images)} pages completed successfully.")
+        return folder_name
+
+    async def start_layout_analysis(self, collection_id, doc_id, page_ids):
+        """Starts the layout analysis for a document, returns the job ID or None."""
+        response = await self.http.post(
+            f"{self.base_url}/LA/analyze",
+            params={"collId": collection_id, **LA_PARAMS},
+            content=json_to_xml_description(doc_id, page_ids),
+            headers={"Content-Type": "application/xml"},
+        )
+        if response.status_code != 200:
+            logger.error(f"[-] Error starting layout analysis: {response.status_code} - {response.text}")
+            return None
+        logger.info(f"[+] Layout analysis for document {doc_id} started.")
+        return parse_job_ids(response.text, [doc_id]).get(doc_id)
+
+    async def start_ocr(self, collection_id, doc_id, page_ids):
+        """Starts OCR with the legacy engine, returns the job ID or None."""
+        params = {
+            "collId": collection_id,
+            "id": doc_id,
+            "pages": ",".join(str(pid) for pid in page_ids),
+            "type": "Legacy",
+        }
+        response = await self.http.post(f"{self.base_url}/recognition/ocr", params=params)
+        if response.status_code != 200:
+            logger.error(f"[-] Error starting OCR: {response.status_code} - {response.text}")
+            return None
+        logger.info(f"[+] OCR started for document {doc_id}")
+        return parse_job_ids(response.text, [doc_id]).get(doc_id)
+
+    async def wait_for_jobs(self, doc_id=None, job_types=DEFAULT_JOB_TYPES, timeout=None):
+        """Waits until all relevant jobs of a document (or all jobs) are completed."""
+        await self.jobs.wait_for_document(doc_id, job_types, timeout=timeout)
+
+    async def job_finished(self, job_id, timeout=None):
+        """Waits for a single job, True if it ended as FINISHED."""
+        status = await self.jobs.wait_for_job(job_id, timeout=timeout)
+        if status.get("state") != "FINISHED":
+            logger.error(f"Job {job_id} ended with state {status.get('state')}.")
+            return False
+        return True
+
+    async def download_file(self, url, path, chunk_size=DOWNLOAD_CHUNK_SIZE):
+        """Streams url to path, a partial path + ".part" is resumed with an HTTP Range request."""
+        part_path = path + ".part"
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+
+        async with self.download_http.stream("GET", url, headers=headers) as response:
+            if response.status_code not in (200, 206, 416):
+                await response.aread()
+                raise Exception(f"Error downloading: {response.status_code} - {response.text}")
+            if response.status_code != 416:
+                mode = "ab" if response.status_code == 206 else "wb"
+                with open(part_path, mode) as f:
+                    async for chunk in response.aiter_bytes(chunk_size):
+                        await asyncio.to_thread(f.write, chunk)
+
+        os.replace(part_path, path)
+        return path
+
+    async def export_and_download(self, collection_id, document_id, page_xml_only=False):
+        """
+        Exports, downloads and extracts a document.
+        Returns the directory the export was extracted to or None on errors.
+        """
+        response = await self.http.post(
+            f"{self.base_url}/collections/{collection_id}/{document_id}/export", json={"format": "application/zip"}
+        )
+        try:
+            data = response.json()
+            job_id = data.get("jobId") if isinstance(data, dict) else data
+        except ValueError:
+            text = response.text.strip()
+            job_id = int(text) if text.isdigit() else None
+        if not job_id:
+            logger.error(f"Error starting the export: {response.status_code} - {response.text}")
+            return None
+
+        status = await self.jobs.wait_for_job(job_id)
+        download_url = status.get("result")
+        if status.get("state") != "FINISHED" or not download_url:
+            logger.error(f"Export job {job_id} ended with state {status.get('state')} without a download URL.")
+            return None
+
+        os.makedirs(DOWNLOAD_DIR, exist_ok=True)
+        zip_path = os.path.join(DOWNLOAD_DIR, f"export_{job_id}.zip")
+        await self.download_file(download_url, zip_path)
+
+        extract_dir = os.path.join(DOWNLOAD_DIR, f"export_{job_id}")
+        await asyncio.to_thread(extract_export, zip_path, extract_dir, is_page_xml if page_xml_only else None)
+        logger.info(f"ZIP extracted to: {extract_dir}")
+        return extract_dir
+
+    async def process_document(self, collection_id, doc_id, fulldoc=None):
+        """Runs LA -> OCR -> export for one document, returns the export directory or None."""
+        page_ids = await self.get_page_ids(collection_id, doc_id, fulldoc)
+        if not page_ids:
+            logger.warning(f"No pages found for document {doc_id}, skipping.")
+            return None
+        # LA and OCR are waited for by job ID, a job for several documents doesn't carry every docId
+        la_job_id = await self.start_layout_analysis(collection_id, doc_id, page_ids)
+        if la_job_id is None or not await self.job_finished(la_job_id):
+            return None
+        ocr_job_id = await self.start_ocr(collection_id, doc_id, page_ids)
+        if ocr_job_id is None or not await self.job_finished(ocr_job_id):
+            return None
+        return await self.export_and_download(collection_id, doc_id)
+
+    async def process_new_documents(self, collection_id, max_concurrency=50):
+        """Processes all new documents of a collection, at most max_concurrency at the same time."""
+        documents = await self.get_documents_in_collection(collection_id)
+        new_docs = await self.filter_new_documents(collection_id, [d.get("docId") for d in documents], documents)
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def run(doc_id, fulldoc):
+            async with semaphore:
+                return await self.process_document(collection_id, doc_id, fulldoc)
+
+        return await asyncio.gather(*(run(doc_id, fulldoc) for doc_id, fulldoc in new_docs.items()))
@@ -0,0 +1,438 @@
+import os
+import json
+import time
+import random
+import threading
+import urllib.parse
+import logging
+import requests
+from lxml import etree
+from requests.adapters import HTTPAdapter
+
+# Shared HTTP client for the Transkribus REST API.
+# One requests.Session per session ID, so all calls of a run reuse
+# the same keep-alive connections instead of a new TCP+TLS handshake per request.
+# The SessionManager logs in lazily, caches the session on disk between runs
+# and renews it when the server rejects it.
+# Every request passes a token-bucket rate limiter and is retried with exponential
+# backoff on 429, 5xx and connection errors (5xx only for idempotent requests).
+
+BASE_URL = os.getenv("TRANSKRIBUS_BASE_URL", "https://transkribus.eu/TrpServer/rest")
+
+logger = logging.getLogger(__name__)
+
+# max. number of pooled connections per host, should be >= the number of concurrent tasks
+POOL_SIZE = int(os.getenv("TRANSKRIBUS_POOL_SIZE", "20"))
+
+# session cache between runs and the time a cached session is trusted
+SESSION_CACHE = os.getenv("TRANSKRIBUS_SESSION_CACHE", ".transkribus_session.json")
+SESSION_TTL = int(os.getenv("TRANSKRIBUS_SESSION_TTL", "3600"))
+
+# status codes that mean the session is no longer valid
+AUTH_ERRORS = (401, 403)
+
+# retries: attempts per request, backoff in seconds and the status codes that are retried
+RETRY_ATTEMPTS = int(os.getenv("TRANSKRIBUS_RETRY_ATTEMPTS", "5"))
+RETRY_BACKOFF = float(os.getenv("TRANSKRIBUS_RETRY_BACKOFF", "1"))
+RETRY_MAX_BACKOFF = float(os.getenv("TRANSKRIBUS_RETRY_MAX_BACKOFF", "60"))
+RETRY_STATUS = (429, 500, 502, 503, 504)
+IDEMPOTENT_METHODS = ("GET", "HEAD", "OPTIONS", "PUT", "DELETE")
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def parse_endpoint_rates(value):
+    """
+    Parses per-endpoint limits like "LA=2,recognition=2".
+    Entries with a rate <= 0 or that can't be parsed are ignored, so that endpoint isn't limited.
+    """
+    rates = {}
+    for entry in value.split(","):
+        if "=" not in entry:
+            continue
+        name, rate = (part.strip() for part in entry.split("=", 1))
+        try:
+            rate = float(rate)
+        except ValueError:
+            logger.warning(f"[!] Ignoring rate limit '{entry}': not a number")
+            continue
+        if rate <= 0:
+            logger.warning(f"[!] Ignoring rate limit '{entry}': the rate must be > 0")
+            continue
+        rates[name] = rate
+    return rates
+
+
+# throttling: requests per second for all calls (<= 0 disables it) and per endpoint ("LA=2,recognition=2")
+RATE_LIMIT = float(os.getenv("TRANSKRIBUS_RATE_LIMIT", "10"))
+ENDPOINT_RATE_LIMITS = parse_endpoint_rates(os.getenv("TRANSKRIBUS_ENDPOINT_RATE_LIMITS", ""))
+
+
+def request_session_id(email=None, password=None):
+    """
+    Performs the login to Transkribus and returns the new session ID.
+    Credentials default to TRANSKRIBUS_EMAIL and TRANSKRIBUS_PASSWORD.
+    """
+    email = email or os.getenv("TRANSKRIBUS_EMAIL")
+    password = password or os.getenv("TRANSKRIBUS_PASSWORD")
+
+    if not email or not password:
+        raise Exception("Missing login credentials: Please ensure that the .env file is correct.")
+
+    response = requests.post(f"{BASE_URL}/auth/login", data={"user": email, "pw": password})
+
+    if response.status_code != 200:
+        raise Exception(f"Login failed: {response.status_code} - {response.text}")
+
+    try:
+        root = etree.fromstring(response.content)
+        return root.find("sessionId").text
+    except etree.ParseError:
+        raise Exception("Error: The XML response could not be parsed.")
+
+
+class SessionManager:
+    """
+    Hands out the current Transkribus session ID.
+    Logs in only when needed, reuses a cached session from an earlier run while it's
+    younger than ttl and renews it at most once per min_renew_interval, no matter how
+    many concurrent tasks report it as expired.
+    """
+
+    def __init__(self, cache_path=SESSION_CACHE, ttl=SESSION_TTL, min_renew_interval=60):
+        self.cache_path = cache_path
+        self.ttl = ttl
+        self.min_renew_interval = min_renew_interval
+        self._lock = threading.Lock()
+        self._session_id = None
+        self._expires_at = 0.0
+        self._renewed_at = 0.0
+
+    def session_id(self):
+        """Returns a valid session ID, from memory, from the cache file or by logging in."""
+        with self._lock:
+            if self._session_id and time.time() < self._expires_at:
+                return self._session_id
+            if self._load_cache():
+                return self._session_id
+            return self._login()
+
+    def renew(self, failed_session_id):
+        """
+        Called when the server rejected failed_session_id.
+        If another task already renewed it, the newer ID is returned without a new login.
+        """
+        with self._lock:
+            if self._session_id and self._session_id != failed_session_id:
+                return self._session_id
+            if time.time() - self._renewed_at < self.min_renew_interval:
+                return self._session_id
+            logger.info("[+] Transkribus session expired, logging in again.")
+            return self._login()
+
+    def _login(self):
+        self._session_id = request_session_id()
+        self._expires_at = time.time() + self.ttl
+        self._renewed_at = time.time()
+        self._save_cache()
+        return self._session_id
+
+    def _load_cache(self):
+        if not self.cache_path or not os.path.exists(self.cache_path):
+            return False
+        try:
+            with open(self.cache_path, "r") as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"[!] Session cache couldn't be read: {e}")
+            return False
+        if data.get("user") != os.getenv("TRANSKRIBUS_EMAIL") or time.time() >= data.get("expires_at", 0):
+            return False
+        self._session_id = data["session_id"]
+        self._expires_at = data["expires_at"]
+        return True
+
+    def _save_cache(self):
+        if not self.cache_path:
+            return
+        data = {"session_id": self._session_id, "expires_at": self._expires_at, "user": os.getenv("TRANSKRIBUS_EMAIL")}
+        try:
+            # only readable by the owner, it's a login
+            fd = os.open(self.cache_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w") as f:
+                json.dump(data, f)
+        except OSError as e:
+            logger.warning(f"[!] Session cache couldn't be written: {e}")
+
+
+_session_manager = SessionManager()
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket, rate tokens per second up to capacity.
+    acquire() blocks until a token is available and returns the time it waited.
+    """
+
+    def __init__(self, rate, capacity=None):
+        if rate <= 0:
+            raise ValueError(f"The rate of a token bucket must be > 0, got {rate}")
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return waited
+                delay = (1 - self._tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+
+class RequestMetrics:
+    """Counts requests, retries, throttling delays, wall time and received bytes per endpoint."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._endpoints = {}
+
+    def record(self, endpoint, calls=0, retries=0, throttled=0.0, errors=0, seconds=0.0, received=0):
+        with self._lock:
+            entry = self._endpoints.setdefault(
+                endpoint, {"requests": 0, "retries": 0, "throttle_seconds": 0.0, "errors": 0, "seconds": 0.0, "bytes": 0}
+            )
+            entry["requests"] += calls
+            entry["retries"] += retries
+            entry["throttle_seconds"] += throttled
+            entry["errors"] += errors
+            entry["seconds"] += seconds
+            entry["bytes"] += received
+
+    def snapshot(self):
+        """Returns a copy of the counters, per endpoint and in total."""
+        with self._lock:
+            endpoints = {name: dict(entry) for name, entry in self._endpoints.items()}
+        total = {"requests": 0, "retries": 0, "throttle_seconds": 0.0, "errors": 0, "seconds": 0.0, "bytes": 0}
+        for entry in endpoints.values():
+            for key in total:
+                total[key] += entry[key]
+        return {"total": total, "endpoints": endpoints}
+
+    def reset(self):
+        """Sets all counters back to zero."""
+        with self._lock:
+            self._endpoints = {}
+
+
+class RateLimiter:
+    """
+    A global token bucket plus optional buckets per endpoint (first path segment after /rest/).
+    A rate <= 0 disables the respective limit.
+    """
+
+    def __init__(self, rate=RATE_LIMIT, endpoint_rates=None):
+        self.global_bucket = TokenBucket(rate) if rate > 0 else None
+        self.endpoint_buckets = {name: TokenBucket(r) for name, r in (endpoint_rates or {}).items() if r > 0}
+
+    def acquire(self, endpoint):
+        waited = self.global_bucket.acquire() if self.global_bucket else 0.0
+        bucket = self.endpoint_buckets.get(endpoint)
+        if bucket is not None:
+            waited += bucket.acquire()
+        return waited
+
+
+def endpoint_of(url):
+    """Returns the endpoint name of a URL used for limits and metrics, e.g. 'jobs' or 'LA'."""
+    path = urllib.parse.urlparse(url).path
+    if "/rest/" in path:
+        path = path.split("/rest/", 1)[1]
+    return path.strip("/").split("/", 1)[0] or "/"
+
+
+def retry_delay(attempt, response=None):
+    """Exponential backoff with jitter, a Retry-After header of the server takes precedence."""
+    if response is not None:
+        retry_after = response.headers.get("Retry-After", "")
+        if retry_after.isdigit():
+            return min(float(retry_after), RETRY_MAX_BACKOFF)
+    delay = min(RETRY_BACKOFF * 2 ** (attempt - 1), RETRY_MAX_BACKOFF)
+    return delay * random.uniform(0.5, 1.5)
+
+
+_rate_limiter = RateLimiter(RATE_LIMIT, ENDPOINT_RATE_LIMITS)
+_metrics = RequestMetrics()
+
+
+def get_metrics():
+    """Returns the request, retry and throttling counters of this process."""
+    return _metrics.snapshot()
+
+
+def reset_metrics():
+    """Sets the request, retry and throttling counters of this process back to zero."""
+    _metrics.reset()
+
+
+def get_session_manager():
+    """Returns the process-wide SessionManager."""
+    return _session_manager
+
+
+class TranskribusSession(requests.Session):
+    """
+    requests.Session that sends the JSESSIONID cookie and, if the server answers
+    401/403, renews the session via the SessionManager and repeats the request once.
+    All requests are throttled by the rate limiter and retried according to the retry settings.
+    Non-idempotent requests (POST) are only retried on 429 and connect timeouts,
+    unless idempotent=True is passed.
+    """
+
+    def __init__(self, session_id, manager=None, rate_limiter=None, retry_attempts=RETRY_ATTEMPTS):
+        super().__init__()
+        self.manager = manager
+        self.rate_limiter = rate_limiter
+        self.retry_attempts = retry_attempts
+        self.set_session_id(session_id)
+
+    def set_session_id(self, session_id):
+        self.session_id = session_id
+        self.headers.update({"Cookie": f"JSESSIONID={session_id}"})
+
+    def request(self, method, url, *args, idempotent=None, **kwargs):
+        session_id = self.session_id
+        # a streamed body is consumed by the first attempt and can't be sent again
+        data = kwargs.get("data")
+        replayable = data is None or isinstance(data, (bytes, str, dict, list, tuple))
+
+        response = self._request_with_retries(method, url, args, kwargs, idempotent, replayable)
+        if response.status_code not in AUTH_ERRORS or self.manager is None or not replayable:
+            return response
+
+        try:
+            new_session_id = self.manager.renew(session_id)
+        except Exception as e:
+            logger.error(f"[!] Session renewal failed: {e}")
+            return response
+        if new_session_id == session_id:
+            return response
+
+        with _clients_lock:
+            _clients[new_session_id] = self
+        self.set_session_id(new_session_id)
+        response.close()
+        return self._request_with_retries(method, url, args, kwargs, idempotent, replayable)
+
+    def _request_with_retries(self, method, url, args, kwargs, idempotent, replayable):
+        endpoint = endpoint_of(url)
+        if idempotent is None:
+            idempotent = method.upper() in IDEMPOTENT_METHODS
+        attempts = self.retry_attempts if replayable else 1
+
+        for attempt in range(1, attempts + 1):
+            throttled = self.rate_limiter.acquire(endpoint) if self.rate_limiter else 0.0
+            _metrics.record(endpoint, calls=1, throttled=throttled, retries=1 if attempt > 1 else 0)
+            start = time.perf_counter()
+            try:
+                response = super().request(method, url, *args, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                _metrics.record(endpoint, seconds=time.perf_counter() - start)
+                # a connect timeout never reached the server, everything else might have
+                retryable = idempotent or isinstance(e, requests.exceptions.ConnectTimeout)
+                if attempt == attempts or not retryable:
+                    _metrics.record(endpoint, errors=1)
+                    raise
+                delay = retry_delay(attempt)
+                logger.warning(f"[!] {method} {endpoint} failed ({e}), retry {attempt}/{attempts - 1} in {delay:.1f} s")
+                time.sleep(delay)
+                continue
+
+            # for streamed responses this is the time until the headers arrived
+            _metrics.record(endpoint, seconds=time.perf_counter() - start,
+                            received=int(response.headers.get("Content-Length") or 0))
+            retryable = response.status_code == 429 or (idempotent and response.status_code in RETRY_STATUS)
+            if not retryable or attempt == attempts:
+                if response.status_code >= 400:
+                    _metrics.record(endpoint, errors=1)
+                return response
+
+            delay = retry_delay(attempt, response)
+            logger.warning(f"[!] {method} {endpoint} returned {response.status_code}, retry {attempt}/{attempts - 1} in {delay:.1f} s")
+            response.close()
+            time.sleep(delay)
+
+
+def create_client(session_id, pool_size=POOL_SIZE, manager=None):
+    """
+    Builds a new pooled client for the given session ID.
+
+    :param session_id: Transkribus session ID (e.g., from get_session_id)
+    :param pool_size: Number of keep-alive connections kept per host
+    :param manager: SessionManager used to renew the session, None disables renewal
+    :return: TranskribusSession with the JSESSIONID cookie set
+    """
+    session = TranskribusSession(session_id, manager, _rate_limiter)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def get_client(session_id, pool_size=POOL_SIZE):
+    """
+    Returns the shared client for a session ID and creates it on first use.
+    The client is shared between threads, the connection pool itself is thread-safe.
+    If the session gets renewed, the same client is used for the old and the new ID.
+
+    :param session_id: Transkribus session ID
+    :param pool_size: Pool size used if the client has to be created
+    :return: TranskribusSession
+    """
+    with _clients_lock:
+        client = _clients.get(session_id)
+        if client is None:
+            client = create_client(session_id, pool_size, get_session_manager())
+            _clients[session_id] = client
+            logger.info(f"[+] HTTP client created (pool size {pool_size}).")
+        return client
+
+
+def close_client(session_id):
+    """Closes the pooled connections of a session ID and forgets the client."""
+    with _clients_lock:
+        client = _clients.pop(session_id, None)
+        if client is not None:
+            for key in [key for key, value in _clients.items() if value is client]:
+                del _clients[key]
+    if client is not None:
+        client.close()
+
+
+_download_session = None
+_download_session_lock = threading.Lock()
+
+
+def get_download_session(pool_size=POOL_SIZE):
+    """
+    Returns the shared requests.Session for file downloads, e.g. the export ZIPs.
+    The files may be served by another host than the API, so the session has no JSESSIONID cookie,
+    and a download neither uses the rate limiter nor the retries of the API client (see download_file).
+    """
+    global _download_session
+    with _download_session_lock:
+        if _download_session is None:
+            _download_session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            _download_session.mount("https://", adapter)
+            _download_session.mount("http://", adapter)
+        return _download_session
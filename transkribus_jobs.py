@@ -0,0 +1,241 @@
+import time
+import random
+import threading
+import logging
+from concurrent.futures import Future, TimeoutError
+from transkribus_client import get_client, BASE_URL
+from instrumentation import measure, get_recorder
+
+# Central job tracking for Transkribus.
+# One background thread per session polls /jobs/list once per tick and
+# resolves the futures of everyone waiting for a document or a job,
+# instead of every waiter downloading the full job list on its own.
+
+DEFAULT_JOB_TYPES = ("LAJob", "TextRecognitionJob", "UploadJob")
+FINAL_STATES = ("FINISHED", "FAILED", "CANCELED")
+
+logger = logging.getLogger(__name__)
+
+_trackers = {}
+_trackers_lock = threading.Lock()
+
+
+def job_timing(job):
+    """Returns (run seconds, queue seconds) of a finished job from its create/start/end times (ms), None if unknown."""
+    try:
+        created, started, ended = (int(job[key]) for key in ("createTime", "startTime", "endTime"))
+    except (KeyError, TypeError, ValueError):
+        return None
+    return max(0, ended - started) / 1000, max(0, started - created) / 1000
+
+
+def open_jobs(jobs, doc_id=None, job_types=DEFAULT_JOB_TYPES):
+    """Returns the jobs of a job list that aren't in a final state yet, for one document or all (doc_id None)."""
+    return [
+        job for job in jobs
+        if (doc_id is None or job.get("docId") == doc_id)
+        and job.get("state") not in FINAL_STATES
+        and job.get("jobType") in job_types
+    ]
+
+
+class JobTracker:
+    """
+    Polls the job list of one session and fans the result out to waiters.
+    The poll interval starts at min_interval, grows by backoff while no job changes
+    its state and drops back to min_interval as soon as something happens.
+    Every interval gets a random jitter, so several trackers don't poll in lockstep.
+    """
+
+    def __init__(self, session_id, min_interval=2, max_interval=30, backoff=1.5, jitter=0.2, max_errors=5):
+        self.session_id = session_id
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.jitter = jitter
+        self.max_errors = max_errors
+
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._doc_waiters = []  # (doc_id, job_types, registered_at, future)
+        self._job_waiters = {}  # job_id -> [future, ...]
+        self._states = {}
+        self._thread = None
+
+    def wait_for_document(self, doc_id=None, job_types=DEFAULT_JOB_TYPES, timeout=None):
+        """
+        Blocks until no job of the given types is open for doc_id.
+        If doc_id is None, it waits until no such job is open at all.
+
+        :return: True once all relevant jobs are done
+        """
+        future = Future()
+        waiter = (doc_id, tuple(job_types), time.monotonic(), future)
+        with self._lock:
+            self._doc_waiters.append(waiter)
+        self._ensure_running()
+        try:
+            return future.result(timeout=timeout)
+        except TimeoutError:
+            with self._lock:
+                if waiter in self._doc_waiters:
+                    self._doc_waiters.remove(waiter)
+            raise
+
+    def wait_for_job(self, job_id, timeout=None):
+        """
+        Blocks until the job reaches a final state (FINISHED, FAILED, CANCELED).
+
+        :return: The job status as returned by the server
+        """
+        future = Future()
+        with self._lock:
+            self._job_waiters.setdefault(str(job_id), []).append(future)
+        self._ensure_running()
+        try:
+            return future.result(timeout=timeout)
+        except TimeoutError:
+            self._remove_job_waiter(str(job_id), future)
+            raise
+
+    def _remove_job_waiter(self, job_id, future):
+        """Drops the future of a waiter that gave up, so the job isn't polled for it any longer."""
+        with self._lock:
+            waiters = self._job_waiters.get(job_id, [])
+            if future in waiters:
+                waiters.remove(future)
+            if not waiters:
+                self._job_waiters.pop(job_id, None)
+
+    def _ensure_running(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="transkribus-job-tracker", daemon=True)
+                self._thread.start()
+            else:
+                self._wakeup.set()
+
+    def _has_waiters(self):
+        with self._lock:
+            return bool(self._doc_waiters or self._job_waiters)
+
+    def _run(self):
+        interval = self.min_interval
+        errors = 0
+        last_poll = 0.0
+
+        while self._has_waiters():
+            # new waiters wake the thread, but never poll faster than min_interval
+            wait = max(0.0, last_poll + self.min_interval - time.monotonic())
+            if wait:
+                time.sleep(wait)
+            last_poll = time.monotonic()
+
+            try:
+                changed = self._poll()
+                errors = 0
+            except Exception as e:
+                errors += 1
+                logger.warning(f"[!] Error retrieving job status ({errors}/{self.max_errors}): {e}")
+                if errors >= self.max_errors:
+                    self._fail_all(e)
+                    break
+                changed = False
+
+            interval = self.min_interval if changed else min(interval * self.backoff, self.max_interval)
+            delay = interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+            self._wakeup.clear()
+            if self._has_waiters():
+                self._wakeup.wait(delay)
+
+        with self._lock:
+            self._thread = None
+        # a waiter may have registered while the thread was shutting down
+        if self._has_waiters():
+            self._ensure_running()
+
+    def _poll(self):
+        client = get_client(self.session_id)
+        polled_at = time.monotonic()
+        with measure("job_poll"):
+            response = client.get(f"{BASE_URL}/jobs/list")
+            if response.status_code != 200:
+                raise Exception(f"{response.status_code} - {response.text}")
+            jobs = response.json()
+
+        states = {str(job.get("jobId")): job.get("state") for job in jobs}
+        changed = states != self._states
+        self._record_finished(jobs)
+        self._states = states
+        by_id = {str(job.get("jobId")): job for job in jobs}
+
+        with self._lock:
+            job_waiters = dict(self._job_waiters)
+
+        # waited-for jobs that are missing in the list (e.g. older ones) or just ended
+        # are asked for directly, only the single job status carries the full result
+        for job_id in job_waiters:
+            if job_id not in by_id or by_id[job_id].get("state") in FINAL_STATES:
+                status_response = client.get(f"{BASE_URL}/jobs/{job_id}")
+                if status_response.status_code == 200:
+                    by_id[job_id] = status_response.json()
+
+        with self._lock:
+            remaining = []
+            for waiter in self._doc_waiters:
+                doc_id, job_types, registered_at, future = waiter
+                # only a job list requested after the waiter registered is conclusive
+                if registered_at > polled_at:
+                    remaining.append(waiter)
+                    continue
+                if open_jobs(jobs, doc_id, job_types):
+                    remaining.append(waiter)
+                else:
+                    future.set_result(True)
+            self._doc_waiters = remaining
+
+            for job_id, job in by_id.items():
+                if job_id in self._job_waiters and job.get("state") in FINAL_STATES:
+                    for future in self._job_waiters.pop(job_id):
+                        future.set_result(job)
+
+            open_count = sum(1 for state in states.values() if state not in FINAL_STATES)
+            logger.info(f"Open Jobs: {open_count}, waiting: {len(self._doc_waiters)} documents, {len(self._job_waiters)} jobs")
+
+        return changed
+
+    def _record_finished(self, jobs):
+        """Records run and queue time of the jobs that reached a final state since the last poll."""
+        for job in jobs:
+            if job.get("state") not in FINAL_STATES:
+                continue
+            previous = self._states.get(str(job.get("jobId")))
+            # on the first poll every unknown job is old, later it is a job that ran between two polls
+            if previous in FINAL_STATES or (previous is None and not self._states):
+                continue
+            timing = job_timing(job)
+            if timing is not None:
+                get_recorder().record(
+                    f"job:{job.get('jobType')}", timing[0], queue_seconds=timing[1],
+                    error=job.get("state") != "FINISHED",
+                )
+
+    def _fail_all(self, error):
+        with self._lock:
+            futures = [future for _, _, _, future in self._doc_waiters]
+            futures += [future for waiters in self._job_waiters.values() for future in waiters]
+            self._doc_waiters = []
+            self._job_waiters = {}
+        for future in futures:
+            future.set_exception(Exception(f"Job polling failed: {error}"))
+
+
+def get_job_tracker(session_id):
+    """Returns the shared JobTracker for a session ID and creates it on first use."""
+    with _trackers_lock:
+        tracker = _trackers.get(session_id)
+        if tracker is None:
+            tracker = JobTracker(session_id)
+            _trackers[session_id] = tracker
+        return tracker
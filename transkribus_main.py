@@ -1,29 +1,57 @@
 from prefect import flow, task
+from prefect.task_runners import ThreadPoolTaskRunner
 from transkribus_tasks import (
     get_session_id,
     get_collections,
     get_documents_in_collection,
     filter_new_documents,
     get_page_ids,
+    get_pages,
     start_layout_analysis,
+    start_layout_analysis_batch,
     start_ocr,
     wait_for_jobs,
+    wait_for_job,
     export_and_download,
     upload_all_documents,
     upload_to_transkribus_via_ftp,
     filter_new_documents,
     wait_for_documents_to_appear
 )
+from state_store import (
+    StateStore,
+    STATE_DB,
+    STAGE_NEW,
+    STAGE_LA_STARTED,
+    STAGE_LA_DONE,
+    STAGE_OCR_STARTED,
+    STAGE_OCR_DONE,
+    STAGE_EXPORTED,
+    listing_signature,
+    page_checksums
+)
 
 """
-from git_issues.git_tasks import (
+from git_tasks import (
     create_issue_on_gitlab,
     update_gitlab_issue,
     close_gitlab_issue
 )
 """
+from pipeline import StagedPipeline
+from instrumentation import get_recorder, report_metrics
+from contextlib import nullcontext
 import os
 
+# upper bound for documents that run through LA -> OCR -> export at the same time
+MAX_CONCURRENT_DOCUMENTS = int(os.getenv("MAX_CONCURRENT_DOCUMENTS", "8"))
+
+# limits per stage of the pipelined mode
+PIPELINE_LA_LIMIT = int(os.getenv("PIPELINE_LA_LIMIT", "20"))
+PIPELINE_OCR_LIMIT = int(os.getenv("PIPELINE_OCR_LIMIT", "20"))
+PIPELINE_EXPORT_LIMIT = int(os.getenv("PIPELINE_EXPORT_LIMIT", "4"))
+PIPELINE_POST_EXPORT_LIMIT = int(os.getenv("PIPELINE_POST_EXPORT_LIMIT", "2"))
+
 @task
 def login():
     return get_session_id()
@@ -53,8 +81,8 @@ def fetch_documents(session_id, col_id):
     return get_documents_in_collection(session_id, col_id)
 
 @task
-def filter_new_docs_task(session_id, col_id, doc_ids):
-    return filter_new_documents(session_id, col_id, doc_ids)
+def filter_new_docs_task(session_id, col_id, doc_ids, documents=None):
+    return filter_new_documents(session_id, col_id, doc_ids, documents)
 
 
 @task
@@ -77,36 +105,273 @@ def wait_for_completion(session_id, doc_id):
 def export_doc(session_id, col_id, doc_id):
     export_and_download(session_id, col_id, doc_id)
 
-@flow
-def transkribus_workflow():
+@task
+def analyze_layout_batch(session_id, col_id, doc_ids, state_db=STATE_DB):
+    """
+    Starts the layout analysis for all documents of doc_ids that are still new,
+    with as few submissions as possible. The documents are recorded as la_started,
+    so process_document continues with waiting for the LA job.
+    """
+    store = StateStore(state_db)
+    documents = {}
+    for doc_id in doc_ids:
+        state = store.get_document(col_id, doc_id) or {}
+        if state.get("stage", STAGE_NEW) != STAGE_NEW:
+            continue
+        pages = get_pages(session_id, col_id, doc_id, keep_cached=True)
+        if not pages:
+            continue
+        documents[doc_id] = [page["pageId"] for page in pages]
+        store.update_document(col_id, doc_id, page_checksums=page_checksums(pages))
+
+    job_ids = start_layout_analysis_batch(session_id, col_id, documents)
+    for doc_id, job_id in job_ids.items():
+        store.update_document(col_id, doc_id, stage=STAGE_LA_STARTED, la_job_id=job_id)
+    return job_ids
+
+def prepare_document(session_id, col_id, doc_id, store):
+    """
+    Loads the pages of a document and its stored stage.
+    A document whose pages changed since the last run starts again at the first stage.
+
+    :return: (stage, page_ids) or (None, []) if the document has no pages
+    """
+    state = store.get_document(col_id, doc_id) or {}
+
+    pages = get_pages(session_id, col_id, doc_id)
+    if not pages:
+        print(f"No pages found for document {doc_id}, skipping.")
+        return None, []
+    page_ids = [page["pageId"] for page in pages]
+    checksums = page_checksums(pages)
+
+    stage = state.get("stage", STAGE_NEW)
+    if state.get("page_checksums") and state["page_checksums"] != checksums:
+        print(f"Pages of document {doc_id} changed, processing it again.")
+        store.reset_document(col_id, doc_id)
+        stage = STAGE_NEW
+    store.update_document(col_id, doc_id, page_checksums=checksums)
+
+    if stage == STAGE_EXPORTED:
+        print(f"Document {doc_id} was already exported to {state.get('export_path')}, skipping.")
+    return stage, page_ids
+
+def finish_job(session_id, col_id, doc_id, store, job_field, retry_stage):
+    """
+    Waits for the job stored in job_field of a document.
+    Only a FINISHED job completes the stage. A failed or canceled job (or a missing job ID)
+    sets the document back to retry_stage, so the job is submitted again on the next run.
+    If the wait itself fails, the stage stays as it is and the next run waits again.
+
+    :return: True if the job finished
+    """
+    job_id = store.get_document(col_id, doc_id).get(job_field)
+    if not job_id:
+        print(f"No {job_field} stored for document {doc_id}, starting the job again.")
+        store.update_document(col_id, doc_id, stage=retry_stage)
+        return False
+
+    status = wait_for_job(session_id, job_id)
+    if status is None:
+        return False
+    state = status.get("state")
+    if state != "FINISHED":
+        print(f"Job {job_id} of document {doc_id} ended with state {state}, it is started again on the next run.")
+        store.update_document(col_id, doc_id, stage=retry_stage, **{job_field: None})
+        return False
+    return True
+
+def advance_layout_analysis(session_id, col_id, doc_id, page_ids, stage, store):
+    """Starts the LA (if not done yet) and waits for it. Returns the new stage or None on errors."""
+    if stage == STAGE_NEW:
+        job_id = start_layout_analysis(session_id, col_id, doc_id, page_ids)
+        if job_id is None:
+            return None
+        stage = STAGE_LA_STARTED
+        store.update_document(col_id, doc_id, stage=stage, la_job_id=job_id)
+    if stage == STAGE_LA_STARTED:
+        # a batched LA job doesn't list the docIds, so wait for the job itself
+        if not finish_job(session_id, col_id, doc_id, store, "la_job_id", STAGE_NEW):
+            return None
+        stage = STAGE_LA_DONE
+        store.update_document(col_id, doc_id, stage=stage)
+    return stage
+
+def advance_ocr(session_id, col_id, doc_id, page_ids, stage, store):
+    """Starts the OCR (if not done yet) and waits for it. Returns the new stage or None on errors."""
+    if stage == STAGE_LA_DONE:
+        job_id = start_ocr(session_id, col_id, doc_id, page_ids)
+        if job_id is None:
+            return None
+        stage = STAGE_OCR_STARTED
+        store.update_document(col_id, doc_id, stage=stage, ocr_job_id=job_id)
+    if stage == STAGE_OCR_STARTED:
+        if not finish_job(session_id, col_id, doc_id, store, "ocr_job_id", STAGE_LA_DONE):
+            return None
+        stage = STAGE_OCR_DONE
+        store.update_document(col_id, doc_id, stage=stage)
+    return stage
+
+def advance_export(session_id, col_id, doc_id, stage, store):
+    """Exports and downloads a document after its OCR. Returns the new stage or None on errors."""
+    if stage == STAGE_OCR_DONE:
+        export_path = export_and_download(session_id, col_id, doc_id)
+        if export_path is None:
+            return None
+        stage = STAGE_EXPORTED
+        store.update_document(col_id, doc_id, stage=stage, export_path=export_path)
+    return stage
+
+@task
+def process_document(session_id, col_id, doc_id, state_db=STATE_DB):
+    """
+    Runs the complete LA -> OCR -> export chain for a single document.
+    Submitted once per document, so that documents don't wait for each other.
+    Every finished step is recorded in the state store, an interrupted document
+    continues at the stage where it stopped. Exported documents are skipped
+    unless their pages changed.
+    """
+    store = StateStore(state_db)
+    stage, page_ids = prepare_document(session_id, col_id, doc_id, store)
+    if stage is None:
+        return None
+    stage = advance_layout_analysis(session_id, col_id, doc_id, page_ids, stage, store)
+    if stage is None:
+        return None
+    stage = advance_ocr(session_id, col_id, doc_id, page_ids, stage, store)
+    if stage is None:
+        return None
+    if advance_export(session_id, col_id, doc_id, stage, store) is None:
+        return None
+    return doc_id
+
+def run_pipeline(session_id, documents, state_db=STATE_DB, post_export=None):
+    """
+    Processes (col_id, doc_id) pairs in a staged pipeline: LA, OCR, export and an optional
+    post_export(col_id, doc_id, export_path) step each have their own queue and limit.
+    A document moves on as soon as its job in the previous stage is finished.
+
+    :return: (results, errors) of StagedPipeline.run
+    """
+    store = StateStore(state_db)
+
+    def la_stage(item, _):
+        col_id, doc_id = item
+        stage, page_ids = prepare_document(session_id, col_id, doc_id, store)
+        if stage is None:
+            return None
+        stage = advance_layout_analysis(session_id, col_id, doc_id, page_ids, stage, store)
+        return (stage, page_ids) if stage else None
+
+    def ocr_stage(item, value):
+        col_id, doc_id = item
+        stage, page_ids = value
+        stage = advance_ocr(session_id, col_id, doc_id, page_ids, stage, store)
+        return stage
+
+    def export_stage(item, stage):
+        col_id, doc_id = item
+        stage = advance_export(session_id, col_id, doc_id, stage, store)
+        if stage is None:
+            return None
+        return store.get_document(col_id, doc_id)["export_path"]
+
+    def post_export_stage(item, export_path):
+        col_id, doc_id = item
+        post_export(col_id, doc_id, export_path)
+        return export_path
+
+    stages = [
+        ("la", la_stage, PIPELINE_LA_LIMIT),
+        ("ocr", ocr_stage, PIPELINE_OCR_LIMIT),
+        ("export", export_stage, PIPELINE_EXPORT_LIMIT),
+    ]
+    if post_export is not None:
+        stages.append(("post_export", post_export_stage, PIPELINE_POST_EXPORT_LIMIT))
+    return StagedPipeline(stages).run(documents)
+
+@flow(task_runner=ThreadPoolTaskRunner(max_workers=MAX_CONCURRENT_DOCUMENTS))
+def transkribus_workflow(concurrent=True, batch_la=True, pipelined=False, state_db=STATE_DB, to_tei=False, upload=True):
+    """
+    Uploads new material and processes every new document.
+    With concurrent=True each document is submitted as its own task run,
+    the number of documents in flight is limited by MAX_CONCURRENT_DOCUMENTS.
+    Collections whose listing didn't change since the last run aren't checked
+    for new documents again, documents interrupted in an earlier run are resumed.
+    With batch_la the layout analysis of all new documents of a collection is
+    submitted in a few batches instead of once per document.
+    With pipelined all documents go through a staged pipeline instead, where LA, OCR
+    and export have their own queues and limits (see run_pipeline).
+    With pipelined and to_tei every export is converted to TEI in a post-export stage (see tei_tasks).
+    Timing, bytes, retries and job queue times of the run are published as artifact and written to METRICS_DIR at the end.
+    With upload=False the upload of new material is skipped and only the documents on the server are processed.
+    """
     # issue_id = create_issue_on_gitlab(
     #     title="Transkribus Flow started",
     #     description="Workflow with upload and complete processing."
     # )
     issue_id = None  # None in case issues aren't used
+    get_recorder().reset()  # metrics of this run only, the worker process may run several flows
 
     try:
         session_id = login()
 
-        collection_id_for_upload = 1992893
-        local_upload_path = "upload"  
-        uploaded_titles = upload_documents_task(session_id, collection_id_for_upload, local_upload_path)
+        if upload:
+            collection_id_for_upload = 1992893
+            local_upload_path = "upload"  
+            uploaded_titles = upload_documents_task(session_id, collection_id_for_upload, local_upload_path)
 
-        wait_for_completion(session_id, None)  # wait for upload process
-        wait_for_documents_to_appear_task(session_id, collection_id_for_upload, uploaded_titles)
+            wait_for_completion(session_id, None)  # wait for upload process
+            wait_for_documents_to_appear_task(session_id, collection_id_for_upload, uploaded_titles)
+        store = StateStore(state_db)
         collections = fetch_collections(session_id)
+        futures = []
+        pipeline_documents = []
         for col_id, col_name in collections:
             documents = fetch_documents(session_id, col_id)
-            all_doc_ids = [doc.get("docId") for doc in documents]
-            new_doc_ids = filter_new_docs_task(session_id, col_id, all_doc_ids)
+            signature = listing_signature(documents)
+            if store.collection_unchanged(col_id, signature):
+                print(f"Collection {col_id} unchanged since the last run.")
+                new_doc_ids = []
+            else:
+                all_doc_ids = [doc.get("docId") for doc in documents]
+                new_doc_ids = filter_new_docs_task(session_id, col_id, all_doc_ids, documents)
+                # register them before the listing is marked as checked
+                for doc_id in new_doc_ids:
+                    store.update_document(col_id, doc_id)
+                store.save_collection(col_id, signature)
             print(new_doc_ids)
-            for doc_id in new_doc_ids:
-                page_ids = fetch_page_ids(session_id, col_id, doc_id)
-                analyze_layout(session_id, col_id, doc_id, page_ids)
-                wait_for_completion(session_id, doc_id)  # wait for lajob
-                perform_ocr(session_id, col_id, doc_id, page_ids)
-                wait_for_completion(session_id, doc_id)  # wait for ocr
-                export_doc(session_id, col_id, doc_id)
+
+            doc_ids = new_doc_ids + [doc_id for doc_id in store.unfinished_documents(col_id) if doc_id not in new_doc_ids]
+            if batch_la and doc_ids:
+                analyze_layout_batch(session_id, col_id, doc_ids, state_db)
+            if pipelined:
+                pipeline_documents.extend((col_id, doc_id) for doc_id in doc_ids)
+                continue
+            if concurrent:
+                futures.extend(process_document.submit(session_id, col_id, doc_id, state_db) for doc_id in doc_ids)
+                continue
+            for doc_id in doc_ids:
+                process_document(session_id, col_id, doc_id, state_db)
+
+        # wait for all submitted documents, raises if one of them failed
+        for future in futures:
+            future.result()
+
+        if pipeline_documents:
+            post_export = None
+            reporting = nullcontext()
+            if to_tei:
+                # imported here, tei_tasks pulls in the eXist and GitLab modules
+                from tei_tasks import page_to_tei
+                from git_tasks import run_reporter
+                post_export = lambda col_id, doc_id, export_path: page_to_tei.fn(export_path)
+                # failed conversions of this run go into its own summary issue
+                reporting = run_reporter("Transkribus workflow")
+            with reporting:
+                _, errors = run_pipeline(session_id, pipeline_documents, state_db, post_export)
+            if errors:
+                raise Exception(f"Pipeline failed for {len(errors)} documents: {errors}")
 
         # close_gitlab_issue(issue_id, success_message="Workflow concluded successfully. All documents processed.")
 
@@ -114,5 +379,8 @@ def transkribus_workflow():
         # update_gitlab_issue(issue_id, f"Error in workflow: {str(e)}")
         raise
 
+    finally:
+        report_metrics()
+
 if __name__ == "__main__":
     transkribus_workflow()
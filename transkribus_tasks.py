@@ -10,41 +10,127 @@ import hashlib
 import urllib.parse
 from ftplib import FTP
 import zipfile
+import threading
+import io
+import uuid
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from transkribus_client import get_client, get_download_session, get_session_manager, BASE_URL
+from transkribus_jobs import get_job_tracker, DEFAULT_JOB_TYPES
+from state_store import StateStore, STATE_DB, checksums_digest
+from instrumentation import measure
 
-BASE_URL = "https://transkribus.eu/TrpServer/rest"
 load_dotenv()
 
 # Logging 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# max. number of parallel /fulldoc requests while looking for new documents
+FULLDOC_WORKERS = int(os.getenv("TRANSKRIBUS_FULLDOC_WORKERS", "8"))
 
-def upload_to_transkribus_via_ftp(session_id, ftp_username, ftp_password, collection_id, local_dir):
+# fulldocs of new documents, kept so get_page_ids doesn't download them again
+_fulldoc_cache = {}
+_fulldoc_cache_lock = threading.Lock()
+
+# FTP upload: number of parallel connections and block size per write
+FTP_HOST = os.getenv("TRANSKRIBUS_FTP_HOST", "transkribus.eu")
+FTP_CONNECTIONS = int(os.getenv("TRANSKRIBUS_FTP_CONNECTIONS", "4"))
+FTP_BLOCKSIZE = 1024 * 1024
+
+# REST upload: parallel folders, parallel pages per folder and hashing
+UPLOAD_FOLDER_WORKERS = int(os.getenv("TRANSKRIBUS_UPLOAD_FOLDERS", "2"))
+UPLOAD_PAGE_WORKERS = int(os.getenv("TRANSKRIBUS_UPLOAD_PAGES", "4"))
+HASH_WORKERS = int(os.getenv("TRANSKRIBUS_HASH_WORKERS", "0"))
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# export download: target directory, bytes per read and attempts before giving up
+DOWNLOAD_DIR = os.getenv("TRANSKRIBUS_DOWNLOAD_DIR", "downloads")
+DOWNLOAD_CHUNK_SIZE = int(os.getenv("TRANSKRIBUS_DOWNLOAD_CHUNK_SIZE", str(8 * 1024 * 1024)))
+DOWNLOAD_ATTEMPTS = 3
+
+
+def list_remote_sizes(ftp):
+    """
+    Lists the current FTP directory once and returns {filename: size}.
+    Uses MLSD to get the sizes in the same round trip, if the server doesn't
+    support it the names come from NLST and the sizes are None.
+    """
+    try:
+        return {
+            name: int(facts["size"]) if "size" in facts else None
+            for name, facts in ftp.mlsd(facts=["type", "size"])
+            if facts.get("type", "file") == "file"
+        }
+    except Exception:
+        return {os.path.basename(name): None for name in ftp.nlst()}
+
+
+
+def upload_file_via_ftp(ftp, local_path, remote_size=None):
+    """
+    Uploads a single file to the current directory of the FTP connection.
+    A partial remote file is resumed with REST, a complete one is skipped.
+
+    :param ftp: Logged in FTP connection
+    :param local_path: Path of the local file
+    :param remote_size: Size of the remote file if known, None if it has to be asked for
+    :return: Number of bytes sent
+    """
+    filename = os.path.basename(local_path)
+    local_size = os.path.getsize(local_path)
+
+    if remote_size is None:
+        try:
+            remote_size = ftp.size(filename)
+        except Exception:
+            remote_size = 0  # doesn't exist yet
+
+    if remote_size == local_size:
+        logger.info(f"[-] File skipped (already exists): {filename}")
+        return 0
+
+    offset = remote_size if 0 < remote_size < local_size else 0
+    start = time.time()
+    with measure("ftp_upload") as measurement, open(local_path, "rb") as file:
+        file.seek(offset)
+        ftp.storbinary(f"STOR {filename}", file, blocksize=FTP_BLOCKSIZE, rest=offset or None)
+        measurement.bytes = local_size - offset
+    elapsed = max(time.time() - start, 1e-6)
+
+    sent_mb = (local_size - offset) / (1024 * 1024)
+    resumed = f", resumed at byte {offset}" if offset else ""
+    logger.info(f"[+] File uploaded: {filename} ({sent_mb:.1f} MB in {elapsed:.1f} s, {sent_mb / elapsed:.2f} MB/s{resumed})")
+    return local_size - offset
+
+
+
+def upload_to_transkribus_via_ftp(session_id, ftp_username, ftp_password, collection_id, local_dir, connections=FTP_CONNECTIONS):
     """
     Uploads files to Transkribus via FTP and triggers ingestion into a specified collection.
     Expects a valid session ID (e.g., from get_session_id).
+    The remote directory is listed once, the files are uploaded over a pool of
+    parallel FTP connections and partial uploads from earlier runs are resumed.
 
     :param session_id: Active Transkribus session ID
     :param ftp_username: Transkribus FTP username
     :param ftp_password: Transkribus FTP password
     :param collection_id: ID of the target collection in Transkribus
     :param local_dir: Full path to the local upload directory
+    :param connections: Number of parallel FTP connections
     :return: List of uploaded document titles if successful, otherwise []
     """
 
     try:
-        headers = {"Cookie": f"JSESSIONID={session_id}"}
-        session = requests.Session()
-        session.headers.update(headers)
-
-        # create ftp-connection
-        ftp = FTP("transkribus.eu")
-        ftp.login(user=ftp_username, passwd=ftp_password)
+        session = get_client(session_id)
 
         if not os.path.exists(local_dir):
             logger.error(f"[!] Local directory couldn't be found: {local_dir}")
             return []
 
+        # create ftp-connection
+        ftp = FTP(FTP_HOST)
+        ftp.login(user=ftp_username, passwd=ftp_password)
+
         shorthand = os.path.basename(local_dir)
         ftp_dir = f"/{shorthand}"
         try:
@@ -53,14 +139,47 @@ def upload_to_transkribus_via_ftp(session_id, ftp_username, ftp_password, collec
             ftp.mkd(ftp_dir)
             ftp.cwd(ftp_dir)
 
-        for filename in os.listdir(local_dir):
-            local_path = os.path.join(local_dir, filename)
-            if os.path.isfile(local_path) and filename not in ftp.nlst():
-                with open(local_path, "rb") as file:
-                    ftp.storbinary(f"STOR {filename}", file)
-                logger.info(f"[+] File uploaded: {filename}")
-            else:
-                logger.info(f"[-] File skipped (already exists): {filename}")
+        remote_sizes = list_remote_sizes(ftp)
+        ftp.quit()
+
+        local_paths = [
+            os.path.join(local_dir, filename)
+            for filename in sorted(os.listdir(local_dir))
+            if os.path.isfile(os.path.join(local_dir, filename))
+        ]
+
+        # one FTP connection per worker thread, opened on first use
+        local = threading.local()
+        open_connections = []
+        connections_lock = threading.Lock()
+
+        def upload(local_path):
+            ftp = getattr(local, "ftp", None)
+            if ftp is None:
+                ftp = FTP(FTP_HOST)
+                ftp.login(user=ftp_username, passwd=ftp_password)
+                ftp.cwd(ftp_dir)
+                local.ftp = ftp
+                with connections_lock:
+                    open_connections.append(ftp)
+            filename = os.path.basename(local_path)
+            # files missing in the listing don't exist remotely, no need to ask for their size
+            return upload_file_via_ftp(ftp, local_path, remote_sizes.get(filename, 0))
+
+        start = time.time()
+        try:
+            with ThreadPoolExecutor(max_workers=connections) as pool:
+                sent = sum(pool.map(upload, local_paths))
+        finally:
+            for connection in open_connections:
+                try:
+                    connection.quit()
+                except Exception:
+                    connection.close()
+
+        elapsed = max(time.time() - start, 1e-6)
+        sent_mb = sent / (1024 * 1024)
+        logger.info(f"[+] FTP upload of '{shorthand}' done: {sent_mb:.1f} MB in {elapsed:.1f} s ({sent_mb / elapsed:.2f} MB/s)")
 
         # start ingest by API
         encoded_name = urllib.parse.quote(shorthand)
@@ -77,80 +196,242 @@ def upload_to_transkribus_via_ftp(session_id, ftp_username, ftp_password, collec
 
 
 
-def upload_all_documents(session_id, collection_id, main_dir):
+SUPPORTED_IMAGE_EXT = [".jpg", ".jpeg", ".tif", ".tiff"]
+
+
+
+def calculate_md5(file_path, chunk_size=HASH_CHUNK_SIZE, store=None):
+    """
+    Calculates the MD5 of a file in chunks, so only chunk_size bytes are held in memory.
+    If a StateStore is given, a checksum stored for the same path, size and mtime is used instead.
+    """
+    if store is not None:
+        return calculate_checksums([file_path], store=store)[0]
+
+    md5 = hashlib.md5()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+
+def calculate_checksums(paths, hash_workers=HASH_WORKERS, store=None):
+    """
+    Calculates the MD5 of every path.
+    With hash_workers > 1 the files are hashed in a process pool, otherwise one after another.
+    If a StateStore is given, only files that are new or changed (size, mtime) are read,
+    the checksums of all others come from the store.
+    """
+    stats = {}
+    for path in paths:
+        stat = os.stat(path)
+        stats[os.path.abspath(path)] = (stat.st_size, stat.st_mtime_ns)
+
+    known = store.get_checksums(stats) if store is not None else {}
+    missing = [path for path in paths if os.path.abspath(path) not in known]
+
+    if hash_workers and hash_workers > 1 and len(missing) > 1:
+        with ProcessPoolExecutor(max_workers=hash_workers) as pool:
+            hashed = dict(zip(missing, pool.map(calculate_md5, missing)))
+    else:
+        hashed = {path: calculate_md5(path) for path in missing}
+
+    if store is not None and hashed:
+        store.save_checksums({
+            os.path.abspath(path): (*stats[os.path.abspath(path)], md5)
+            for path, md5 in hashed.items()
+        })
+
+    return [known.get(os.path.abspath(path)) or hashed[path] for path in paths]
+
+
+
+def document_matches(session_id, collection_id, doc_id, checksums):
+    """True if the pages of an existing Transkribus document have exactly the given image checksums."""
+    pages = sorted(get_pages(session_id, collection_id, doc_id), key=lambda page: page.get("pageNr", 0))
+    return [page.get("md5Sum") for page in pages] == list(checksums)
+
+
+
+class MultipartFileStream:
+    """
+    multipart/form-data body with a single file part that is read from disk while it is sent.
+    requests would build the complete body in memory when using files=.
     """
-    Uploads all subfolders from a directory to Transkribus. Each subfolder becomes a separate document.
+
+    def __init__(self, field_name, file_path, content_type="application/octet-stream"):
+        boundary = uuid.uuid4().hex
+        file_name = os.path.basename(file_path)
+        head = (
+            f"--{boundary}\r\n"
+            f'Content-Disposition: form-data; name="{field_name}"; filename="{file_name}"\r\n'
+            f"Content-Type: {content_type}\r\n\r\n"
+        ).encode("utf-8")
+        tail = f"\r\n--{boundary}--\r\n".encode("utf-8")
+
+        self.content_type = f"multipart/form-data; boundary={boundary}"
+        self._length = len(head) + os.path.getsize(file_path) + len(tail)
+        self._file = open(file_path, "rb")
+        self._parts = [io.BytesIO(head), self._file, io.BytesIO(tail)]
+
+    def __len__(self):
+        return self._length
+
+    def read(self, size=-1):
+        data = b""
+        while self._parts and (size < 0 or len(data) < size):
+            chunk = self._parts[0].read(-1 if size < 0 else size - len(data))
+            if not chunk:
+                self._parts.pop(0)
+                continue
+            data += chunk
+        return data
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+
+def upload_document(session_id, collection_id, folder_path, page_workers=UPLOAD_PAGE_WORKERS, hash_workers=HASH_WORKERS,
+                    store=None, existing_docs=None):
+    """
+    Uploads the images of one folder as a new document to Transkribus.
+    The pages are streamed from disk, up to page_workers of them at the same time.
+    A folder is skipped if a document with the same title and the same page checksums
+    already exists in the collection.
 
     :param session_id: Active Transkribus session.
     :param collection_id: ID of the collection to upload to.
-    :param main_dir: Main directory containing subfolders with image files.
-    :return: List of uploaded document titles
+    :param folder_path: Folder containing the image files, its name becomes the title.
+    :param page_workers: Max. number of pages uploaded in parallel for this document.
+    :param hash_workers: Number of processes used for hashing, 0 or 1 hashes in this thread.
+    :param store: Optional StateStore with the checksum index and the uploaded folders.
+    :param existing_docs: Optional dict title -> docId of the documents already in the collection.
+    :return: The title of the uploaded document or None
     """
+    folder_name = os.path.basename(folder_path)
+    images = sorted([
+        os.path.join(folder_path, f)
+        for f in os.listdir(folder_path)
+        if os.path.splitext(f.lower())[1] in SUPPORTED_IMAGE_EXT
+    ])
 
-    def calculate_md5(file_path):
-        with open(file_path, "rb") as f:
-            return hashlib.md5(f.read()).hexdigest()
+    if not images:
+        print(f"No valid image files found in the directory: {folder_path}")
+        return None
 
-    uploaded_titles = []  # collect titles
-    for folder_name in sorted(os.listdir(main_dir)):
-        folder_path = os.path.join(main_dir, folder_name)
-        if not os.path.isdir(folder_path):
-            continue
+    try:
+        session = get_client(session_id)
+        checksums = calculate_checksums(images, hash_workers, store)
+        digest = checksums_digest(checksums)
+
+        doc_id = (existing_docs or {}).get(folder_name)
+        if doc_id is not None:
+            # the local record saves the fulldoc request, the server is only asked if there is none
+            known = store is not None and store.get_upload_digest(collection_id, folder_name) == digest
+            if known or document_matches(session_id, collection_id, doc_id, checksums):
+                if store is not None:
+                    store.save_upload(collection_id, folder_name, digest)
+                print(f"'{folder_name}' already exists as document {doc_id} with the same pages, skipped.")
+                return None
+
+        url_create = f"{BASE_URL}/uploads?collId={collection_id}"
+        payload = {
+            "md": {"title": folder_name},
+            "pageList": {
+                "pages": [
+                    {
+                        "fileName": os.path.basename(img),
+                        "pageNr": i + 1,
+                        "imgChecksum": checksum,
+                    }
+                    for i, (img, checksum) in enumerate(zip(images, checksums))
+                ]
+            }
+        }
 
-        supported_ext = [".jpg", ".jpeg", ".tif", ".tiff"]
-        images = sorted([
-            os.path.join(folder_path, f)
-            for f in os.listdir(folder_path)
-            if os.path.splitext(f.lower())[1] in supported_ext
-        ])
+        response = session.post(url_create, json=payload)
+        if response.status_code != 200:
+            raise Exception(f"Error creating the upload: {response.status_code} - {response.text}")
 
-        if not images:
-            print(f"No valid image files found in the directory: {folder_path}")
-            continue
+        root = ET.fromstring(response.text)
+        upload_id = root.find("uploadId").text
+        print(f"Upload ID received: {upload_id}")
 
-        try:
-            session = requests.Session()
-            session.headers.update({"Cookie": f"JSESSIONID={session_id}"})
-
-            url_create = f"{BASE_URL}/uploads?collId={collection_id}"
-            payload = {
-                "md": {"title": folder_name},
-                "pageList": {
-                    "pages": [
-                        {
-                            "fileName": os.path.basename(img),
-                            "pageNr": i + 1,
-                            "imgChecksum": calculate_md5(img),
-                        }
-                        for i, img in enumerate(images)
-                    ]
-                }
-            }
+        def upload_page(img):
+            url_upload = f"{BASE_URL}/uploads/{upload_id}"
+            with measure("rest_upload") as measurement, MultipartFileStream("img", img) as body:
+                response = session.put(url_upload, data=body, headers={"Content-Type": body.content_type})
+                measurement.bytes = os.path.getsize(img)
 
-            response = session.post(url_create, json=payload)
             if response.status_code != 200:
-                raise Exception(f"Error creating the upload: {response.status_code} - {response.text}")
+                raise Exception(f"Error uploading the page {img}: {response.status_code} - {response.text}")
 
-            root = ET.fromstring(response.text)
-            upload_id = root.find("uploadId").text
-            print(f"Upload ID received: {upload_id}")
+            print(f"Page {img} successfully uploaded.")
 
-            for img in images:
-                url_upload = f"{BASE_URL}/uploads/{upload_id}"
-                with open(img, "rb") as img_file:
-                    files = {"img": (os.path.basename(img), img_file, "application/octet-stream")}
-                    response = session.put(url_upload, files=files)
+        with ThreadPoolExecutor(max_workers=page_workers) as pool:
+            list(pool.map(upload_page, images))
 
-                if response.status_code != 200:
-                    raise Exception(f"Error uploading the page {img}: {response.status_code} - {response.text}")
+        print(f"Upload of '{folder_name}' with {len(images)} pages completed successfully.")
+        if store is not None:
+            store.save_upload(collection_id, folder_name, digest)
+        return folder_name
 
-                print(f"Page {img} successfully uploaded.")
+    except Exception as e:
+        print(f"Error uploading '{folder_name}': {str(e)}")
+        return None
 
-            print(f"Upload of '{folder_name}' with {len(images)} pages completed successfully.")
-            uploaded_titles.append(folder_name)  # save title
 
-        except Exception as e:
-            print(f"Error uploading '{folder_name}': {str(e)}")
+
+def upload_all_documents(session_id, collection_id, main_dir, folder_workers=UPLOAD_FOLDER_WORKERS,
+                         page_workers=UPLOAD_PAGE_WORKERS, hash_workers=HASH_WORKERS, state_db=STATE_DB):
+    """
+    Uploads all subfolders from a directory to Transkribus. Each subfolder becomes a separate document.
+    Up to folder_workers folders are uploaded at the same time.
+    Image checksums are cached in the state store by path, size and mtime, folders that
+    already exist in the collection with the same checksums are skipped.
+
+    :param session_id: Active Transkribus session.
+    :param collection_id: ID of the collection to upload to.
+    :param main_dir: Main directory containing subfolders with image files.
+    :param folder_workers: Max. number of folders uploaded in parallel.
+    :param page_workers: Max. number of pages uploaded in parallel per folder.
+    :param hash_workers: Number of processes used for hashing, 0 or 1 hashes in the upload thread.
+    :param state_db: Path of the SQLite state file, None disables the checksum cache.
+    :return: List of uploaded document titles
+    """
+    store = StateStore(state_db) if state_db else None
+    try:
+        listed = get_documents_in_collection(session_id, collection_id)
+    except Exception as e:
+        # e.g. a collection that doesn't exist yet, every folder is uploaded then
+        logger.warning(f"[!] Documents of collection {collection_id} couldn't be listed, uploading all folders: {e}")
+        listed = []
+    existing_docs = {
+        doc.get("title") or doc.get("md", {}).get("title"): doc.get("docId")
+        for doc in listed
+    }
+
+    folder_paths = [
+        os.path.join(main_dir, folder_name)
+        for folder_name in sorted(os.listdir(main_dir))
+        if os.path.isdir(os.path.join(main_dir, folder_name))
+    ]
+
+    with ThreadPoolExecutor(max_workers=folder_workers) as pool:
+        results = pool.map(
+            lambda folder_path: upload_document(session_id, collection_id, folder_path, page_workers, hash_workers,
+                                                store, existing_docs),
+            folder_paths,
+        )
+        uploaded_titles = [title for title in results if title]  # collect titles
 
     print("Upload process completed.")
     return uploaded_titles  # return list of titles
@@ -164,14 +445,14 @@ def wait_for_documents_to_appear(session_id, collection_id, expected_titles, tim
 
     """
     start = time.time()
-    headers = {"Cookie": f"JSESSIONID={session_id}"}
+    client = get_client(session_id)
     url = f"{BASE_URL}/collections/{collection_id}/list"
 
     expected = set(expected_titles)
     found = set()
 
     while time.time() - start < timeout:
-        r = requests.get(url, headers=headers)
+        r = client.get(url)
         r.raise_for_status()
         docs = r.json()
 
@@ -190,37 +471,66 @@ def wait_for_documents_to_appear(session_id, collection_id, expected_titles, tim
 
 
 
-def filter_new_documents(session_id, collection_id, doc_ids):
+def fetch_fulldoc(session_id, collection_id, doc_id):
+    """
+    Fetches the /fulldoc of a document.
+
+    :return: The parsed JSON or None if the document couldn't be loaded
+    """
+    client = get_client(session_id)
+    url = f"{BASE_URL}/collections/{collection_id}/{doc_id}/fulldoc"
+    response = client.get(url)
+
+    if response.status_code != 200:
+        logger.warning(f"Document {doc_id} couldn't be loaded: {response.status_code}")
+        return None
+
+    try:
+        return response.json()
+    except Exception as e:
+        logger.warning(f"Error while processing the document {doc_id}: {e}")
+        return None
+
+
+
+def filter_new_documents(session_id, collection_id, doc_ids, documents=None, max_workers=FULLDOC_WORKERS):
     """
     Checks a list of documents to determine which have the status "New"
     and returns only those document IDs.
+    If the collection listing (documents) already contains nrOfNew, no further request is made.
+    Otherwise the fulldocs are fetched in parallel and kept for get_page_ids.
 
     :param session_id: Transkribus session ID
     :param collection_id: ID of the collection
     :param doc_ids: List of document IDs
+    :param documents: Optional result of get_documents_in_collection for the same collection
+    :param max_workers: Max. number of parallel /fulldoc requests
     :return: List of document IDs with status "New"
     """
-    headers = {"Cookie": f"JSESSIONID={session_id}"}
-    new_doc_ids = []
+    listed = {doc.get("docId"): doc for doc in documents or []}
+    new_ids = set()
+    unknown_ids = []
 
     for doc_id in doc_ids:
-        url = f"{BASE_URL}/collections/{collection_id}/{doc_id}/fulldoc"
-        response = requests.get(url, headers=headers)
-
-        if response.status_code != 200:
-            logger.warning(f"Document {doc_id} couldn't be loaded: {response.status_code}")
-            continue
-
-        try:
-            data = response.json()
-            md = data.get("md", {})
-            if md.get("nrOfNew", 0) > 0:
-                new_doc_ids.append(doc_id)
-
-        except Exception as e:
-            logger.warning(f"Error while processing the document {doc_id}: {e}")
-            continue
-
+        md = listed.get(doc_id, {})
+        if "nrOfNew" in md:
+            if md["nrOfNew"] > 0:
+                new_ids.add(doc_id)
+        else:
+            unknown_ids.append(doc_id)
+
+    if unknown_ids:
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            fulldocs = pool.map(lambda doc_id: fetch_fulldoc(session_id, collection_id, doc_id), unknown_ids)
+            for doc_id, data in zip(unknown_ids, fulldocs):
+                if data is None:
+                    continue
+                if data.get("md", {}).get("nrOfNew", 0) > 0:
+                    new_ids.add(doc_id)
+                    with _fulldoc_cache_lock:
+                        _fulldoc_cache[(collection_id, doc_id)] = data
+
+    new_doc_ids = [doc_id for doc_id in doc_ids if doc_id in new_ids]
     logger.info(f"[+] Found 'New'-documents: {new_doc_ids}")
     return new_doc_ids
 
@@ -228,34 +538,20 @@ def filter_new_documents(session_id, collection_id, doc_ids):
 
 def get_session_id():
     """
-    Performs the login to Transkribus and returns the session ID.
+    Returns a Transkribus session ID.
+    The login happens lazily through the shared SessionManager: a session cached on disk
+    by an earlier run is reused while it's valid, expired sessions are renewed automatically.
     """
-    email = os.getenv("TRANSKRIBUS_EMAIL")
-    password = os.getenv("TRANSKRIBUS_PASSWORD")
-    
-    if not email or not password:
-        raise Exception("Missing login credentials: Please ensure that the .env file is correct.")
-    
-    session = requests.Session()
-    response = session.post(f"{BASE_URL}/auth/login", data={"user": email, "pw": password})
-
-    if response.status_code != 200:
-        raise Exception(f"Login failed: {response.status_code} - {response.text}")
-
-    try:
-        root = etree.fromstring(response.content)
-        session_id = root.find("sessionId").text
-        print("Successfully logged in! Session-ID:", session_id)
-        return session_id
-    except etree.ParseError:
-        raise Exception("Error: The XML response could not be parsed.")
+    session_id = get_session_manager().session_id()
+    print("Successfully logged in! Session-ID:", session_id)
+    return session_id
 
 
 
 def get_collections(session_id):
     """Fetches all collections as a list of tuples (ID, Name)."""
-    headers = {"Cookie": f"JSESSIONID={session_id}"}
-    response = requests.get(f"{BASE_URL}/collections/list", headers=headers)
+    client = get_client(session_id)
+    response = client.get(f"{BASE_URL}/collections/list")
 
     if response.status_code != 200:
         raise Exception(f"Error retrieving the collections: {response.status_code} - {response.text}")
@@ -271,9 +567,9 @@ def get_collections(session_id):
 
 def get_documents_in_collection(session_id, collection_id):
     """Fetches all documents from a specific collection."""
-    headers = {"Cookie": f"JSESSIONID={session_id}"}
+    client = get_client(session_id)
     url = f"{BASE_URL}/collections/{collection_id}/list"
-    response = requests.get(url, headers=headers)
+    response = client.get(url)
 
     if response.status_code != 200:
         raise Exception(f"Error while retrieving the documents: {response.status_code} - {response.text}")
@@ -286,31 +582,75 @@ def get_documents_in_collection(session_id, collection_id):
 
 
 
+def get_pages(session_id, collection_id, doc_id, keep_cached=False):
+    """
+    Fetch the page list for a specific document via the /fulldoc endpoint.
+    Uses the fulldoc kept by filter_new_documents, if there is one.
+    With keep_cached the fulldoc stays available for the next call.
+    """
+    with _fulldoc_cache_lock:
+        if keep_cached:
+            data = _fulldoc_cache.get((collection_id, doc_id))
+        else:
+            data = _fulldoc_cache.pop((collection_id, doc_id), None)
+
+    if data is None:
+        client = get_client(session_id)
+        url = f"{BASE_URL}/collections/{collection_id}/{doc_id}/fulldoc"
+        response = client.get(url)
+        if response.status_code != 200:
+            logger.error(f"Error when retrieving pages for document {doc_id}: {response.status_code}")
+            return []
+    try:
+        if data is None:
+            data = response.json()
+            if keep_cached:
+                with _fulldoc_cache_lock:
+                    _fulldoc_cache[(collection_id, doc_id)] = data
+        return data.get("pageList", {}).get("pages", [])
+    except Exception as e:
+        logger.error(f"Error when parsing the pages: {e}")
+        return []
+
+
+
 def get_page_ids(session_id, collection_id, doc_id):
     """Fetch pageIds for a specific document via the /fulldoc endpoint."""
-    headers = {"Cookie": f"JSESSIONID={session_id}"}
-    url = f"{BASE_URL}/collections/{collection_id}/{doc_id}/fulldoc"
-    response = requests.get(url, headers=headers)
-    if response.status_code != 200:
-        logger.error(f"Error when retrieving pages for document {doc_id}: {response.status_code}")
-        return []
     try:
-        data = response.json()
-        pages = data.get("pageList", {}).get("pages", [])
-        page_ids = [page["pageId"] for page in pages]
-        return page_ids
+        return [page["pageId"] for page in get_pages(session_id, collection_id, doc_id)]
     except Exception as e:
         logger.error(f"Error when parsing the pages: {e}")
         return []
 
 
 
-def start_layout_analysis(session_id, collection_id, doc_id, page_ids):
-    """Starts the layout analysis for the specified document, without requiring tsIds."""
+# parameters of /LA/analyze, collId is added per call
+LA_PARAMS = {
+    "doBlockSeg": "true",
+    "doLineSeg": "true",
+    "doWordSeg": "false",
+    "doPolygonToBaseline": "false",
+    "doBaselineToPolygon": "false",
+    "jobImpl": "CITlabAdvancedLaJob",
+    "credits": "AUTO",
+}
 
-    def json_to_xml_description(doc_id, page_ids):
-        try:
-            root = etree.Element("documentSelectionDescriptors")
+
+
+# max. number of documents per /LA/analyze submission
+LA_BATCH_SIZE = int(os.getenv("TRANSKRIBUS_LA_BATCH_SIZE", "50"))
+
+
+
+def documents_to_xml_description(documents):
+    """
+    Builds the documentSelectionDescriptors XML sent to /LA/analyze.
+
+    :param documents: Dict docId -> list of pageIds, one descriptor is created per document
+    """
+    try:
+        root = etree.Element("documentSelectionDescriptors")
+        for doc_id, page_ids in documents.items():
             doc_desc = etree.SubElement(root, "documentSelectionDescriptor")
 
             doc_id_el = etree.SubElement(doc_desc, "docId")
@@ -325,32 +665,76 @@ def start_layout_analysis(session_id, collection_id, doc_id, page_ids):
                 region_ids_el = etree.SubElement(pages_el, "regionIds")
                 region_ids_el.text = ""
 
-            return etree.tostring(root, encoding='utf-8', pretty_print=True)
-        except Exception as e:
-            logger.error(f"[!] Error generating XML description: {e}")
-            raise
+        return etree.tostring(root, encoding='utf-8', pretty_print=True)
+    except Exception as e:
+        logger.error(f"[!] Error generating XML description: {e}")
+        raise
+
+
+
+def json_to_xml_description(doc_id, page_ids):
+    """Builds the documentSelectionDescriptors XML for a single document."""
+    return documents_to_xml_description({doc_id: page_ids})
+
+
+
+def parse_job_ids(response_text, doc_ids):
+    """
+    Maps the answer of a job submission to the submitted documents.
+    The server answers with job statuses (JSON or XML, with docId) or with plain job IDs.
+    Plain IDs are assigned in submission order, a single ID is assigned to all documents.
+
+    :return: Dict docId -> jobId
+    """
+    text = response_text.strip()
+    entries = []
+    try:
+        data = json.loads(text)
+        data = data if isinstance(data, list) else [data]
+        for item in data:
+            if isinstance(item, dict):
+                entries.append((item.get("docId"), str(item.get("jobId"))))
+            else:
+                entries.append((None, str(item)))
+    except ValueError:
+        try:
+            root = etree.fromstring(text.encode("utf-8"))
+            statuses = [el for el in root.iter() if el.find("jobId") is not None]
+            for el in statuses:
+                doc_id = el.findtext("docId")
+                entries.append((int(doc_id) if doc_id and doc_id.isdigit() else None, el.findtext("jobId")))
+        except etree.XMLSyntaxError:
+            entries = [(None, job_id) for job_id in text.replace(",", " ").split()]
+
+    if entries and all(doc_id is not None for doc_id, _ in entries):
+        return {doc_id: job_id for doc_id, job_id in entries}
+    if len(entries) == len(doc_ids):
+        return {doc_id: job_id for doc_id, (_, job_id) in zip(doc_ids, entries)}
+    if len(entries) == 1:
+        return {doc_id: entries[0][1] for doc_id in doc_ids}
+    logger.warning(f"[!] Couldn't assign the job IDs {entries} to the documents {doc_ids}.")
+    return {}
 
+
+
+def start_layout_analysis(session_id, collection_id, doc_id, page_ids):
+    """
+    Starts the layout analysis for the specified document, without requiring tsIds.
+    Returns the job ID or None if the job couldn't be started.
+    """
     url = f"{BASE_URL}/LA/analyze"
-    cookies = {"JSESSIONID": session_id}
+    client = get_client(session_id)
 
-    params = {
-        "collId": collection_id,
-        "doBlockSeg": "true",
-        "doLineSeg": "true",
-        "doWordSeg": "false",
-        "doPolygonToBaseline": "false",
-        "doBaselineToPolygon": "false",
-        "jobImpl": "CITlabAdvancedLaJob",
-        "credits": "AUTO",
-    }
+    params = {"collId": collection_id, **LA_PARAMS}
 
     try:
         xml_desc = json_to_xml_description(doc_id, page_ids)
         headers = {'Content-Type': 'application/xml'}
-        response = requests.post(url, cookies=cookies, params=params, data=xml_desc, headers=headers)
+        response = client.post(url, params=params, data=xml_desc, headers=headers)
 
         if response.status_code == 200:
             logger.info(f"[+] Layout analysis for document {doc_id} started.")
+            return parse_job_ids(response.text, [doc_id]).get(doc_id)
         else:
             logger.error(f"[-] Error starting layout analysis: {response.status_code} - {response.text}")
     except requests.exceptions.RequestException as e:
@@ -360,50 +744,96 @@ def start_layout_analysis(session_id, collection_id, doc_id, page_ids):
 
 
 
-def wait_for_jobs(session_id, doc_id=None, job_types=("LAJob", "TextRecognitionJob", "UploadJob"), poll_interval=5):
+def start_layout_analysis_batch(session_id, collection_id, documents, max_batch_size=LA_BATCH_SIZE):
     """
-    Waits until all relevant jobs are completed. If doc_id is None, it waits for all active jobs.
+    Starts the layout analysis for many documents with as few submissions as possible.
+    Each submission contains up to max_batch_size documents.
+
+    :param session_id: Transkribus session ID
+    :param collection_id: ID of the collection
+    :param documents: Dict docId -> list of pageIds
+    :param max_batch_size: Max. number of documents per submission
+    :return: Dict docId -> jobId for all documents whose LA was started
     """
-    headers = {"Cookie": f"JSESSIONID={session_id}"}
-    job_list_url = f"{BASE_URL}/jobs/list"
+    url = f"{BASE_URL}/LA/analyze"
+    client = get_client(session_id)
+    params = {"collId": collection_id, **LA_PARAMS}
+    headers = {'Content-Type': 'application/xml'}
+
+    doc_ids = list(documents)
+    job_ids = {}
+    for i in range(0, len(doc_ids), max_batch_size):
+        batch = doc_ids[i:i + max_batch_size]
+        try:
+            xml_desc = documents_to_xml_description({doc_id: documents[doc_id] for doc_id in batch})
+            response = client.post(url, params=params, data=xml_desc, headers=headers)
 
+            if response.status_code == 200:
+                batch_job_ids = parse_job_ids(response.text, batch)
+                job_ids.update(batch_job_ids)
+                logger.info(f"[+] Layout analysis for {len(batch)} documents started: {batch_job_ids}")
+            else:
+                logger.error(f"[-] Error starting layout analysis for {batch}: {response.status_code} - {response.text}")
+        except requests.exceptions.RequestException as e:
+            logger.error(f"[!] Request failed: {e}")
+        except Exception as e:
+            logger.error(f"[!] Unexpected error: {e}")
+
+    return job_ids
+
+
+
+def wait_for_jobs(session_id, doc_id=None, job_types=DEFAULT_JOB_TYPES, timeout=None):
+    """
+    Waits until all relevant jobs are completed. If doc_id is None, it waits for all active jobs.
+    The job list is polled by the shared JobTracker of the session, so concurrent
+    waiters share one /jobs/list request per tick.
+    A job ending as FAILED or CANCELED counts as completed here, use wait_for_job for its state.
+
+    :return: True once the jobs are completed, False if the wait failed or timed out
+    """
     print("Wait for Transkribus-Jobs...")
 
-    while True:
-        response = requests.get(job_list_url, headers=headers)
-        if response.status_code != 200:
-            print(f"Error retrieving job status: {response.status_code} - {response.text}")
-            return
+    try:
+        with measure("job_wait"):
+            get_job_tracker(session_id).wait_for_document(doc_id, job_types, timeout=timeout)
+    except Exception as e:
+        print(f"Error retrieving job status: {e}")
+        return False
 
-        jobs = response.json()
+    print("All relevant jobs completed.")
+    return True
 
-        # Filter for relevant jobs
-        relevant_jobs = [
-            job for job in jobs
-            if (doc_id is None or job.get("docId") == doc_id)
-            and job.get("state") != "FINISHED"
-            and job.get("jobType") in job_types
-        ]
 
-        if not relevant_jobs:
-            print("All relevant jobs completed.")
-            break
 
-        print(f"Open Jobs: {[ (j['jobId'], j['jobType'], j['state']) for j in relevant_jobs ]}")
-        time.sleep(poll_interval)
+def wait_for_job(session_id, job_id, timeout=None):
+    """
+    Waits until a single job is completed, e.g. a LA job submitted for several documents,
+    whose job status doesn't carry the docIds.
+
+    :return: The job status as returned by the server or None if it couldn't be retrieved
+    """
+    print(f"Wait for Transkribus-Job {job_id}...")
+
+    try:
+        with measure("job_wait"):
+            status = get_job_tracker(session_id).wait_for_job(job_id, timeout=timeout)
+    except Exception as e:
+        print(f"Error retrieving job status: {e}")
+        return None
+
+    print(f"Job {job_id} completed with state {status.get('state')}.")
+    return status
 
 
 
 def start_ocr(session_id, collection_id, doc_id, page_ids): # Doesn't work yet!
     """
     Starts OCR via /recognition/ocr using the legacy OCR engine.
+    Returns the job ID sent by the server or None if the job couldn't be started.
     """
-    import logging
-    import requests
-
-    logger = logging.getLogger(__name__)
     url = f"{BASE_URL}/recognition/ocr"
-    cookies = {"JSESSIONID": session_id}
+    client = get_client(session_id)
 
     params = {
         "collId": collection_id,
@@ -412,20 +842,102 @@ def start_ocr(session_id, collection_id, doc_id, page_ids): # Doesn't work yet!
         "type": "Legacy",  # Legacy OCR-Engine
     }
 
-    response = requests.post(url, cookies=cookies, params=params)
+    response = client.post(url, params=params)
 
     if response.status_code == 200:
         logger.info(f"[+] OCR started for document {doc_id}")
+        return response.text.strip()
     else:
         logger.error(f"[-] Error starting OCR: {response.status_code} - {response.text}")
+        return None
+
+
+
+def download_file(client, url, path, chunk_size=DOWNLOAD_CHUNK_SIZE, attempts=DOWNLOAD_ATTEMPTS):
+    """
+    Streams url to path. The data goes to path + ".part" first, if the connection breaks
+    (or a partial file is left from an earlier run) the download continues with an HTTP Range request.
+
+    :param client: requests.Session used for the download, without the API session (see get_download_session)
+    :param url: URL of the file
+    :param path: Target path
+    :param chunk_size: Bytes read and written per chunk
+    :param attempts: Number of attempts before the error is raised
+    :return: path
+    """
+    part_path = path + ".part"
+    with measure("download") as measurement:
+        _download_with_resume(client, url, part_path, chunk_size, attempts, measurement)
+
+    os.replace(part_path, path)
+    return path
+
+
+def _download_with_resume(client, url, part_path, chunk_size, attempts, measurement):
+    """Download loop of download_file, continues part_path until the file is complete."""
+    for attempt in range(1, attempts + 1):
+        measurement.retries = attempt - 1
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+        try:
+            with client.get(url, stream=True, headers=headers) as response:
+                if response.status_code == 416:
+                    break  # nothing left to download
+                if response.status_code not in (200, 206):
+                    raise Exception(f"Error downloading: {response.status_code} - {response.text}")
+
+                # 200 means the server ignored the range, so the file starts again
+                mode = "ab" if response.status_code == 206 else "wb"
+                with open(part_path, mode) as f:
+                    for chunk in response.iter_content(chunk_size=chunk_size):
+                        f.write(chunk)
+                        measurement.bytes += len(chunk)
+            break
+        except requests.exceptions.RequestException as e:
+            if attempt == attempts:
+                raise
+            logger.warning(f"[!] Download interrupted ({attempt}/{attempts}), resuming: {e}")
+
+
+
+def is_page_xml(member_name):
+    """True for the PAGE XML files of an export, they are stored in a 'page' folder."""
+    parts = member_name.split("/")
+    return "page" in parts[:-1] and parts[-1].lower().endswith(".xml")
+
+
+
+def extract_export(zip_path, extract_dir, member_filter=None, delete_zip=True):
+    """
+    Extracts an export ZIP and deletes it afterwards.
+
+    :param zip_path: Path of the downloaded ZIP
+    :param extract_dir: Target directory
+    :param member_filter: Optional function member name -> bool, only matching members are extracted
+    :param delete_zip: Delete the ZIP after a successful extraction
+    :return: extract_dir
+    """
+    os.makedirs(extract_dir, exist_ok=True)
+    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+        members = [name for name in zip_ref.namelist() if member_filter is None or member_filter(name)]
+        zip_ref.extractall(extract_dir, members=members)
+    if delete_zip:
+        os.remove(zip_path)
+    return extract_dir
 
 
 
-def export_and_download(session_id, collection_id, document_id):
-    """Exports, downloads, and extracts the document after processing."""
-    headers = {"Cookie": f"JSESSIONID={session_id}"}
+def export_and_download(session_id, collection_id, document_id, page_xml_only=False, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    """
+    Exports, downloads, and extracts the document after processing.
+    The ZIP is streamed to disk (resumable) and deleted after the extraction.
+    With page_xml_only only the PAGE XML files are extracted.
+    Returns the directory the export was extracted to or None on errors.
+    """
+    client = get_client(session_id)
     url = f"{BASE_URL}/collections/{collection_id}/{document_id}/export"
-    response = requests.post(url, headers=headers, json={"format": "application/zip"})
+    # a repeated export only creates another read-only ZIP, so it's safe to retry on 5xx
+    response = client.post(url, json={"format": "application/zip"}, idempotent=True)
 
     try:
         response_data = response.json()
@@ -446,41 +958,32 @@ def export_and_download(session_id, collection_id, document_id):
     print(f"Export job started! Job ID: {job_id}")
 
     # Wait for export to complete
-    while True:
-        time.sleep(5)
-        status_url = f"{BASE_URL}/jobs/{job_id}"
-        status_response = requests.get(status_url, headers=headers)
-
-        if status_response.status_code != 200:
-            print(f"Error retrieving job status: {status_response.status_code} - {status_response.text}")
-            return
+    try:
+        with measure("job_wait"):
+            status_data = get_job_tracker(session_id).wait_for_job(job_id)
+    except Exception as e:
+        print(f"Error retrieving job status: {e}")
+        return
 
-        status_data = status_response.json()
-        if status_data.get("state") == "FINISHED":
-            download_url = status_data.get("result")
-            if download_url:
-                print("Export completed. Download URL is available.")
-                break
-        else:
-            print(f"Export status: {status_data.get('state')}. Waiting for completion...")
+    download_url = status_data.get("result")
+    if status_data.get("state") != "FINISHED" or not download_url:
+        print(f"Export job {job_id} ended with state {status_data.get('state')} without a download URL.")
+        return
+    print("Export completed. Download URL is available.")
 
     # Download the file
-    response = requests.get(download_url, stream=True)
-    if response.status_code == 200:
-        os.makedirs("downloads", exist_ok=True)
-        zip_path = os.path.join("downloads", f"export_{job_id}.zip")
-        with open(zip_path, "wb") as f:
-            for chunk in response.iter_content(chunk_size=1024):
-                f.write(chunk)
-        print(f"Download completed: {zip_path}")
-
-        # Extract ZIP
-        extract_dir = os.path.join("downloads", f"export_{job_id}")
-        os.makedirs(extract_dir, exist_ok=True)
-        with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-            zip_ref.extractall(extract_dir)
-        print(f"ZIP extracted to: {extract_dir}")
-
-    else:
-        print(f"Error downloading: {response.status_code} - {response.text}")
+    os.makedirs(DOWNLOAD_DIR, exist_ok=True)
+    zip_path = os.path.join(DOWNLOAD_DIR, f"export_{job_id}.zip")
+    try:
+        download_file(get_download_session(), download_url, zip_path, chunk_size=chunk_size)
+    except Exception as e:
+        print(f"Error downloading: {e}")
+        return None
+    print(f"Download completed: {zip_path}")
+
+    # Extract ZIP
+    extract_dir = os.path.join(DOWNLOAD_DIR, f"export_{job_id}")
+    extract_export(zip_path, extract_dir, member_filter=is_page_xml if page_xml_only else None)
+    print(f"ZIP extracted to: {extract_dir}")
+    return extract_dir
 